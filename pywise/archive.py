@@ -0,0 +1,346 @@
+import os
+import re
+import sqlite3
+import hashlib
+import datetime
+import logging
+
+DEFAULT_INDEX_DIR = os.path.join("~", ".cache", "pywise")
+FRAME_TYPES = ["Bias", "Dark", "Flat"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS masters (
+    telescope TEXT NOT NULL,
+    instrument TEXT NOT NULL,
+    ccd_str TEXT NOT NULL,
+    filter TEXT NOT NULL,
+    frame_type TEXT NOT NULL,
+    date TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (telescope, instrument, ccd_str, filter, frame_type, date)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def get_index_dir(config):
+    """
+    :return: local folder of the calibration archive indexes (INDEX_DIR of the CAL section of config.ini)
+    """
+    return os.path.expanduser(config.get("CAL", "INDEX_DIR", fallback="") or DEFAULT_INDEX_DIR)
+
+
+def parse_master_filename(filename, telescope):
+    """
+    parses a master calibration frame file name of the form
+    <Bias|Dark|Flat>_<telescope>_<instrument>_<YYYYMMDD>_<ccd_str>[_<filter>].fits
+
+    :param filename: file name (with or without the path)
+    :param telescope: telescope name
+    :return: dict with frame_type, instrument, date, ccd_str and filter, or None if the name does not match
+    """
+    pattern = rf"^({'|'.join(FRAME_TYPES)})_{re.escape(telescope)}_(.+)_(\d{{8}})_(x\d+-\d+_\d+bin_y\d+-\d+_\d+bin)(?:_(.+))?\.fits$"
+    match = re.match(pattern, os.path.basename(filename))
+    if match is None:
+        return None
+
+    frame_type, instrument, date, ccd_str, filt = match.groups()
+    return {"frame_type": frame_type, "instrument": instrument, "date": date, "ccd_str": ccd_str,
+            "filter": filt if filt is not None else ""}
+
+
+def get_master_filename(cal_archive_path, frame_type, telescope, instrument, t, ccd_str, filt=""):
+    """
+    :param t: datetime.date
+    :return: full path to the master calibration frame of the given date (the inverse of parse_master_filename)
+    """
+    filename = f"{frame_type}_{telescope}_{instrument}_{t.strftime('%Y%m%d')}_{ccd_str}"
+    if filt:
+        filename += f"_{filt}"
+    return os.path.join(cal_archive_path, filename + ".fits")
+
+
+def nearest_dates(dates, nights, max_day_shift=14, include_same_day=True):
+    """
+    finds the nearest date of each night, in a single sweep over both lists.
+    On equal distance the earlier date is preferred.
+
+    :param dates: sorted list of datetime.date (of the available master frames)
+    :param nights: sorted list of datetime.date
+    :param max_day_shift: maximal number of days away to look for
+    :param include_same_day: False - ignore a date of the night itself
+    :return: dict of the nearest date of each night (None if there is none within max_day_shift days)
+    """
+    nearest = {}
+    i = 0
+    for t in nights:
+        # dates[:i] are before t, dates[i:j] are on t
+        while (i < len(dates)) and (dates[i] < t):
+            i += 1
+        j = i
+        while (j < len(dates)) and (dates[j] == t):
+            j += 1
+        if include_same_day and (i < j):
+            nearest[t] = t
+            continue
+        before = dates[i-1] if i > 0 else None
+        after = dates[j] if j < len(dates) else None
+        if (before is not None) and ((after is None) or ((t - before) <= (after - t))):
+            date = before
+        else:
+            date = after
+        nearest[t] = date if (date is not None) and (abs((date - t).days) <= max_day_shift) else None
+    return nearest
+
+
+class MasterIndex:
+    """
+    persistent (SQLite) index of the master calibration frame archive of a single telescope.
+
+    The index is kept in a local folder (SQLite locking is unreliable on network file systems), one per host, and is
+    rebuilt from a single directory listing whenever the archive folder was modified by someone else.
+    """
+
+    def __init__(self, cal_archive_path, telescope, index_dir=None, log=None):
+        """
+        :param index_dir: local folder of the index file (None - DEFAULT_INDEX_DIR)
+        """
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.path = cal_archive_path
+        self.telescope = telescope
+        self.log = log
+        if index_dir is None:
+            index_dir = os.path.expanduser(DEFAULT_INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        path_hash = hashlib.sha1(os.path.abspath(cal_archive_path).encode()).hexdigest()[:16]
+        self.index_file = os.path.join(index_dir, f"index_{telescope}_{path_hash}.sqlite")
+        self._conn = None
+        self._dir_mtime = None
+        # incremented whenever the indexed masters may have changed
+        self.version = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.index_file, timeout=60)
+            try:
+                self._conn.executescript(_SCHEMA)
+            except sqlite3.DatabaseError:
+                # the index is only a cache of the archive folder, so a corrupt index is simply rebuilt
+                self.log.warning(f"Calibration archive index {self.index_file} is corrupt, rebuilding.")
+                self._conn.close()
+                os.remove(self.index_file)
+                self._conn = sqlite3.connect(self.index_file, timeout=60)
+                self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def refresh(self, force=False):
+        """
+        rescans the archive folder if it was modified since the index was last built.
+        """
+        conn = self._connect()
+        dir_mtime = str(os.stat(self.path).st_mtime_ns)
+        if (not force) and (dir_mtime == self._dir_mtime):
+            return
+
+        row = conn.execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+        if force or (row is None) or (row[0] != dir_mtime):
+            self.log.debug(f"Indexing calibration archive {self.path}...")
+            rows = []
+            for filename in os.listdir(self.path):
+                info = parse_master_filename(filename, self.telescope)
+                if info is None:
+                    continue
+                rows.append((self.telescope, info["instrument"], info["ccd_str"], info["filter"], info["frame_type"],
+                             info["date"], filename))
+            with conn:
+                conn.execute("DELETE FROM masters WHERE telescope = ?", (self.telescope,))
+                conn.executemany("INSERT OR REPLACE INTO masters VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime', ?)", (dir_mtime,))
+            self.log.debug(f"Calibration archive index contains {len(rows)} master frames.")
+            self.version += 1
+
+        self._dir_mtime = dir_mtime
+
+    def _update_dir_mtime(self, conn):
+        """
+        records the directory mtime after a change made by this process, so that it doesn't trigger a rescan (unless
+        the index was already out of date).
+        """
+        row = conn.execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+        if (self._dir_mtime is None) or (row is None) or (row[0] != self._dir_mtime):
+            return
+        self._dir_mtime = str(os.stat(self.path).st_mtime_ns)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime', ?)", (self._dir_mtime,))
+
+    def add(self, filename):
+        """
+        adds a newly-written master calibration frame to the index.
+        """
+        info = parse_master_filename(filename, self.telescope)
+        if info is None:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO masters VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (self.telescope, info["instrument"], info["ccd_str"], info["filter"], info["frame_type"],
+                          info["date"], os.path.basename(filename)))
+            self._update_dir_mtime(conn)
+        self.version += 1
+
+    def discard(self, filename):
+        """
+        removes a master calibration frame that was found missing from the index.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM masters WHERE telescope = ? AND filename = ?",
+                         (self.telescope, os.path.basename(filename)))
+            self._update_dir_mtime(conn)
+        self.version += 1
+
+    def get_dates(self, frame_type, instrument, ccd_str, filt=""):
+        """
+        :return: sorted list of dates (YYYYMMDD) of the available master frames
+        """
+        self.refresh()
+        rows = self._connect().execute("SELECT date FROM masters WHERE telescope = ? AND instrument = ? "
+                                       "AND ccd_str = ? AND filter = ? AND frame_type = ? ORDER BY date",
+                                       (self.telescope, instrument, ccd_str, filt, frame_type)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_ccd_strs(self, frame_type, instrument, filt=""):
+        """
+        :return: sorted list of the ccd geometries (ccd_str) of the available master frames
+        """
+        self.refresh()
+        rows = self._connect().execute("SELECT DISTINCT ccd_str FROM masters WHERE telescope = ? AND instrument = ? "
+                                       "AND filter = ? AND frame_type = ? ORDER BY ccd_str",
+                                       (self.telescope, instrument, filt, frame_type)).fetchall()
+        return [row[0] for row in rows]
+
+    def find_nearest(self, frame_type, instrument, t, ccd_str, filt="", max_day_shift=14, include_same_day=True):
+        """
+        finds the master calibration frame nearest to a given date.
+        On equal distance the earlier date is preferred.
+
+        :param frame_type: "Bias", "Dark" or "Flat"
+        :param instrument: instrument name
+        :param t: datetime.date
+        :param ccd_str: output of utils.get_ccd_str
+        :param filt: filter name (flats only)
+        :param max_day_shift: maximal number of days away to look for
+        :param include_same_day: False - ignore a master frame of the date itself
+        :return: full path to the master frame, or "" if none was found
+        """
+        while True:
+            nearest = nearest_dates(self.get_master_dates(frame_type, instrument, ccd_str, filt), [t],
+                                    max_day_shift=max_day_shift, include_same_day=include_same_day)[t]
+            if nearest is None:
+                return ""
+
+            filename = self.get_filename(frame_type, instrument, nearest, ccd_str, filt)
+            if os.path.isfile(filename):
+                return filename
+
+            self.log.debug(f"Indexed master {filename} is missing, removing it from the index.")
+            self.discard(filename)
+
+    def get_master_dates(self, frame_type, instrument, ccd_str, filt=""):
+        """
+        :return: sorted list of dates (datetime.date) of the available master frames
+        """
+        return [datetime.datetime.strptime(d, "%Y%m%d").date()
+                for d in self.get_dates(frame_type, instrument, ccd_str, filt)]
+
+    def get_filename(self, frame_type, instrument, t, ccd_str, filt=""):
+        """
+        :return: full path to the master frame of the given date (whether it exists or not)
+        """
+        return get_master_filename(self.path, frame_type, self.telescope, instrument, t, ccd_str, filt)
+
+
+class MasterResolver:
+    """
+    nearest master calibration frames of all the nights of a date range, found in a single sweep over the archive index
+    for each frame type, instrument, ccd geometry and filter, and kept until the archive changes.
+
+    It answers find_nearest as MasterIndex does (falling back to the index for nights outside the range).
+    """
+
+    def __init__(self, index, nights, max_day_shift=14):
+        """
+        :param index: MasterIndex of the calibration archive
+        :param nights: list of datetime.date
+        """
+        self.index = index
+        self.nights = sorted(set(nights))
+        self.max_day_shift = max_day_shift
+        self._nearest = {}
+        self._version = None
+
+    def resolve(self, frame_type, instrument, ccd_str, filt="", include_same_day=True):
+        """
+        :return: dict of the date of the nearest master frame of each night of the range (None if there is none within
+                 max_day_shift days)
+        """
+        self.index.refresh()
+        if self._version != self.index.version:
+            self._nearest.clear()
+            self._version = self.index.version
+
+        key = (frame_type, instrument, ccd_str, filt, include_same_day)
+        if key not in self._nearest:
+            self._nearest[key] = nearest_dates(self.index.get_master_dates(frame_type, instrument, ccd_str, filt),
+                                               self.nights, max_day_shift=self.max_day_shift,
+                                               include_same_day=include_same_day)
+        return self._nearest[key]
+
+    def find_nearest(self, frame_type, instrument, t, ccd_str, filt="", max_day_shift=None, include_same_day=True):
+        """
+        see MasterIndex.find_nearest
+
+        :param max_day_shift: None - the max_day_shift of the resolver
+        """
+        if max_day_shift is None:
+            max_day_shift = self.max_day_shift
+        if (max_day_shift != self.max_day_shift) or (t not in self.nights):
+            return self.index.find_nearest(frame_type, instrument, t, ccd_str, filt=filt, max_day_shift=max_day_shift,
+                                           include_same_day=include_same_day)
+
+        while True:
+            nearest = self.resolve(frame_type, instrument, ccd_str, filt, include_same_day=include_same_day)[t]
+            if nearest is None:
+                return ""
+
+            filename = self.index.get_filename(frame_type, instrument, nearest, ccd_str, filt)
+            if os.path.isfile(filename):
+                return filename
+
+            self.index.log.debug(f"Indexed master {filename} is missing, removing it from the index.")
+            self.index.discard(filename)
+
+
+_indices = {}
+
+
+def get_master_index(cal_archive_path, telescope, index_dir=None, log=None):
+    """
+    :param index_dir: local folder of the index file (see get_index_dir)
+    :return: the (shared) MasterIndex of the given calibration archive folder
+    """
+    key = (os.path.abspath(cal_archive_path), telescope, os.getpid())
+    if key not in _indices:
+        _indices[key] = MasterIndex(cal_archive_path, telescope, index_dir=index_dir, log=log)
+    elif log is not None:
+        _indices[key].log = log
+    return _indices[key]
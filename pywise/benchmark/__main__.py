@@ -0,0 +1,44 @@
+import sys
+import json
+import argparse
+import tempfile
+from pywise.benchmark.run import run, compare
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m pywise.benchmark",
+                                     description="Benchmark the pyWise pipeline on synthetic Wise Observatory nights.")
+    parser.add_argument("-d", "--dir", metavar="path", help="scratch folder for the synthetic nights (default: temporary folder)")
+    parser.add_argument("-n", "--frames", metavar="N,...", default="5", help="numbers of raw frames of each kind (default: 5)")
+    parser.add_argument("-g", "--geometry", metavar="SIZE[:BIN],...", default="4096",
+                        help="frame geometries: frame size and binning, e.g. 4096,2048:2,1024 (default: 4096)")
+    parser.add_argument("-e", "--engine", metavar="ENGINE,...", default="ccdproc", help="science frame engines (default: ccdproc)")
+    parser.add_argument("-m", "--combine", metavar="METHOD,...", default="ccdproc", help="master combination methods (default: ccdproc)")
+    parser.add_argument("-s", "--set", metavar="SECTION.KEY=VALUE", action="append", default=[],
+                        help="additional config.ini setting of all the runs (can be repeated)")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=1, help="number of reduce_night processes (default: 1)")
+    parser.add_argument("-r", "--repeat", metavar="N", type=int, default=1, help="number of timed repetitions, the best is kept (default: 1)")
+    parser.add_argument("-k", "--catalog", metavar="N", type=int, default=0,
+                        help="also time the header catalog of a night of N raw frames of each kind (default: 0 - skip)")
+    parser.add_argument("-o", "--output", metavar="file.json", help="JSON result file")
+    parser.add_argument("--compare", metavar="old.json", help="print the wall time ratios to a previous result file")
+    parser.add_argument("--no-golden", action="store_true", help="skip the golden-output check of the faster paths")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        report = run(root, frame_counts=[int(n) for n in args.frames.split(",")], geometries=args.geometry.split(","),
+                     engines=args.engine.split(","), combines=args.combine.split(","),
+                     options=dict(option.split("=", 1) for option in args.set), workers=args.workers,
+                     repeat=args.repeat, golden=not args.no_golden, catalog_frames=args.catalog,
+                     output=args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+    if not all(result["passed"] for result in report["golden"]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,264 @@
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import datetime
+import subprocess
+import ccdproc
+import numpy as np
+from astropy.io import fits
+from pywise import calframes, utils
+from pywise.cache import get_master_cache
+from pywise.catalog import get_catalog, read_header, HeaderCatalog, CATALOG_FILENAME, DEFAULT_CATALOG_THREADS
+from pywise.keywords import get_profile
+from pywise.wise import reduce_night
+from pywise.benchmark.synthetic import create_night, write_config, FLI_PL16801_SHAPE, INSTRUMENT
+
+DATE = datetime.date(2019, 5, 29)
+FILTERS = ("V", "R")
+# settings of the faster paths checked against the reference reduction (ENGINE = ccdproc, COMBINE = ccdproc)
+GOLDEN_VARIANTS = ({"GENERAL.ENGINE": "fast"},
+                   {"CAL.COMBINE": "tiled"},
+                   {"GENERAL.ENGINE": "fast", "CAL.COMBINE": "tiled"},
+                   {"GENERAL.MEMMAP": True},
+                   {"GENERAL.ENGINE": "fast", "GENERAL.MEMMAP": True},
+                   {"GENERAL.OUTPUT_FORMAT": "gzip"},
+                   {"GENERAL.PREFETCH": 0})
+
+
+def parse_geometry(geometry):
+    """
+    :param geometry: "<size>[:<binning>]", e.g. "4096" (full frame), "2048:2" (full frame, binned 2x2),
+                     "1024" (centered 1024x1024 subframe)
+    :return: dict of create_night keyword arguments
+    """
+    size, _, binning = geometry.partition(":")
+    size, binning = int(size), int(binning or 1)
+    full_size = FLI_PL16801_SHAPE[0] // binning
+    assert(size <= full_size), f"{geometry} is larger than the {INSTRUMENT} chip!"
+    origin = (full_size - size) // 2
+    return {"shape": (size, size), "binning": binning, "x_subframe": origin, "y_subframe": origin}
+
+
+def get_version():
+    """
+    :return: git commit (with a -dirty suffix if there are local changes) of the pywise source tree, if available
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _time(func, *args, repeat=1, **kwargs):
+    """
+    :return: the best wall and CPU times of repeated calls [sec]
+    """
+    wall, cpu = [], []
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        func(*args, **kwargs)
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+    return min(wall), min(cpu)
+
+
+def _get_calframes(config_file, telescope, log):
+    config = utils.get_config(config_file)
+    im_path = config.get("GENERAL", "PATH") + config.get(telescope, "PATH") + DATE.strftime("%Y%m%d") + \
+        config.get(telescope, "DIR_SUFFIX")
+    ccd_str = utils.get_ccd_str(utils.get_ccd_shape(get_catalog(im_path, log=log), telescope))
+    for filt in FILTERS:
+        calframes.get_calframes(DATE.year, DATE.month, DATE.day, filt, ccd_str, telescope=telescope,
+                                instrument=INSTRUMENT, log=log, config_file=config_file)
+
+
+def _get_options_str(options):
+    return ",".join(f"{key}={val}" for key, val in sorted(options.items()))
+
+
+def benchmark_night(root, n_frames, geometry, telescope="C28", engine="ccdproc", combine="ccdproc", options=None,
+                    workers=1, repeat=1):
+    """
+    times create_masters, get_calframes and reduce_night on a synthetic night.
+
+    :param root: folder of the synthetic data tree
+    :param n_frames: number of raw frames of each kind (bias, dark, flat and science per filter)
+    :param geometry: frame geometry (see parse_geometry)
+    :param options: dict of additional settings (see synthetic.write_config)
+    :return: list of result dicts, one per stage
+    """
+    options = {"GENERAL.ENGINE": engine, "CAL.COMBINE": combine, **(options or {})}
+    create_night(root, date=DATE.strftime("%Y%m%d"), telescope=telescope, n_bias=n_frames, n_dark=n_frames,
+                 n_flat=n_frames, n_light=n_frames, filters=FILTERS, **parse_geometry(geometry))
+    config_file = write_config(root, options)
+    get_master_cache().clear()
+
+    log = utils.init_log("benchmark", config_file)
+    stages = {"create_masters": (calframes.create_masters, (DATE.year, DATE.month, DATE.day, telescope),
+                                 {"log": log, "config_file": config_file}),
+              "get_calframes": (_get_calframes, (config_file, telescope, log), {}),
+              "reduce_night": (reduce_night, (DATE.year, DATE.month, DATE.day, telescope),
+                               {"config_file": config_file, "workers": workers, "create_calframes": False})}
+    results = []
+    try:
+        for stage, (func, args, kwargs) in stages.items():
+            wall, cpu = _time(func, *args, repeat=repeat, **kwargs)
+            results.append({"stage": stage, "geometry": geometry, "n_frames": n_frames,
+                            "options": _get_options_str(options), "workers": workers, "wall": wall, "cpu": cpu})
+            print(f"{geometry:>8} {n_frames:>4} frames {stage:>15}: {wall:8.3f} s wall, {cpu:8.3f} s CPU "
+                  f"({_get_options_str(options)})")
+    finally:
+        utils.close_log(log)
+
+    return results
+
+
+def benchmark_catalog(root, n_frames, telescope="C28", threads=DEFAULT_CATALOG_THREADS, repeat=1):
+    """
+    times building the header catalog of a synthetic night (of small frames, so that the headers dominate) with
+    ccdproc.ImageFileCollection(keywords="*"), with astropy (every card of each header), and with the header scanner
+    (on one thread and on a thread pool), and checks that the scanned headers give the same ccd geometry and image
+    type groups (utils.find_groups) as ImageFileCollection.
+
+    :param n_frames: number of raw frames of each kind (bias, dark, flat and science per filter)
+    :return: list of result dicts, one per method, and the result dict of the grouping check
+    """
+    create_night(root, date=DATE.strftime("%Y%m%d"), telescope=telescope, n_bias=n_frames, n_dark=n_frames,
+                 n_flat=n_frames, n_light=n_frames, filters=FILTERS, **parse_geometry("64"))
+    config = utils.get_config(write_config(root))
+    im_path = config.get("GENERAL", "PATH") + config.get(telescope, "PATH") + DATE.strftime("%Y%m%d") + \
+        config.get(telescope, "DIR_SUFFIX") + os.sep
+    filenames = sorted(filename for filename in os.listdir(im_path) if filename.endswith(".fits"))
+
+    def scan(threads):
+        if os.path.isfile(im_path + CATALOG_FILENAME):
+            os.remove(im_path + CATALOG_FILENAME)
+        return HeaderCatalog(im_path, threads=threads)
+
+    methods = {"ImageFileCollection": lambda: ccdproc.ImageFileCollection(im_path, keywords="*"),
+               "astropy": lambda: [read_header(im_path + filename) for filename in filenames],
+               "scan": lambda: scan(1),
+               f"scan x{threads}": lambda: scan(threads)}
+    results = []
+    for method, func in methods.items():
+        wall, cpu = _time(func, repeat=repeat)
+        results.append({"stage": "catalog", "geometry": "64", "n_frames": len(filenames), "options": method,
+                        "workers": 1, "wall": wall, "cpu": cpu})
+        print(f"{len(filenames):>5} headers {method:>20}: {wall:8.3f} s wall, {cpu:8.3f} s CPU "
+              f"({len(filenames)/wall:.0f} headers/s)")
+
+    profile = get_profile(telescope)
+    keys = utils.get_ccd_keys(telescope, original_keys=True) + [profile.key("image_type").lower()]
+    groups = {}
+    for name, imlist in (("ImageFileCollection", ccdproc.ImageFileCollection(im_path, keywords="*")),
+                         ("scan", scan(threads))):
+        vals, idx = utils.find_groups(imlist, keys, return_inverse=True)
+        files = [os.path.basename(filename) for filename in imlist.files]
+        groups[name] = {filename: tuple(str(val) for val in vals[:, i]) for filename, i in zip(files, idx.ravel())}
+    is_equal = groups["ImageFileCollection"] == groups["scan"]
+    check = {"options": "catalog scan", "n_files": len(groups["scan"]), "n_expected": len(filenames),
+             "max_rel_diff": 0. if is_equal else 1., "passed": is_equal}
+    print(f"catalog check: {len(groups['scan'])}/{len(filenames)} files, "
+          f"{'same groups as' if is_equal else 'DIFFERENT groups from'} ImageFileCollection - "
+          f"{'passed' if is_equal else 'FAILED'}")
+
+    return results, check
+
+
+def _get_reduced_files(root, reduced_dir):
+    return {os.path.basename(filename): filename
+            for filename in glob.glob(os.path.join(root, "images", "*", "*", reduced_dir, "*.fits"))}
+
+
+def check_golden(root, geometry="512", n_frames=5, telescope="C28", rtol=1e-5):
+    """
+    reduces a synthetic night with the reference (ccdproc) path and with each of the faster paths, and compares the
+    reduced frames.
+
+    :param rtol: maximal difference, relative to the peak of the reference frame
+    :return: list of result dicts, one per faster path
+    """
+    create_night(root, date=DATE.strftime("%Y%m%d"), telescope=telescope, n_bias=n_frames, n_dark=n_frames,
+                 n_flat=n_frames, n_light=n_frames, filters=FILTERS, **parse_geometry(geometry))
+
+    def reduce(name, options):
+        config_file = write_config(root, options, reduced_dir=f"reduced_{name}", cal_dir=f"cal_{name}",
+                                   filename=f"config_{name}.ini")
+        get_master_cache().clear()
+        reduce_night(DATE.year, DATE.month, DATE.day, telescope, config_file=config_file)
+        return _get_reduced_files(root, f"reduced_{name}")
+
+    golden = reduce("golden", {})
+    results = []
+    for i, options in enumerate(GOLDEN_VARIANTS):
+        reduced = reduce(f"variant{i}", options)
+        max_diff = 0.
+        for name in golden.keys() & reduced.keys():
+            expected, actual = fits.getdata(golden[name]).astype(np.float64), fits.getdata(reduced[name])
+            max_diff = max(max_diff, float(np.nanmax(np.abs(actual - expected)) / np.nanmax(np.abs(expected))))
+        is_equal = (golden.keys() == reduced.keys()) and (max_diff <= rtol)
+        results.append({"options": _get_options_str(options), "n_files": len(reduced), "n_expected": len(golden),
+                        "max_rel_diff": max_diff, "passed": is_equal})
+        print(f"golden check {_get_options_str(options)}: {len(reduced)}/{len(golden)} files, "
+              f"max relative difference {max_diff:.2e} - {'passed' if is_equal else 'FAILED'}")
+
+    return results
+
+
+def compare(old_results, new_results):
+    """
+    prints the wall time ratios (new/old) of the stages benchmarked in both result files.
+    """
+    def get_key(result):
+        return tuple(result[key] for key in ("stage", "geometry", "n_frames", "options", "workers"))
+
+    old = {get_key(result): result for result in old_results["results"]}
+    print(f"{old_results['version'] or 'old'} -> {new_results['version'] or 'new'}:")
+    for result in new_results["results"]:
+        key = get_key(result)
+        if key in old:
+            print(f"{result['geometry']:>8} {result['n_frames']:>4} frames {result['stage']:>15}: "
+                  f"{result['wall'] / old[key]['wall']:6.2f}x ({result['options']})")
+
+
+def run(root, frame_counts=(5,), geometries=("4096",), engines=("ccdproc",), combines=("ccdproc",), options=None,
+        workers=1, repeat=1, golden=True, catalog_frames=0, output=None):
+    """
+    runs the benchmark over all the combinations of frame counts, geometries, engines and combination methods.
+
+    :param root: scratch folder for the synthetic data trees
+    :param catalog_frames: number of raw frames of each kind of the header catalog benchmark (0 - skip it)
+    :param options: dict of additional settings of all the runs (see synthetic.write_config)
+    :param output: JSON result file name (None - don't save)
+    :return: dict of the results
+    """
+    report = {"version": get_version(), "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+              "python": sys.version.split()[0], "numpy": np.__version__, "platform": platform.platform(),
+              "cpu_count": os.cpu_count(), "results": [], "golden": []}
+
+    for geometry in geometries:
+        for n_frames in frame_counts:
+            for engine in engines:
+                for combine in combines:
+                    night_root = os.path.join(root, f"{geometry.replace(':', 'b')}_{n_frames}_{engine}_{combine}")
+                    report["results"] += benchmark_night(night_root, n_frames, geometry, engine=engine,
+                                                         combine=combine, options=options, workers=workers,
+                                                         repeat=repeat)
+
+    if catalog_frames > 0:
+        results, check = benchmark_catalog(os.path.join(root, "catalog"), catalog_frames, repeat=repeat)
+        report["results"] += results
+        report["golden"].append(check)
+
+    if golden:
+        report["golden"] += check_golden(os.path.join(root, "golden"))
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    return report
@@ -0,0 +1,116 @@
+import os
+import datetime
+from configparser import ConfigParser
+import numpy as np
+from astropy.io import fits
+
+FLI_PL16801_SHAPE = (4096, 4096)
+INSTRUMENT = "FLI-PL16801"
+RBI_READOUT = "8 MHz (RBI Flood)"
+NORMAL_READOUT = "2 MHz"
+
+
+def write_config(root, options=None, reduced_dir="reduced", cal_dir="cal", filename="config.ini"):
+    """
+    writes a config.ini for a synthetic data tree.
+
+    :param options: dict of additional or overridden settings, by "<SECTION>.<KEY>" (e.g. {"GENERAL.ENGINE": "fast"})
+    :return: path to the config file
+    """
+    config = ConfigParser()
+    config.optionxform = str  # keep the keys in upper case
+    config.read_dict({"LOG": {"PATH": os.path.join(root, "log", ""), "CONSOLE_LEVEL": "ERROR", "FILE_LEVEL": "INFO"},
+                      "GENERAL": {"PATH": os.path.join(root, "images", ""), "SAVE_UNCERTAINTY": "False",
+                                  "OVERWRITE": "True", "REDUCED_DIR": reduced_dir, "ENGINE": "ccdproc"},
+                      "CAL": {"MAX_DAY_SHIFT": "14", "PATH": os.path.join(root, cal_dir, ""), "OVERWRITE": "True",
+                              "MIN_NUM_FRAMES": "5", "MAX_NUM_FRAMES": "-1", "COMBINE": "ccdproc"},
+                      "C28": {"PATH": "C28backup/", "DIR_SUFFIX": "c28"},
+                      "C18": {"PATH": "C18backup/", "DIR_SUFFIX": "c18"}})
+    for option, val in (options or {}).items():
+        section, _, key = option.partition(".")
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, str(val))
+
+    config_file = os.path.join(root, filename)
+    os.makedirs(root, exist_ok=True)
+    with open(config_file, "w") as f:
+        config.write(f)
+    return config_file
+
+
+def _write_frame(filename, image_type, shape, rng, exptime=0., filt=None, obj=None, jd=2458633.5, readout=NORMAL_READOUT,
+                 x_subframe=0, y_subframe=0, binning=1, telescope="C28"):
+    bias_level, dark_rate, sky = 1000., 0.5*binning**2, 300.*binning**2
+    data = rng.normal(bias_level, 10., shape).astype(np.float32)
+    if image_type in ("DARK", "FLAT", "LIGHT"):
+        data += dark_rate*exptime
+    if image_type == "FLAT":
+        # vignetted flat field
+        y, x = np.ogrid[-1:1:shape[0]*1j, -1:1:shape[1]*1j]
+        data += 20000.*(1 - 0.1*(x**2 + y**2))
+    elif image_type == "LIGHT":
+        data += sky*exptime/30.
+
+    hdu = fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16))
+    header = hdu.header
+    header["IMAGETYP"] = image_type
+    header["EXPTIME"] = float(exptime)
+    header["INSTRUME"] = INSTRUMENT
+    header["TELESCOP"] = telescope
+    header["XORGSUBF"] = x_subframe
+    header["YORGSUBF"] = y_subframe
+    header["XBINNING"] = binning
+    header["YBINNING"] = binning
+    header["READOUTM"] = readout
+    header["JD"] = jd
+    header["DATE-OBS"] = (datetime.datetime(2000, 1, 1, 12) + datetime.timedelta(days=jd - 2451545.)).isoformat()
+    header["CCD-TEMP"] = -30.
+    if filt is not None:
+        header["FILTER"] = filt
+    if obj is not None:
+        header["OBJECT"] = obj
+        header["AIRMASS"] = 1.2
+    hdu.writeto(filename, overwrite=True)
+
+
+def create_night(root, date="20190529", telescope="C28", n_bias=5, n_dark=5, n_flat=5, n_light=5, filters=("V", "R"),
+                 shape=FLI_PL16801_SHAPE, binning=1, x_subframe=0, y_subframe=0, seed=0):
+    """
+    creates a synthetic night folder laid out like the Wise Observatory archive (<root>/images/C28backup/<date>c28/),
+    with raw bias, dark, flat (per filter) and science (per filter) frames.
+
+    :param shape: frame shape (NAXIS2, NAXIS1)
+    :param binning: x and y binning
+    :param x_subframe: XORGSUBF
+    :param y_subframe: YORGSUBF
+    :return: path to the night folder
+    """
+    rng = np.random.default_rng(seed)
+    im_path = os.path.join(root, "images", f"{telescope}backup", f"{date}{telescope.lower()}")
+    os.makedirs(im_path, exist_ok=True)
+
+    t = datetime.datetime.strptime(date, "%Y%m%d")
+    jd0 = 2451545. + (t - datetime.datetime(2000, 1, 1, 12)).total_seconds()/86400. + 0.75  # ~6 pm local time
+    geometry = {"x_subframe": x_subframe, "y_subframe": y_subframe, "binning": binning, "telescope": telescope}
+    i = 0
+    for j in range(n_bias):
+        _write_frame(os.path.join(im_path, f"bias_{j:04d}.fits"), "BIAS", shape, rng, jd=jd0 + i*1e-3, **geometry)
+        i += 1
+    for j in range(n_dark):
+        _write_frame(os.path.join(im_path, f"dark_{j:04d}.fits"), "DARK", shape, rng, exptime=60., jd=jd0 + i*1e-3,
+                     **geometry)
+        i += 1
+    for filt in filters:
+        for j in range(n_flat):
+            _write_frame(os.path.join(im_path, f"flat_{filt}_{j:04d}.fits"), "FLAT", shape, rng, exptime=3.,
+                         filt=filt, jd=jd0 + i*1e-3, **geometry)
+            i += 1
+    for filt in filters:
+        for j in range(n_light):
+            readout = RBI_READOUT if j % 2 == 0 else NORMAL_READOUT
+            _write_frame(os.path.join(im_path, f"sci_{filt}_{j:04d}.fits"), "LIGHT", shape, rng, exptime=30.,
+                         filt=filt, obj="SYNTH", jd=jd0 + 0.1 + i*1e-3, readout=readout, **geometry)
+            i += 1
+
+    return im_path
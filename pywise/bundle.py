@@ -0,0 +1,343 @@
+import io
+import os
+import csv
+import logging
+from astropy.io import fits
+from pywise.catalog import FITS_BLOCK, FITS_CARD
+from pywise.keywords import get_profile, get_output_name
+from pywise.locks import WorkLock, atomic_output
+from pywise.output import get_hdus, write_reduced, DEFAULT_QUANTIZE_LEVEL
+
+BUNDLE_MODES = ("filter", "object")
+BUNDLE_PREFIX = "bundle_"
+INDEX_SUFFIX = ".index.csv"
+INDEX_COLUMNS = ("name", "offset", "size")
+# name of the (first) compressed image HDU of a reduced frame file, as written by astropy
+_COMPRESSED_NAME = "COMPRESSED_IMAGE"
+
+
+def get_bundle_mode(config, log=None):
+    """
+    :return: BUNDLE of config.ini ("filter" or "object"), None if reduced frames are saved to their own files
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    bundle_by = config.get("GENERAL", "BUNDLE", fallback="").lower() or None
+    if (bundle_by is not None) and (bundle_by not in BUNDLE_MODES):
+        log.warning(f"Unknown bundle mode {bundle_by}, saving a file per reduced frame instead.")
+        return None
+    return bundle_by
+
+
+def get_output_file(reduced_path, header, filt, telescope, bundle_by=None):
+    """
+    :param header: raw image header (astropy.io.fits.Header)
+    :param bundle_by: None - a file per reduced frame, "filter" or "object" - a bundle of the reduced frames of the night
+                      per filter or per object
+    :return: reduced frame file name, or "<bundle file name>[<reduced frame name>]" for a bundled frame (as in the
+             CFITSIO extended file name syntax)
+    """
+    name = get_output_name(header, filt, telescope)
+    if bundle_by is None:
+        return reduced_path + name + ".fits"
+    group = filt if bundle_by == "filter" else header[get_profile(telescope).key("object")]
+    return f"{reduced_path}{BUNDLE_PREFIX}{group}_{telescope}.fits[{name}]"
+
+
+def split_output(output):
+    """
+    :return: bundle file name and reduced frame name of a bundled frame (see get_output_file), the file name and None
+             otherwise
+    """
+    if output.endswith("]") and ("[" in output):
+        filename, _, name = output[:-1].rpartition("[")
+        return filename, name
+    return output, None
+
+
+class BundleIndex:
+    """
+    index of the reduced frames in a bundle (a multi-extension FITS file): the byte offset and size of the HDUs of each
+    frame, so that a frame is read without going through the HDUs before it. The index is a CSV file next to the
+    bundle, with a row appended for each frame appended to the bundle (a frame appended again supersedes its previous
+    copy, until the bundle is compacted).
+    """
+
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        self.filename = os.path.splitext(bundle_file)[0] + INDEX_SUFFIX
+        self.frames = {}  # (offset, size), by reduced frame name
+        self.n_rows = 0
+        self._stat = None  # (inode, modification time, size) of the index when it was last read
+        self._pos = 0  # number of bytes of the index read
+
+    def _clear(self):
+        self.frames = {}
+        self.n_rows = 0
+        self._stat = None
+        self._pos = 0
+
+    def refresh(self, force=False):
+        """
+        reads the rows appended to the index since it was last read (or the whole index, if it was replaced).
+
+        :param force: True - read the index even if its inode, modification time and size look unchanged (as done under
+                      the bundle lock, since the coarse modification times and cached attributes of network file
+                      systems may hide the rows appended by other hosts)
+        """
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            self._clear()
+            return
+        if (not force) and (self._stat == (st.st_ino, st.st_mtime_ns, st.st_size)):
+            return
+        try:
+            with open(self.filename, "rb") as f:
+                st = os.fstat(f.fileno())
+                if (self._stat is None) or (self._stat[0] != st.st_ino) or (st.st_size < self._pos):
+                    # a new index, or replaced by compact_bundle
+                    self._clear()
+                f.seek(self._pos)
+                data = f.read()
+        except FileNotFoundError:
+            self._clear()
+            return
+        end = data.rfind(b"\n") + 1  # complete rows only
+        rows = csv.reader(data[:end].decode().splitlines())
+        if self._pos == 0:
+            next(rows, None)  # INDEX_COLUMNS
+        for name, offset, size in rows:
+            self.frames[name] = (int(offset), int(size))
+            self.n_rows += 1
+        self._pos += end
+        self._stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @property
+    def n_superseded(self):
+        return self.n_rows - len(self.frames)
+
+    def __contains__(self, name):
+        return name in self.frames
+
+    def append(self, name, offset, size):
+        """
+        appends a row to the index (under the bundle lock, after refresh(force=True)).
+        """
+        is_new = not os.path.isfile(self.filename)
+        with open(self.filename, "a", newline="") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(INDEX_COLUMNS)
+            writer.writerow((name, offset, size))
+        self.refresh(force=True)
+
+
+_indexes = {}
+
+
+def get_index(bundle_file):
+    """
+    :return: the (shared, refreshed) BundleIndex of a bundle
+    """
+    key = os.path.abspath(bundle_file)
+    if key not in _indexes:
+        _indexes[key] = BundleIndex(bundle_file)
+    _indexes[key].refresh()
+    return _indexes[key]
+
+
+def output_exists(output):
+    """
+    :param output: reduced frame file name, or bundled frame (see get_output_file)
+    """
+    filename, name = split_output(output)
+    if name is None:
+        return os.path.isfile(filename)
+    return os.path.isfile(filename) and (name in get_index(filename))
+
+
+def get_output_size(output):
+    """
+    :return: size of a reduced frame file, or of the HDUs of a bundled frame [bytes]
+    """
+    filename, name = split_output(output)
+    if name is None:
+        return os.path.getsize(filename)
+    return get_index(filename).frames[name][1]
+
+
+def write_output(ccd, output, output_format="fits", quantize_level=DEFAULT_QUANTIZE_LEVEL, log=None):
+    """
+    writes a reduced frame to its own file (see output.write_reduced), or appends it to its bundle.
+
+    The HDUs of a bundled frame are those of its own file (see output.get_hdus), as extensions named after the frame
+    (<name>, and <name>.UNCERT and <name>.MASK if saved). They are appended to the end of the bundle without reading
+    it, under a lock of the bundle (so that several processes can append to the same bundle).
+    """
+    filename, name = split_output(output)
+    if name is None:
+        write_reduced(ccd, filename, output_format=output_format, quantize_level=quantize_level)
+        return
+
+    hdus = get_hdus(ccd, output_format, quantize_level, as_extensions=True)
+    for i, hdu in enumerate(hdus):
+        hdu.name = name if i == 0 else f"{name}.{hdu.name}"
+    # the extensions, as written after an empty primary HDU (of a single FITS block)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU()] + list(hdus)).writeto(buffer)
+    data = buffer.getbuffer()[FITS_BLOCK:]
+
+    with WorkLock(filename, log=log):
+        if not os.path.isfile(filename):
+            with atomic_output(filename) as tmp_file:
+                fits.PrimaryHDU().writeto(tmp_file)
+        index = get_index(filename)
+        index.refresh(force=True)
+        with open(filename, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        index.append(name, offset, len(data))
+
+
+def _split_hdus(data):
+    """
+    :param data: bytes of consecutive HDUs
+    :return: list of the (astropy.io.fits.Header, data bytes) of each HDU
+    """
+    hdus = []
+    start = 0
+    while start < len(data):
+        end = start
+        while data[end:end + FITS_CARD].rstrip() != b"END":
+            end += FITS_CARD
+            if end >= len(data):
+                raise ValueError("No END card in the HDU header.")
+        end = start + -(-(end + FITS_CARD - start) // FITS_BLOCK) * FITS_BLOCK
+        header = fits.Header.fromstring(bytes(data[start:end]).decode("ascii"))
+        n_pixels = 0
+        if header["NAXIS"] > 0:
+            n_pixels = 1
+            for i in range(header["NAXIS"]):
+                n_pixels *= header[f"NAXIS{i + 1}"]
+        size = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + n_pixels)
+        hdus.append((header, bytes(data[end:end + -(-size // FITS_BLOCK) * FITS_BLOCK])))
+        start = end + len(hdus[-1][1])
+    return hdus
+
+
+def _to_primary(header, is_extended):
+    # the header of an image extension, as the header of the primary HDU of a reduced frame file
+    primary = fits.Header([("SIMPLE", True, "conforms to FITS standard")])
+    for card in header.cards:
+        if card.keyword in ("XTENSION", "PCOUNT", "GCOUNT", "EXTNAME"):
+            continue
+        primary.append(card)
+        if is_extended and (card.keyword == f"NAXIS{header['NAXIS']}"):
+            primary.append(("EXTEND", True))
+    return primary
+
+
+def read_bytes(output, log=None):
+    """
+    :param output: bundled frame (see get_output_file)
+    :return: the content of the reduced frame file of a bundled frame (as written without bundles), read from the
+             bundle at the offset in its index (under the bundle lock, so that the bundle and its index are not
+             replaced by compact_bundle in between)
+    """
+    filename, name = split_output(output)
+    with WorkLock(filename, log=log):
+        index = get_index(filename)
+        index.refresh(force=True)
+        with open(filename, "rb") as f:
+            return _read_frame(f, index, name)
+
+
+def _read_frame(f, index, name):
+    # the content of the reduced frame file of a bundled frame, from the open bundle
+    if name not in index:
+        raise KeyError(f"{name} is not in {os.path.basename(index.bundle_file)}.")
+    offset, size = index.frames[name]
+    f.seek(offset)
+    data = f.read(size)
+
+    parts = []
+    hdus = _split_hdus(data)
+    for i, (header, payload) in enumerate(hdus):
+        if i > 0:
+            header["EXTNAME"] = header["EXTNAME"][len(name) + 1:]
+        elif header["XTENSION"].strip() == "IMAGE":
+            header = _to_primary(header, is_extended=len(hdus) > 1)
+        else:
+            # compressed frames follow an empty primary HDU
+            header["EXTNAME"] = _COMPRESSED_NAME
+            buffer = io.BytesIO()
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU()]).writeto(buffer)
+            parts.append(buffer.getvalue()[:FITS_BLOCK])
+        parts.append(header.tostring().encode("ascii") + payload)
+    return b"".join(parts)
+
+
+def read_bundled(output):
+    """
+    :param output: bundled frame (see get_output_file)
+    :return: astropy.io.fits.HDUList of the reduced frame file of a bundled frame
+    """
+    return fits.HDUList.fromstring(read_bytes(output))
+
+
+def export_bundle(bundle_file, out_path=None, names=None, log=None):
+    """
+    writes the frames of a bundle to their own reduced frame files (as written without bundles).
+
+    :param out_path: output folder (None - the folder of the bundle)
+    :param names: reduced frame names to export (None - all the frames of the bundle)
+    :return: list of the file names written
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    if out_path is None:
+        out_path = os.path.dirname(bundle_file)
+    filenames = []
+    with WorkLock(bundle_file, log=log), open(bundle_file, "rb") as src:
+        index = get_index(bundle_file)
+        index.refresh(force=True)
+        for name in (list(index.frames) if names is None else names):
+            filename = os.path.join(out_path, name + ".fits")
+            with atomic_output(filename) as tmp_file:
+                with open(tmp_file, "wb") as f:
+                    f.write(_read_frame(src, index, name))
+            filenames.append(filename)
+    log.info(f"Exported {len(filenames)} frames of {os.path.basename(bundle_file)} to {out_path}.")
+    return filenames
+
+
+def compact_bundle(bundle_file, log=None):
+    """
+    rewrites a bundle without the superseded copies of its frames (frames that were appended again), with a new index.
+
+    The bundle and its index are replaced one after the other, under the bundle lock (which readers take as well).
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    with WorkLock(bundle_file, log=log):
+        index = get_index(bundle_file)
+        index.refresh(force=True)
+        if index.n_superseded == 0:
+            return
+        n_superseded = index.n_superseded
+        frames = sorted(index.frames.items(), key=lambda item: item[1][0])
+        with atomic_output(index.filename) as tmp_index, atomic_output(bundle_file) as tmp_file:
+            with open(bundle_file, "rb") as src, open(tmp_file, "wb") as dst, open(tmp_index, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(INDEX_COLUMNS)
+                dst.write(src.read(FITS_BLOCK))  # the empty primary HDU
+                for name, (offset, size) in frames:
+                    src.seek(offset)
+                    writer.writerow((name, dst.tell(), size))
+                    dst.write(src.read(size))
+        index.refresh()
+    log.info(f"Compacted {os.path.basename(bundle_file)} ({n_superseded} superseded frames removed).")
@@ -0,0 +1,118 @@
+import os
+import logging
+from collections import OrderedDict
+from astropy.nddata import CCDData
+from pywise.metrics import count_mapped_read
+
+DEFAULT_CACHE_SIZE = 2048  # [MB]
+
+
+def get_ccd_nbytes(ccd):
+    nbytes = ccd.data.nbytes
+    if ccd.uncertainty is not None:
+        nbytes += ccd.uncertainty.array.nbytes
+    if ccd.mask is not None:
+        nbytes += ccd.mask.nbytes
+    return nbytes
+
+
+class MasterCache:
+    """
+    size-bounded LRU cache of master calibration frames, keyed by file path and modification time.
+
+    Cached frames are shared between callers, and should be treated as read-only.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE*1024**2, log=None):
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.max_bytes = max_bytes
+        self.log = log
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+
+    @staticmethod
+    def _get_key(filename):
+        return os.path.abspath(filename), os.stat(filename).st_mtime_ns
+
+    def read(self, filename, memmap=False):
+        """
+        :param filename: master calibration frame file name
+        :param memmap: True - wrap the memory-mapped (big-endian) data instead of converting it to a native-order copy
+        :return: ccdproc.CCDData, read from disk only if not already cached
+        """
+        key = self._get_key(filename)
+        if key in self._frames:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            self.log.debug(f"Master cache hit: {filename}")
+            return self._frames[key]
+
+        self.misses += 1
+        self.log.debug(f"Master cache miss: {filename}")
+        ccd = CCDData.read(filename, memmap=True)
+        count_mapped_read(ccd.data.nbytes)
+        if not memmap:
+            # FITS data are big-endian, convert once to native byte order (as for freshly-created masters)
+            ccd.data = ccd.data.astype(ccd.data.dtype.newbyteorder("="), copy=False)
+        self._store(key, ccd)
+        return ccd
+
+    def put(self, filename, ccd):
+        """
+        caches a master calibration frame that was just written to filename.
+        """
+        self._store(self._get_key(filename), ccd)
+
+    def _store(self, key, ccd):
+        # drop stale versions of the same file
+        for old_key in [k for k in self._frames if k[0] == key[0]]:
+            self.nbytes -= get_ccd_nbytes(self._frames.pop(old_key))
+
+        nbytes = get_ccd_nbytes(ccd)
+        if nbytes > self.max_bytes:
+            return
+
+        self._frames[key] = ccd
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, old_ccd = self._frames.popitem(last=False)
+            self.nbytes -= get_ccd_nbytes(old_ccd)
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+
+    def log_stats(self, log=None):
+        if log is None:
+            log = self.log
+        log.info(f"Master cache: {self.hits} hits, {self.misses} misses, "
+                 f"{len(self._frames)} frames ({self.nbytes/1024**2:.1f} MB of {self.max_bytes/1024**2:.0f} MB).")
+
+
+_cache = None
+
+
+def get_master_cache(config=None, log=None):
+    """
+    :param config: configparser.ConfigParser, used to set the cache size (CACHE_SIZE in the CAL section, in MB)
+    :return: the (shared) MasterCache
+    """
+    global _cache
+
+    if config is not None:
+        max_bytes = config.getint("CAL", "CACHE_SIZE", fallback=DEFAULT_CACHE_SIZE)*1024**2
+    else:
+        max_bytes = DEFAULT_CACHE_SIZE*1024**2
+
+    if _cache is None:
+        _cache = MasterCache(max_bytes, log=log)
+    else:
+        if config is not None:
+            _cache.max_bytes = max_bytes
+        if log is not None:
+            _cache.log = log
+    return _cache
@@ -1,140 +1,265 @@
 import numpy as np
 from astropy import units as u
-import ccdproc
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
 import os
 import datetime
-import glob
 import logging
-from pywise import utils
-
-
-def create_master_bias(imlist, filename="mbias", save_uncertainty=False, min_num_frames=5, max_num_frames=-1, log=None, **kwargs):
+from contextlib import nullcontext
+from pywise import combine, utils
+from pywise.archive import get_index_dir, get_master_index, parse_master_filename
+from pywise.cache import get_master_cache
+from pywise.catalog import get_catalog, group_calframes, open_hdu, DEFAULT_CATALOG_THREADS
+from pywise.keywords import get_profile
+from pywise.locks import atomic_output, get_work_lock
+from pywise.metrics import stage, timed
+
+
+def read_frames(filenames, out=None):
+    """
+    reads raw frames into a float32 cube, each file once.
+
+    :param filenames: list of raw frame file names (of the same shape)
+    :param out: (n, ny, nx) float32 array to read the frames into (None - a new one)
+    :return: (n, ny, nx) float32 array, and array of the n exposure times [sec]
+    """
+    cube = out
+    exptimes = np.zeros(len(filenames))
+    for i, filename in enumerate(filenames):
+        with open_hdu(filename) as hdu:
+            if cube is None:
+                cube = np.empty((len(filenames),) + hdu.data.shape, dtype=np.float32)
+            cube[i] = hdu.data
+            exptimes[i] = hdu.header.get("EXPTIME", 0.)
+    return cube, exptimes
+
+
+def calibrate_frames(cube, exptimes, bias=None, dark=None):
+    """
+    subtracts the master bias and the exposure-scaled master dark from a cube of raw frames, in place.
+
+    :param cube: (n, ny, nx) float32 array (e.g. returned by read_frames)
+    :param exptimes: n exposure times [sec]
+    :param bias: master bias (None - don't subtract)
+    :param dark: master dark, scaled by the exposure time (None - don't subtract)
+    :return: cube
+    """
+    if bias is not None:
+        np.subtract(cube, np.asarray(bias.data, dtype=np.float32), out=cube)
+    if dark is not None:
+        dark_rate = np.asarray(dark.data, dtype=np.float32) / np.float32(dark.header["EXPTIME"])
+        # frame by frame, through a single scaled dark frame (rather than a temporary copy of the cube)
+        scaled_dark = np.empty_like(dark_rate)
+        for frame, exptime in zip(cube, exptimes):
+            np.multiply(dark_rate, np.float32(exptime), out=scaled_dark)
+            np.subtract(frame, scaled_dark, out=frame)
+    return cube
+
+
+def combine_tiled(filenames, bias=None, dark=None, scale=None, save_uncertainty=False,
+                  memory_limit=combine.DEFAULT_MEMORY_LIMIT, tmp_dir=None, shape=None):
+    """
+    median-combines raw frames through a memory-mapped cube, within a memory budget.
+
+    :param filenames: list of raw frame file names
+    :param bias: master bias to subtract (None - don't subtract)
+    :param dark: master dark to subtract, scaled by the exposure time (None - don't subtract)
+    :param scale: None, "exptime" - scale by 1/EXPTIME, "mean" - scale by 1/mean (after calibration)
+    :param memory_limit: memory budget of the combination [MB]
+    :param tmp_dir: folder of the memory-mapped cube (None - system default)
+    :param shape: frame shape (NAXIS2, NAXIS1) (None - read from the header of the first raw frame)
+    :return: ccdproc.CCDData
+    """
+    if shape is None:
+        header = fits.getheader(filenames[0])
+        shape = (header["NAXIS2"], header["NAXIS1"])
+
+    cube = combine.create_cube(len(filenames), shape, tmp_dir=tmp_dir)
+    scaling = []
+    for i, filename in enumerate(filenames):
+        with open_hdu(filename) as hdu:
+            cube[i] = hdu.data
+            exptime = hdu.header["EXPTIME"]
+        calibrate_frames(cube[i:i+1], [exptime], bias=bias, dark=dark)
+        if scale == "exptime":
+            scaling.append(1/exptime)
+        elif scale == "mean":
+            scaling.append(1/np.mean(cube[i]))
+
+    median, sigma = combine.median_combine(cube, scaling=scaling if scale else None,
+                                           memory_limit=memory_limit*1024**2, uncertainty=save_uncertainty)
+    master = CCDData(data=median, unit=u.adu,
+                     uncertainty=StdDevUncertainty(sigma) if save_uncertainty else None)
+    master.header["NCOMBINE"] = len(filenames)
+
+    return master
+
+
+def build_master(filenames, image_type, filename, bias=None, dark=None, filt=None, save_uncertainty=False,
+                 min_num_frames=5, max_num_frames=-1, combine_method="ccdproc",
+                 memory_limit=combine.DEFAULT_MEMORY_LIMIT, tmp_dir=None, shape=None, log=None):
+    """
+    creates a master calibration frame from a group of raw frames of the same type, ccd geometry (and filter), reading
+    each raw frame once, and saves it to <filename>.fits.
+
+    :param filenames: list of raw frame file names (e.g. a group returned by group_calframes)
+    :param image_type: "BIAS", "DARK" (scaled by 1/EXPTIME) or "FLAT" (scaled by 1/mean)
+    :param bias: master bias subtracted from dark and flat frames (None or empty - don't subtract)
+    :param dark: master dark subtracted from flat frames (None or empty - don't subtract)
+    :param filt: filter of the flat frames (for the log only)
+    :param shape: frame shape (NAXIS2, NAXIS1), if known
+    :return: ccdproc.CCDData (empty if there are not enough raw frames)
+    """
     if log is None:
         log = logging.getLogger(__name__)
 
-    # collect all individual images
-    kwargs["imagetyp"] = "BIAS"
-    bias_list = []
-    for bias in imlist.hdus(**kwargs):
-        bias_list.append(ccdproc.CCDData(data=bias.data, unit=u.adu))
+    name = image_type.lower()
+    label = f"{name.capitalize()} {filt}" if filt else name.capitalize()
+    bias = bias if (bias is not None) and (bias.size > 0) and (image_type != "BIAS") else None
+    dark = dark if (dark is not None) and (dark.size > 0) and (image_type == "FLAT") else None
+    scale = {"DARK": "exptime", "FLAT": "mean"}.get(image_type)
 
-    log.debug(f"Bias list contains {len(bias_list)} files.")
+    filenames = list(filenames)
+    log.debug(f"{label} list contains {len(filenames)} files.")
     if max_num_frames > 0:
-        bias_list[max_num_frames:] = []
-
-    if len(bias_list) >= min_num_frames:
-        biases = ccdproc.Combiner(bias_list, dtype=np.float32)
-        master_bias = biases.median_combine()
-        if not save_uncertainty:
-            master_bias.uncertainty = None
-            master_bias.mask = None
-        master_bias.write(filename + ".fits", overwrite=True)
-        log.info(f"Master bias created and saved in {filename}.fits")
-    else:
-        master_bias = ccdproc.CCDData(data=[], unit=u.adu)
-        log.warning(f"Not enough raw bias frames found for {filename}!  (found {len(bias_list)} frames)")
+        filenames[max_num_frames:] = []
 
-    return master_bias
+    if len(filenames) < min_num_frames:
+        log.warning(f"Not enough raw {name} frames found for {filename}!  (found {len(filenames)} frames)")
+        return CCDData(data=[], unit=u.adu)
 
+    if combine_method == "tiled":
+        master = combine_tiled(filenames, bias=bias, dark=dark, scale=scale, save_uncertainty=save_uncertainty,
+                               memory_limit=memory_limit, tmp_dir=tmp_dir, shape=shape)
+    else:
+        import ccdproc  # only the ccdproc combination needs it (importing it takes a while)
+        if shape is None:
+            header = fits.getheader(filenames[0])
+            shape = (header["NAXIS2"], header["NAXIS1"])
+        # the Combiner keeps the frames it is given, and copies them into a cube of its own, so it is given empty
+        # placeholders, and the raw frames are read straight into its cube
+        frames = ccdproc.Combiner([CCDData(data=np.broadcast_to(np.float32(0), shape), unit=u.adu)
+                                   for _ in filenames], dtype=np.float32)
+        cube, exptimes = read_frames(filenames, out=frames.data_arr.data)
+        calibrate_frames(cube, exptimes, bias=bias, dark=dark)
+        if scale == "exptime":
+            frames.scaling = 1/exptimes
+        elif scale == "mean":
+            frames.scaling = 1/frames.data_arr.data.mean(axis=(1, 2), dtype=np.float64)
+        master = frames.median_combine()
+    if not save_uncertainty:
+        master.uncertainty = None
+        master.mask = None
+
+    if image_type != "BIAS":
+        master.header["EXPTIME"] = 1  # [sec]
+    with atomic_output(filename + ".fits") as tmp_file:
+        master.write(tmp_file, overwrite=True)
+    log.info(f"Master {name} created and saved in {filename}.fits")
+
+    return master
+
+
+def create_master_bias(imlist, filename="mbias", save_uncertainty=False, min_num_frames=5, max_num_frames=-1,
+                       combine_method="ccdproc", memory_limit=combine.DEFAULT_MEMORY_LIMIT, tmp_dir=None, log=None,
+                       **kwargs):
+    kwargs["imagetyp"] = "BIAS"
+    return build_master(imlist.files_filtered(include_path=True, **kwargs), "BIAS", filename,
+                        save_uncertainty=save_uncertainty, min_num_frames=min_num_frames,
+                        max_num_frames=max_num_frames, combine_method=combine_method, memory_limit=memory_limit,
+                        tmp_dir=tmp_dir, log=log)
 
-def create_master_dark(imlist, bias=[], filename="mdark", save_uncertainty=False, min_num_frames=5, max_num_frames=-1,
-                       log=None, **kwargs):
-    if log is None:
-        log = logging.getLogger(__name__)
 
-    # collect all individual images
+def create_master_dark(imlist, bias=None, filename="mdark", save_uncertainty=False, min_num_frames=5, max_num_frames=-1,
+                       combine_method="ccdproc", memory_limit=combine.DEFAULT_MEMORY_LIMIT, tmp_dir=None, log=None,
+                       **kwargs):
     kwargs["imagetyp"] = "DARK"
-    dark_list = []
-    for dark in imlist.hdus(**kwargs):
-        if bias:
-            dark = ccdproc.subtract_bias(ccdproc.CCDData(data=dark.data, unit=u.adu, header=dark.header), bias)
-        dark_list.append(ccdproc.CCDData(data=dark.data, unit=u.adu, header=dark.header))
-
-    log.debug(f"Dark list contains {len(dark_list)} files.")
-    if max_num_frames > 0:
-        dark_list[max_num_frames:] = []
-
-    if len(dark_list) >= min_num_frames:
-        darks = ccdproc.Combiner(dark_list, dtype=np.float32)
-        # apply exposure-time scaling before combining:
-        darks.scaling = [1/dark.header["EXPTIME"] for dark in dark_list]
-        master_dark = darks.median_combine()
-        if not save_uncertainty:
-            master_dark.uncertainty = None
-            master_dark.mask = None
-
-        master_dark.header["EXPTIME"] = 1  # [sec]
-        master_dark.write(filename + ".fits", overwrite=True)
-        log.info(f"Master dark created and saved in {filename}.fits")
-    else:
-        master_dark = ccdproc.CCDData(data=[], unit=u.adu)
-        log.warning(f"Not enough raw dark frames found for {filename}!  (found {len(dark_list)} frames)")
+    return build_master(imlist.files_filtered(include_path=True, **kwargs), "DARK", filename, bias=bias,
+                        save_uncertainty=save_uncertainty, min_num_frames=min_num_frames,
+                        max_num_frames=max_num_frames, combine_method=combine_method, memory_limit=memory_limit,
+                        tmp_dir=tmp_dir, log=log)
 
-    return master_dark
 
-
-def create_master_flat(imlist, bias=[], dark=[], filt="", filename="mflat", save_uncertainty=False, is_overwrite=True,
-                       min_num_frames=5, max_num_frames=-1, log=None, **kwargs):
+def create_master_flat(imlist, bias=None, dark=None, filt="", filename="mflat", save_uncertainty=False,
+                       is_overwrite=True, min_num_frames=5, max_num_frames=-1, combine_method="ccdproc",
+                       memory_limit=combine.DEFAULT_MEMORY_LIMIT, tmp_dir=None, index=None, cache=None, log=None,
+                       **kwargs):
     if log is None:
         log = logging.getLogger(__name__)
 
     if len(filt) == 0:
         if "filter" in imlist.keywords:
-            filt_idx = ~imlist.summary["filter"].mask  # images with unmasked filter
-            filters = np.unique(imlist.summary[filt_idx]["filter"])
+            # images with a filter keyword
+            filters = np.unique([val for val in imlist.values("filter") if val is not None])
         else:
             log.warning(f"Not enough raw flat frames found for {filename}! (found {len(filt)} frames)")
             return
     else:
         filters = filt
 
+    kwargs["imagetyp"] = "FLAT"
     for filt in filters:
-        file_exists = os.path.isfile(filename + "_" + filt + ".fits")
-        if file_exists & (not is_overwrite):
-            log.debug(f"{filt} master flat exists, skipping.")
-            continue
-
-        # collect all individual images
-        kwargs["imagetyp"] = "FLAT"
         kwargs["filter"] = filt
-        flat_list = []
-        for flat in imlist.hdus(**kwargs):
-            if bias:
-                flat = ccdproc.subtract_bias(ccdproc.CCDData(data=flat.data, unit=u.adu, header=flat.header), bias)
-            if dark:
-                flat = ccdproc.subtract_dark(flat, dark, exposure_time="EXPTIME", exposure_unit=u.s, scale=True)
-            flat_list.append(ccdproc.CCDData(data=flat.data, unit=u.adu, header=flat.header))
-
-        if max_num_frames > 0:
-            flat_list[max_num_frames:] = []
-
-        log.debug(f"Flat {filt} list contains {len(flat_list)} files.")
-        if len(flat_list) >= min_num_frames:
-            flats = ccdproc.Combiner(flat_list, dtype=np.float32)
-            # apply exposure-time scaling before combining:
-            flats.scaling = [1 / np.mean(flat) for flat in flat_list]
-            master_flat = flats.median_combine()
-            if not save_uncertainty:
-                master_flat.uncertainty = None
-                master_flat.mask = None
-
-            master_flat.header["EXPTIME"] = 1  # [sec]
-            master_flat.write(filename + "_" + filt + ".fits", overwrite=True)
-            log.info(f"Master flat created and saved in {filename}.fits")
-        else:
-            log.warning(f"No raw flat frames found for {filename}!")
+        _create_master_flat(imlist.files_filtered(include_path=True, **kwargs), filt, filename, bias, dark,
+                            is_overwrite=is_overwrite, index=index, cache=cache, log=log,
+                            save_uncertainty=save_uncertainty, min_num_frames=min_num_frames,
+                            max_num_frames=max_num_frames, combine_method=combine_method, memory_limit=memory_limit,
+                            tmp_dir=tmp_dir)
 
     return
 
 
-def create_masters(year=datetime.date.today().year, month=datetime.date.today().month, day=datetime.date.today().day,
-                   telescope="C28", log=None, config_file="config.ini"):
-    assert(telescope in ["C28", "C18"]), f"Not implemented for {telescope} yet!"
+def master_exists(filename, filenames):
+    """
+    :param filenames: raw frames the master would be created from
+    :return: True if the master calibration frame exists, unless it was derived from another ccd geometry (see
+             derive_master) and there are raw frames to create it from
+    """
+    return os.path.isfile(filename) and ((len(filenames) == 0) or (not is_derived(filename)))
+
 
+def _create_master_flat(filenames, filt, filename, bias, dark, is_overwrite=True, index=None, cache=None, log=None,
+                        **kwargs):
     if log is None:
         log = logging.getLogger(__name__)
 
-    config = utils.get_config(config_file)
+    file_exists = master_exists(filename + "_" + filt + ".fits", filenames)
+    if file_exists & (not is_overwrite):
+        log.debug(f"{filt} master flat exists, skipping.")
+        return
+
+    master_flat = build_master(filenames, "FLAT", filename + "_" + filt, bias=bias, dark=dark, filt=filt, log=log,
+                               **kwargs)
+    if master_flat.size > 0:
+        if index is not None:
+            index.add(filename + "_" + filt + ".fits")
+        if cache is not None:
+            cache.put(filename + "_" + filt + ".fits", master_flat)
+
+
+@timed("create_masters")
+def create_masters(year=datetime.date.today().year, month=datetime.date.today().month, day=datetime.date.today().day,
+                   telescope="C28", log=None, config_file="config.ini", frame_types=("bias", "dark", "flat"),
+                   filenames=None, only=None, session=None):
+    """
+    creates the master calibration frames of a single night.
+
+    The raw calibration frames are grouped by type, ccd geometry and filter in a single pass over the night catalog,
+    and each raw frame is read once.
+
+    :param frame_types: master frame types to create, the rest are only read from the archive when needed
+                        (e.g. ("dark",) creates only the master darks, using the already-existing master biases)
+    :param filenames: raw frame file names (without path) to use (None - all the raw frames of the night)
+    :param only: keys of the groups of raw frames (image type, geometry, filter), as in catalog.group_calframes, whose
+                 masters are created, replacing existing ones (e.g. created from fewer raw frames) (None - the masters
+                 of frame_types)
+    :param session: ReductionSession providing the config, logger, catalog and master cache (None - read config_file)
+    """
+    if log is None:
+        log = session.log if session is not None else logging.getLogger(__name__)
+
+    config = session.config if session is not None else utils.get_config(config_file)
+    profile = get_profile(telescope)
 
     t = datetime.date(year, month, day)
     t_str = datetime.date.strftime(t, format="%Y%m%d")
@@ -146,154 +271,257 @@ def create_masters(year=datetime.date.today().year, month=datetime.date.today().
         return
 
     max_day_shift = config.getint("CAL", "MAX_DAY_SHIFT")
-    a = range(-1, -max_day_shift-1, -1)
-    b = range(1, max_day_shift+1, 1)
-    day_shift = [None]*(len(a)+len(b))
-    day_shift[0::2] = a
-    day_shift[1::2] = b
-
-    min_num_frames = config.getint("CAL", "MIN_NUM_FRAMES")
-    max_num_frames = config.getint("CAL", "MAX_NUM_FRAMES")
-    save_uncertainty = config.getboolean("GENERAL", "SAVE_UNCERTAINTY")
+
     is_overwrite = config.getboolean("CAL", "OVERWRITE")
+    build_kwargs = {"save_uncertainty": config.getboolean("GENERAL", "SAVE_UNCERTAINTY"),
+                    "min_num_frames": config.getint("CAL", "MIN_NUM_FRAMES"),
+                    "max_num_frames": config.getint("CAL", "MAX_NUM_FRAMES"),
+                    "combine_method": config.get("CAL", "COMBINE", fallback="ccdproc"),
+                    "memory_limit": config.getint("CAL", "MEMORY_LIMIT", fallback=combine.DEFAULT_MEMORY_LIMIT),
+                    "tmp_dir": config.get("CAL", "TMP_DIR", fallback="") or None}
 
     cal_archive_path = config.get("CAL", "PATH") + telescope + os.sep
     # create calibration frame folder
     if not os.path.exists(cal_archive_path):
         os.makedirs(cal_archive_path)
-
-    imlist = ccdproc.ImageFileCollection(im_path, keywords='*')
+    index = get_master_index(cal_archive_path, telescope, index_dir=get_index_dir(config), log=log)
+    # the nearest masters of the range being reduced are resolved at once
+    finder = session.resolvers.get(telescope, index) if session is not None else index
+    cache = session.cache if session is not None else get_master_cache(config, log=log)
+
+    with stage("catalog"):
+        if session is not None:
+            imlist = session.get_catalog(im_path)
+        else:
+            imlist = get_catalog(im_path, threads=config.getint("GENERAL", "CATALOG_THREADS",
+                                                                fallback=DEFAULT_CATALOG_THREADS), log=log)
 
     if len(imlist.files) == 0:
         log.warning(f"No images taken on {t_str}.")
         return
 
-    instrument = imlist.values("instrume", True)[0]  # assuming a single instrument per night
-    ccd_shape = utils.get_ccd_shape(imlist, telescope)
-
-    for i in range(len(ccd_shape["x_naxis"])):
-
-        ccd_str = utils.get_ccd_str(ccd_shape, idx=i)
-        base_filename = f"_{telescope}_{instrument}_{t_str}_{ccd_str}"
-        keys = utils.get_set_from_dict(utils.get_ccd_shape(imlist, telescope, original_keys=True), idx=i)
-
-        # create master bias
-        bias_file = f"{cal_archive_path}Bias{base_filename}"
-        file_exists = os.path.isfile(bias_file + ".fits")
-        if (not file_exists) | (file_exists & is_overwrite):
-            bias = create_master_bias(imlist, filename=bias_file, save_uncertainty=save_uncertainty,
-                                      min_num_frames=min_num_frames, max_num_frames=max_num_frames, log=log, **keys)
-        else:
-            log.debug(f"Master bias exists, skipping.")
-            bias = ccdproc.CCDData.read(bias_file + ".fits")
-
-        # if no bias frames were found
-        if bias.size == 0:
-            # look for an archival master bias
-            i = 0
-            while (bias.size == 0) and (i < len(day_shift)):
-                curr_day = datetime.datetime.strftime(t + datetime.timedelta(days=day_shift[i]), "%Y%m%d")
-                filename = glob.glob(f"{cal_archive_path}Bias_{telescope}_{instrument}_{curr_day}_{ccd_str}.fits")
-                if filename:
-                    bias_file = filename[0]
-                    bias = ccdproc.CCDData.read(bias_file)
-                else:
-                    i += 1
-
-        dark_file = f"{cal_archive_path}Dark{base_filename}"
-        file_exists = os.path.isfile(dark_file + ".fits")
-        if (not file_exists) | (file_exists & is_overwrite):
-            dark = create_master_dark(imlist, bias, filename=dark_file, save_uncertainty=save_uncertainty,
-                                      min_num_frames=min_num_frames, max_num_frames=max_num_frames, log=log, **keys)
-        else:
-            log.debug(f"Master dark exists, skipping.")
-            dark = ccdproc.CCDData.read(dark_file + ".fits")
-
-        if dark.size == 0:
-            # look for an archival master dark
-            i = 0
-            while (dark.size == 0) and (i < len(day_shift)):
-                curr_day = datetime.datetime.strftime(t + datetime.timedelta(days=day_shift[i]), "%Y%m%d")
-                filename = glob.glob(f"{cal_archive_path}Dark_{telescope}_{instrument}_{curr_day}_{ccd_str}.fits")
-                if filename:
-                    dark_file = filename[0]
-                    dark = ccdproc.CCDData.read(dark_file)
-                else:
-                    i += 1
-
-        flat_file = f"{cal_archive_path}Flat{base_filename}"
-        create_master_flat(imlist, bias, dark, filename=flat_file, save_uncertainty=save_uncertainty,
-                           is_overwrite=is_overwrite, min_num_frames=min_num_frames, max_num_frames=max_num_frames,
-                           log=log, **keys)
-
-
-def get_calframes(year, month, day, filt, ccd_str, telescope="C28", instrument="FLI-PL16801", log=None, config_file="config.ini"):
+    instrument = imlist.values(profile.key("instrument"), True)[0]  # assuming a single instrument per night
+    groups, geometries = group_calframes(imlist, telescope, filenames=filenames)
+    ccd_keys = utils.get_ccd_keys(telescope)
+    if only is not None:
+        frame_types = {key[0].lower() for key in only}
+        geometries = [geometry for geometry in geometries if geometry in {key[1] for key in only}]
+
+    def is_created(image_type, geometry, file_exists):
+        # whether the master bias or dark of a geometry is created (again)
+        if only is not None:
+            return (image_type, geometry, None) in only
+        return (image_type.lower() in frame_types) and ((not file_exists) or is_overwrite)
+
+    # other hosts reducing the same archive wait until the masters of the night are created (and then use them)
+    lock = get_work_lock(config, f"{cal_archive_path}.{t_str}_{instrument}", log=log)
+    with lock or nullcontext():
+        for geometry in geometries:
+
+            ccd_str = utils.get_ccd_str({key: [val] for key, val in zip(ccd_keys, geometry)})
+            base_filename = f"_{telescope}_{instrument}_{t_str}_{ccd_str}"
+            shape = (geometry[1], geometry[0])  # (NAXIS2, NAXIS1)
+
+            # create master bias
+            bias_file = f"{cal_archive_path}Bias{base_filename}"
+            file_exists = master_exists(bias_file + ".fits", groups.get(("BIAS", geometry, None), []))
+            if is_created("BIAS", geometry, file_exists):
+                with stage("bias"):
+                    bias = build_master(groups.get(("BIAS", geometry, None), []), "BIAS", bias_file, shape=shape,
+                                        log=log, **build_kwargs)
+                if bias.size > 0:
+                    index.add(bias_file + ".fits")
+                    cache.put(bias_file + ".fits", bias)
+            elif ("dark" not in frame_types) & ("flat" not in frame_types):
+                # the master bias is not needed
+                continue
+            elif file_exists:
+                log.debug(f"Master bias exists, skipping.")
+                with stage("read_masters"):
+                    bias = cache.read(bias_file + ".fits")
+            else:
+                bias = CCDData(data=[], unit=u.adu)
+
+            # if no bias frames were found
+            if bias.size == 0:
+                # look for an archival master bias
+                with stage("archive"):
+                    filename = finder.find_nearest("Bias", instrument, t, ccd_str, max_day_shift=max_day_shift,
+                                                   include_same_day=False)
+                    if filename:
+                        bias_file = filename
+                        bias = cache.read(bias_file)
+
+            dark_file = f"{cal_archive_path}Dark{base_filename}"
+            file_exists = master_exists(dark_file + ".fits", groups.get(("DARK", geometry, None), []))
+            if is_created("DARK", geometry, file_exists):
+                with stage("dark"):
+                    dark = build_master(groups.get(("DARK", geometry, None), []), "DARK", dark_file, bias=bias,
+                                        shape=shape, log=log, **build_kwargs)
+                if dark.size > 0:
+                    index.add(dark_file + ".fits")
+                    cache.put(dark_file + ".fits", dark)
+            elif "flat" not in frame_types:
+                # the master dark is not needed
+                continue
+            elif file_exists:
+                log.debug(f"Master dark exists, skipping.")
+                with stage("read_masters"):
+                    dark = cache.read(dark_file + ".fits")
+            else:
+                dark = CCDData(data=[], unit=u.adu)
+
+            if dark.size == 0:
+                # look for an archival master dark
+                with stage("archive"):
+                    filename = finder.find_nearest("Dark", instrument, t, ccd_str, max_day_shift=max_day_shift,
+                                                   include_same_day=False)
+                    if filename:
+                        dark_file = filename
+                        dark = cache.read(dark_file)
+
+            if "flat" in frame_types:
+                flat_file = f"{cal_archive_path}Flat{base_filename}"
+                flat_filters = sorted(key[2] for key in groups if (key[0] == "FLAT") and (key[1] == geometry) and
+                                      ((only is None) or (key in only)))
+                if len(flat_filters) == 0:
+                    log.warning(f"No raw flat frames found for {flat_file}!")
+                for filt in flat_filters:
+                    with stage("flat"):
+                        _create_master_flat(groups[("FLAT", geometry, filt)], filt, flat_file, bias, dark,
+                                            is_overwrite=is_overwrite or (only is not None), index=index, cache=cache,
+                                            shape=shape, log=log,
+                                            **build_kwargs)
+
+
+def bin_frame(data, y_bin, x_bin, method="sum"):
+    """
+    bins a frame with a vectorized reshape.
+
+    :param method: "sum" or "mean" of the binned pixels
+    :return: binned data (float32)
+    """
+    ny, nx = data.shape[0] // y_bin, data.shape[1] // x_bin
+    pixels = data[:ny*y_bin, :nx*x_bin].reshape(ny, y_bin, nx, x_bin)
+    if method == "mean":
+        return pixels.mean(axis=(1, 3), dtype=np.float64).astype(np.float32)
+    return pixels.sum(axis=(1, 3), dtype=np.float64).astype(np.float32)
+
+
+def is_derived(filename):
+    """
+    :return: True if the master calibration frame was derived from a master of another ccd geometry (see derive_master)
+    """
+    return "DERIVED" in fits.getheader(filename)
+
+
+def derive_master(frame_type, instrument, t, ccd_str, telescope="C28", filt="", index=None, finder=None, cache=None,
+                  max_day_shift=14, max_days=None, log=None):
+    """
+    derives a master calibration frame of a subframe and/or binned ccd geometry from the nearest unbinned master that
+    contains it: the master is cut to the subframe window, and binned (biases and flats by the mean of the binned
+    pixels, darks, which are in counts per pixel per second, by their sum). The derived master is saved to the archive
+    (under the date of the master it was derived from), with a DERIVED keyword naming that master.
+
+    :param index: MasterIndex of the calibration archive
+    :param finder: MasterIndex or MasterResolver used to find the nearest masters (None - index)
+    :param max_days: derive only from a master less than max_days away (None - max_day_shift)
+    :return: file name of the derived master, "" if there is no master to derive it from
+    """
     if log is None:
         log = logging.getLogger(__name__)
+    if finder is None:
+        finder = index
+    if cache is None:
+        cache = get_master_cache(log=log)
+
+    target = utils.parse_ccd_str(ccd_str)
+    candidates = []
+    for source_str in index.get_ccd_strs(frame_type, instrument, filt):
+        source = utils.parse_ccd_str(source_str)
+        if (source_str == ccd_str) or (source is None) or (utils.get_window(source, target) is None):
+            continue
+        source_file = finder.find_nearest(frame_type, instrument, t, source_str, filt=filt, max_day_shift=max_day_shift)
+        if not source_file:
+            continue
+        date = datetime.datetime.strptime(parse_master_filename(source_file, telescope)["date"], "%Y%m%d").date()
+        if (max_days is None) or (abs((date - t).days) < max_days):
+            candidates.append((abs((date - t).days), date, source_file, source))
+    if len(candidates) == 0:
+        return ""
+
+    _, date, source_file, source = min(candidates, key=lambda candidate: candidate[:2])
+    master = cache.read(source_file)
+    data = master.data[utils.get_window(source, target)]
+    if (target["y_bin"] > 1) or (target["x_bin"] > 1):
+        data = bin_frame(data, target["y_bin"], target["x_bin"], method="sum" if frame_type == "Dark" else "mean")
+    else:
+        data = data.astype(np.float32)
+
+    profile = get_profile(telescope)
+    header = master.header.copy()
+    for key in ["x_subframe", "y_subframe", "x_bin", "y_bin"]:
+        header[profile.key(key)] = target[key]
+    header["DERIVED"] = os.path.basename(source_file)
+    derived = CCDData(data=data, unit=master.unit, header=header)
+
+    filename = index.get_filename(frame_type, instrument, date, ccd_str, filt)
+    with atomic_output(filename) as tmp_file:
+        derived.write(tmp_file, overwrite=True)
+    index.add(filename)
+    cache.put(filename, derived)
+    log.info(f"Master {frame_type.lower()} {os.path.basename(filename)} derived from {os.path.basename(source_file)}.")
+
+    return filename
+
+
+@timed("get_calframes")
+def get_calframes(year, month, day, filt, ccd_str, telescope="C28", instrument="FLI-PL16801", log=None, config_file="config.ini",
+                  session=None):
+    """
+    finds the nearest master bias, dark and flat of a ccd geometry and filter. When there is no master of the ccd
+    geometry itself on the night, a nearer master is derived from an unbinned master containing it (see derive_master).
+
+    :return: master bias, dark and flat file names ("" where none was found within MAX_DAY_SHIFT days)
+    """
+    if log is None:
+        log = session.log if session is not None else logging.getLogger(__name__)
 
-    config = utils.get_config(config_file)
+    config = session.config if session is not None else utils.get_config(config_file)
 
     t = datetime.date(year, month, day)
-    t_str = datetime.date.strftime(t, format="%Y%m%d")
 
     max_day_shift = config.getint("CAL", "MAX_DAY_SHIFT")
-    a = range(-1, -max_day_shift-1, -1)
-    b = range(1, max_day_shift+1, 1)
-    day_shift = [None]*(len(a)+len(b))
-    day_shift[0::2] = a
-    day_shift[1::2] = b
 
     cal_archive_path = config.get("CAL", "PATH") + telescope + os.sep
+    if not os.path.isdir(cal_archive_path):
+        log.error(f"Calibration archive {cal_archive_path} doesn't exist!")
+        return "", "", ""
+    index = get_master_index(cal_archive_path, telescope, index_dir=get_index_dir(config), log=log)
+    finder = session.resolvers.get(telescope, index) if session is not None else index
+    cache = session.cache if session is not None else get_master_cache(config, log=log)
+
+    # find the nearest master bias, dark and flat
+    master_files = []
+    for frame_type, frame_filt in [("Bias", ""), ("Dark", ""), ("Flat", filt)]:
+        filename = finder.find_nearest(frame_type, instrument, t, ccd_str, filt=frame_filt, max_day_shift=max_day_shift)
+        days = abs((datetime.datetime.strptime(parse_master_filename(filename, telescope)["date"], "%Y%m%d").date()
+                    - t).days) if filename else None
+        if days != 0:
+            with stage("derive"):
+                filename = derive_master(frame_type, instrument, t, ccd_str, telescope=telescope, filt=frame_filt,
+                                         index=index, finder=finder, cache=cache, max_day_shift=max_day_shift,
+                                         max_days=days, log=log) or filename
+        master_files.append(filename)
+    bias_file, dark_file, flat_file = master_files
 
-    base_filename = f"_{telescope}_{instrument}_{t_str}_{ccd_str}"
-
-    # find master bias
-    bias_file = f"{cal_archive_path}Bias{base_filename}.fits"
-    file_exists = os.path.isfile(bias_file)
-    if not file_exists:
-        bias_file = ""
-        # look for an archival master bias
-        i = 0
-        while (not bias_file) and (i < len(day_shift)):
-            curr_day = datetime.date.strftime(t + datetime.timedelta(days=day_shift[i]), "%Y%m%d")
-            filename = glob.glob(f"{cal_archive_path}Bias_{telescope}_{instrument}_{curr_day}_{ccd_str}.fits")
-            if filename:
-                bias_file = filename[0]
-            else:
-                i += 1
     if not bias_file:
-        log.error(f"No master bias was found within {day_shift} days!")
-
-    dark_file = f"{cal_archive_path}Dark{base_filename}.fits"
-    file_exists = os.path.isfile(dark_file)
-    if not file_exists:
-        dark_file = ""
-        # look for an archival master dark
-        i = 0
-        while (not dark_file) and (i < len(day_shift)):
-            curr_day = datetime.date.strftime(t + datetime.timedelta(days=day_shift[i]), "%Y%m%d")
-            filename = glob.glob(f"{cal_archive_path}Dark_{telescope}_{instrument}_{curr_day}_{ccd_str}.fits")
-            if filename:
-                dark_file = filename[0]
-            else:
-                i += 1
+        log.error(f"No master bias was found within {max_day_shift} days!")
+
     if not dark_file:
-        log.error(f"No master dark was found within {day_shift} days!")
-
-    flat_file = f"{cal_archive_path}Flat{base_filename}_{filt}.fits"
-    file_exists = os.path.isfile(flat_file)
-    if not file_exists:
-        flat_file = ""
-        # look for an archival master flat
-        i = 0
-        while (not flat_file) and (i < len(day_shift)):
-            curr_day = datetime.date.strftime(t + datetime.timedelta(days=day_shift[i]), "%Y%m%d")
-            filename = glob.glob(f"{cal_archive_path}Flat_{telescope}_{instrument}_{curr_day}_{ccd_str}_{filt}.fits")
-            if filename:
-                flat_file = filename[0]
-            else:
-                i += 1
+        log.error(f"No master dark was found within {max_day_shift} days!")
+
     if not flat_file:
-        log.error(f"No {filt} master flat was found within {day_shift} days!")
+        log.error(f"No {filt} master flat was found within {max_day_shift} days!")
 
     return bias_file, dark_file, flat_file
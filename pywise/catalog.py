@@ -0,0 +1,328 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from astropy.io import fits
+from pywise import utils
+from pywise.keywords import get_profile, get_header_keys
+from pywise.locks import get_tmp_name
+from pywise.metrics import count_mapped_read
+
+CATALOG_FILENAME = ".pywise_catalog.json"
+FITS_EXTENSIONS = (".fit", ".fits", ".fts", ".fit.gz", ".fits.gz", ".fts.gz", ".fits.fz")
+FITS_BLOCK = 2880  # [bytes]
+FITS_CARD = 80  # [bytes]
+DEFAULT_CATALOG_THREADS = 8
+_COMMENTARY_KEYS = ("", "COMMENT", "HISTORY")
+# value field of a header card (after "= "), as parsed by astropy: a string (with '' for a quote), a logical, an
+# integer, a float (with an E or D exponent), or undefined, optionally followed by a comment
+_VALUE_RE = re.compile(r" *(?:'(?P<str>(?:[^']|'')*)'|(?P<bool>[TF])|(?P<int>[+-]?\d+)"
+                       r"|(?P<float>[+-]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][+-]?\d+)?)|) *(?:/.*)?$")
+
+
+def read_header(filename, keys=None):
+    """
+    :param keys: set of the (upper-case) header keywords to keep (None - all)
+    :return: dict of the primary header keywords (in lower case) and their values
+    """
+    header = fits.getheader(filename)
+    return {key.lower(): (val if isinstance(val, (str, int, float, bool)) else None)
+            for key, val in header.items() if (key not in _COMMENTARY_KEYS) and ((keys is None) or (key in keys))}
+
+
+def _parse_value(field):
+    match = _VALUE_RE.match(field)
+    if match is None:
+        # e.g. a complex value
+        raise ValueError(f"Unsupported header value {field.strip()}")
+    if match.group("str") is not None:
+        val = match.group("str").replace("''", "'").rstrip()
+        if val.endswith("&"):
+            # a long string, continued in CONTINUE cards
+            raise ValueError(f"Unsupported long string {val}")
+        return val
+    if match.group("bool") is not None:
+        return match.group("bool") == "T"
+    if match.group("int") is not None:
+        return int(match.group("int"))
+    if match.group("float") is not None:
+        return float(match.group("float").translate(str.maketrans("Dd", "EE")))
+    return None
+
+
+def scan_header(filename, keys):
+    """
+    reads only the primary header blocks of a FITS file (2880 bytes each, up to the END card), and parses only the
+    cards of the requested keywords, instead of every card of the header (as astropy does). Headers that can't be
+    scanned this way (e.g. with long string or complex values of the requested keywords) are read with astropy.
+
+    :param keys: set of the (upper-case) header keywords to keep
+    :return: dict of the requested keywords (in lower case) and their values, as returned by read_header
+    """
+    names = {key.encode(): key.lower() for key in keys}
+    header = {}
+    opener = gzip.open if filename.lower().endswith(".gz") else open
+    try:
+        with opener(filename, "rb") as f:
+            block = f.read(FITS_BLOCK)
+            if not block.startswith(b"SIMPLE  ="):
+                raise OSError(f"{os.path.basename(filename)} is not a FITS file")
+            while len(block) == FITS_BLOCK:
+                for i in range(0, FITS_BLOCK, FITS_CARD):
+                    keyword = block[i:i + 8].rstrip()
+                    if keyword == b"END":
+                        return header
+                    if (keyword in names) and (block[i + 8:i + 10] == b"= "):
+                        header[names[keyword]] = _parse_value(block[i + 10:i + FITS_CARD].decode("ascii"))
+                block = f.read(FITS_BLOCK)
+    except ValueError:
+        return read_header(filename, keys)
+    raise OSError(f"No END card in the header of {os.path.basename(filename)}")
+
+
+@contextmanager
+def open_hdu(filename, memmap=False):
+    """
+    opens the primary HDU of a raw frame, the same way ccdproc.ImageFileCollection.hdus does.
+
+    :param memmap: True - leave the data memory-mapped and unscaled (BZERO and BSCALE are not applied, e.g. uint16 data
+                   is returned as the stored int16 values)
+    """
+    kwargs = {"memmap": True, "do_not_scale_image_data": True} if memmap else {}
+    with fits.open(filename, **kwargs) as hdul:
+        if not filename.lower().endswith(".gz"):
+            # uncompressed data is memory-mapped
+            count_mapped_read(hdul[0].size)
+        yield hdul[0]
+
+
+def _match(header_val, val):
+    if isinstance(val, (list, tuple)):
+        # any of several alternatives
+        return any(_match(header_val, alternative) for alternative in val)
+    if val == "*":
+        return header_val is not None
+    if val is None:
+        return header_val is None
+    if header_val is None:
+        return False
+    if isinstance(val, str):
+        # case-insensitive, as in ccdproc.ImageFileCollection
+        return isinstance(header_val, str) and (header_val.lower() == val.lower())
+    return header_val == val
+
+
+class HeaderCatalog:
+    """
+    catalog of the primary headers of the FITS files in a night folder.
+
+    Implements the parts of ccdproc.ImageFileCollection used by pywise (files, values, files_filtered, hdus), while
+    reading each header only once: the catalog is persisted in the folder, and a file is re-read only if its size or
+    modification time changed. Only the keywords of the telescope profiles are kept (see scan_header), and new files
+    are scanned on a thread pool.
+    """
+
+    def __init__(self, location, entries=None, threads=DEFAULT_CATALOG_THREADS, log=None):
+        """
+        :param threads: number of threads scanning the headers of new and modified files
+        """
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.location = location
+        self.threads = threads
+        self.log = log
+        self._entries = {} if entries is None else entries
+        self._is_view = entries is not None
+        if not self._is_view:
+            self.refresh()
+
+    @property
+    def catalog_file(self):
+        return os.path.join(self.location, CATALOG_FILENAME)
+
+    def refresh(self):
+        """
+        re-reads the headers of new and modified files (and drops removed files).
+        """
+        if (not self._entries) and os.path.isfile(self.catalog_file):
+            try:
+                with open(self.catalog_file) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self.log.warning(f"Could not read header catalog {self.catalog_file}, rebuilding.")
+                self._entries = {}
+
+        # the keywords scanned, identified by their hash (entries without one have the whole header, as read by
+        # earlier versions), so that the headers are scanned again when a telescope profile adds keywords
+        keys = get_header_keys()
+        keys_hash = hashlib.sha1(",".join(sorted(keys)).encode()).hexdigest()[:12]
+
+        entries = {}
+        to_scan = []
+        for filename in sorted(os.listdir(self.location)):
+            if not filename.lower().endswith(FITS_EXTENSIONS):
+                continue
+            st = os.stat(os.path.join(self.location, filename))
+            entry = self._entries.get(filename)
+            if (entry is None) or (entry["size"] != st.st_size) or (entry["mtime"] != st.st_mtime_ns) or \
+                    (entry.get("keys", keys_hash) != keys_hash):
+                to_scan.append((filename, st))
+            entries[filename] = entry
+
+        def scan(filename):
+            try:
+                return scan_header(os.path.join(self.location, filename), keys)
+            except (OSError, IndexError) as e:
+                self.log.warning(f"Could not read the header of {filename} ({e}), skipping.")
+                return None
+
+        if (self.threads > 1) and (len(to_scan) > 1):
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                headers = list(executor.map(scan, [filename for filename, _ in to_scan]))
+        else:
+            headers = [scan(filename) for filename, _ in to_scan]
+        for (filename, st), header in zip(to_scan, headers):
+            if header is None:
+                del entries[filename]
+            else:
+                entries[filename] = {"size": st.st_size, "mtime": st.st_mtime_ns, "keys": keys_hash, "header": header}
+        is_modified = len(to_scan) > 0
+
+        if is_modified or (len(entries) != len(self._entries)):
+            self.log.debug(f"Header catalog of {self.location} updated ({len(entries)} files).")
+            self._entries = entries
+            self.save()
+        else:
+            self._entries = entries
+
+    def save(self):
+        tmp_file = get_tmp_name(self.catalog_file)
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_file, self.catalog_file)
+        except OSError as e:
+            self.log.warning(f"Could not save header catalog {self.catalog_file} ({e}).")
+
+    @property
+    def files(self):
+        return list(self._entries.keys())
+
+    @property
+    def keywords(self):
+        keys = set()
+        for entry in self._entries.values():
+            keys.update(entry["header"].keys())
+        return sorted(keys)
+
+    def header(self, filename):
+        """
+        :return: dict of the (lower-case) header keywords of a file in the catalog
+        """
+        return self._entries[os.path.basename(filename)]["header"]
+
+    def fits_header(self, filename):
+        """
+        :return: astropy.io.fits.Header with the cataloged keywords of a file (no file access)
+        """
+        return fits.Header(self.header(filename))
+
+    def values(self, keyword, unique=False):
+        """
+        :return: list of the values of a keyword (None where missing), in file order
+        """
+        vals = [entry["header"].get(keyword.lower()) for entry in self._entries.values()]
+        if unique:
+            return list(dict.fromkeys(vals))
+        return vals
+
+    def _filter(self, **kwargs):
+        kwargs = {key.lower(): val for key, val in kwargs.items()}
+        return {filename: entry for filename, entry in self._entries.items()
+                if all(_match(entry["header"].get(key), val) for key, val in kwargs.items())}
+
+    def filtered(self, **kwargs):
+        """
+        :return: HeaderCatalog of the files matching all the keyword=value pairs
+        """
+        return HeaderCatalog(self.location, entries=self._filter(**kwargs), threads=self.threads, log=self.log)
+
+    def files_filtered(self, include_path=False, **kwargs):
+        """
+        :return: list of the files matching all the keyword=value pairs (string values are matched case-insensitively,
+                 "*" matches any value, None matches a missing keyword, a list matches any of its values)
+        """
+        files = list(self._filter(**kwargs).keys())
+        if include_path:
+            files = [os.path.join(self.location, filename) for filename in files]
+        return files
+
+    def hdus(self, return_fname=False, **kwargs):
+        """
+        generator of the primary HDUs of the files matching all the keyword=value pairs.
+        """
+        for filename in self.files_filtered(**kwargs):
+            with open_hdu(os.path.join(self.location, filename)) as hdu:
+                if return_fname:
+                    yield hdu, filename
+                else:
+                    yield hdu
+
+
+def group_calframes(imlist, telescope, filenames=None):
+    """
+    groups the raw calibration frames of a night by image type, ccd geometry and filter, in a single pass over the
+    cataloged headers (no file access).
+
+    :param imlist: catalog.HeaderCatalog
+    :param filenames: file names (without path) to group (None - all the files of the catalog)
+    :return: dict of {(image type ("BIAS", "DARK" or "FLAT"), geometry, filter): list of file names (with path)}, where geometry is the tuple of the
+             utils.get_ccd_keys(original_keys=True) header values, and filter is None for bias and dark frames,
+             and list of the geometries of all the frames of the night (also of the science frames), in file order
+    """
+    profile = get_profile(telescope)
+    image_type_key = profile.key("image_type").lower()
+    filter_key = profile.key("filter").lower()
+    ccd_keys = utils.get_ccd_keys(telescope, original_keys=True)
+    groups = {}
+    geometries = {}
+    for filename in imlist.files:
+        if (filenames is not None) and (filename not in filenames):
+            continue
+        header = imlist.header(filename)
+        geometry = tuple(header.get(key) for key in ccd_keys)
+        geometries[geometry] = None
+        image_type = profile.image_type(header.get(image_type_key))
+        if image_type in ("bias", "dark"):
+            filt = None
+        elif (image_type == "flat") and (header.get(filter_key) is not None):
+            filt = header[filter_key]
+        else:
+            continue
+        image_type = image_type.upper()
+        groups.setdefault((image_type, geometry, filt), []).append(os.path.join(imlist.location, filename))
+
+    return groups, list(geometries)
+
+
+_catalogs = {}
+
+
+def get_catalog(location, threads=DEFAULT_CATALOG_THREADS, log=None):
+    """
+    :param threads: number of threads scanning the headers of new and modified files
+    :return: the (shared, refreshed) HeaderCatalog of a night folder
+    """
+    key = os.path.abspath(location)
+    if key not in _catalogs:
+        _catalogs[key] = HeaderCatalog(location, threads=threads, log=log)
+    else:
+        if log is not None:
+            _catalogs[key].log = log
+        _catalogs[key].refresh()
+    return _catalogs[key]
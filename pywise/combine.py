@@ -0,0 +1,56 @@
+import tempfile
+import numpy as np
+
+DEFAULT_MEMORY_LIMIT = 1024  # [MB]
+
+
+def create_cube(n, shape, tmp_dir=None):
+    """
+    creates a float32 cube of n frames, memory-mapped to an (anonymous) temporary file.
+
+    :param n: number of frames
+    :param shape: frame shape (ny, nx)
+    :param tmp_dir: folder of the temporary file (None - system default)
+    :return: numpy.memmap of shape (n, ny, nx)
+    """
+    f = tempfile.TemporaryFile(dir=tmp_dir)  # removed once the cube is garbage-collected
+    return np.memmap(f, dtype=np.float32, mode="w+", shape=(n,) + tuple(shape))
+
+
+def median_combine(cube, scaling=None, memory_limit=DEFAULT_MEMORY_LIMIT*1024**2, uncertainty=False):
+    """
+    median-combines a cube of frames, one tile of rows at a time.
+
+    :param cube: (n, ny, nx) array (e.g. returned by create_cube)
+    :param scaling: n scaling factors applied to the frames before combining (None - no scaling)
+    :param memory_limit: memory budget of the tile buffer [bytes]
+    :param uncertainty: True - also return the uncertainty of the median (as in ccdproc.Combiner.median_combine)
+    :return: float32 median frame, and its uncertainty (or None)
+    """
+    n, ny, nx = cube.shape
+    rows = int(max(1, min(ny, memory_limit // (4*n*nx))))
+
+    buf = np.empty((n, rows, nx), dtype=np.float32)
+    if scaling is not None:
+        scaling = np.asarray(scaling, dtype=np.float32)[:, None, None]
+    median = np.empty((ny, nx), dtype=np.float32)
+    sigma = np.empty((ny, nx), dtype=np.float32) if uncertainty else None
+
+    for r0 in range(0, ny, rows):
+        r1 = min(r0 + rows, ny)
+        tile = buf[:, :r1-r0]
+        if scaling is None:
+            tile[...] = cube[:, r0:r1]
+        else:
+            np.multiply(cube[:, r0:r1], scaling, out=tile)
+
+        if uncertainty:
+            median[r0:r1] = np.median(tile, axis=0)
+            # 1.4826 * median absolute deviation / sqrt(n)
+            np.subtract(tile, median[r0:r1], out=tile)
+            np.abs(tile, out=tile)
+            sigma[r0:r1] = 1.4826*np.median(tile, axis=0, overwrite_input=True)/np.sqrt(n)
+        else:
+            median[r0:r1] = np.median(tile, axis=0, overwrite_input=True)
+
+    return median, sigma
@@ -0,0 +1,77 @@
+import numpy as np
+from collections import namedtuple
+
+FastMasters = namedtuple("FastMasters", ["bias", "dark_rate", "inv_flat", "scratch"])
+TILE_ROWS = 64  # rows converted at a time by convert_raw (64 rows of a 4096 pixel wide frame fit in L2 cache)
+
+
+def prepare_masters(bias, dark, flat, exptime_key="EXPTIME"):
+    """
+    precomputes the calibration arrays used by calibrate, once per ccd geometry and filter.
+
+    :param bias: master bias (ccdproc.CCDData)
+    :param dark: master dark (ccdproc.CCDData)
+    :param flat: master flat (ccdproc.CCDData)
+    :param exptime_key: exposure time keyword of the master dark
+    :return: FastMasters with float32 bias, dark rate (per second) and normalized inverse flat
+    """
+    bias_data = np.asarray(bias.data, dtype=np.float32)
+    dark_rate = np.asarray(dark.data, dtype=np.float32) / np.float32(dark.header[exptime_key])
+    # same normalization as ccdproc.flat_correct
+    flat_data = np.asarray(flat.data, dtype=np.float32)
+    with np.errstate(divide="ignore"):
+        inv_flat = (flat_data.mean() / flat_data).astype(np.float32)
+
+    return FastMasters(bias=bias_data, dark_rate=dark_rate.astype(np.float32, copy=False), inv_flat=inv_flat,
+                       scratch=np.empty_like(bias_data))
+
+
+def calibrate(data, exptime, masters):
+    """
+    calibrates raw frames in place: (raw - bias - dark_rate*exptime) * inv_flat.
+
+    :param data: float32 array of a single frame (ny, nx), or of a batch of frames stacked into (n, ny, nx)
+    :param exptime: exposure time [sec] (a sequence of n exposure times for a batch)
+    :param masters: FastMasters returned by prepare_masters
+    :return: data
+    """
+    if data.ndim == 3:
+        for frame, t in zip(data, np.broadcast_to(exptime, data.shape[:1])):
+            calibrate(frame, t, masters)
+        return data
+
+    scratch = masters.scratch
+    np.subtract(data, masters.bias, out=data)
+    np.multiply(masters.dark_rate, np.float32(exptime), out=scratch)
+    np.subtract(data, scratch, out=data)
+    np.multiply(data, masters.inv_flat, out=data)
+    return data
+
+
+def convert_raw(raw, out, bscale=1., bzero=0., exptime=0., masters=None, tile_rows=TILE_ROWS):
+    """
+    converts raw (unscaled, e.g. memory-mapped integer) data to float32 one tile of rows at a time, straight into a
+    reusable buffer, and optionally calibrates each tile while it is still in cache.
+
+    :param raw: raw data (ny, nx), read with do_not_scale_image_data=True
+    :param out: float32 buffer of the same shape
+    :param bscale: BSCALE of the raw data
+    :param bzero: BZERO of the raw data
+    :param exptime: exposure time [sec] (only used for calibration)
+    :param masters: FastMasters returned by prepare_masters (None - only convert)
+    :return: out
+    """
+    for r0 in range(0, raw.shape[0], tile_rows):
+        tile = out[r0:r0 + tile_rows]
+        tile[...] = raw[r0:r0 + tile_rows]
+        if bscale != 1:
+            np.multiply(tile, np.float32(bscale), out=tile)
+        if bzero != 0:
+            np.add(tile, np.float32(bzero), out=tile)
+        if masters is not None:
+            scratch = masters.scratch[r0:r0 + tile_rows]
+            np.subtract(tile, masters.bias[r0:r0 + tile_rows], out=tile)
+            np.multiply(masters.dark_rate[r0:r0 + tile_rows], np.float32(exptime), out=scratch)
+            np.subtract(tile, scratch, out=tile)
+            np.multiply(tile, masters.inv_flat[r0:r0 + tile_rows], out=tile)
+    return out
@@ -0,0 +1,232 @@
+import os
+import time
+import datetime
+from collections import Counter
+from pywise import calframes, utils
+from pywise.catalog import open_hdu, group_calframes, FITS_EXTENSIONS, FITS_BLOCK
+from pywise.keywords import get_profile
+from pywise.manifest import Manifest, get_file_hash
+from pywise.reduced import ReducedCatalog
+from pywise.output import get_output_format, OUTPUT_FORMATS
+from pywise.preview import preview_image, PREVIEW_FORMATS, DEFAULT_PREVIEW_BINNING
+from pywise.session import ReductionSession
+from pywise.bundle import get_bundle_mode, get_output_file
+from pywise.wise import load_masters, reduce_image
+
+
+def get_header_ccd_shape(header, telescope):
+    """
+    :param header: dict of (lower-case) header keywords, as in catalog.HeaderCatalog
+    :return: ccd_shape of a single frame, in the format of utils.get_ccd_shape
+    """
+    out_keys = ["x_naxis", "y_naxis", "x_subframe", "y_subframe", "x_bin", "y_bin"]
+    profile = get_profile(telescope)
+    return {key: [header.get(profile.key(key).lower())] for key in out_keys}
+
+
+def find_complete_files(im_path, sizes):
+    """
+    finds the FITS files whose writing is done: files with a whole number of FITS blocks (if not compressed), whose size
+    didn't change since the previous poll.
+
+    :param sizes: dict of file sizes from the previous poll (updated in place)
+    :return: set of complete file names
+    """
+    complete = set()
+    for filename in os.listdir(im_path):
+        if not filename.lower().endswith(FITS_EXTENSIONS):
+            continue
+        size = os.path.getsize(os.path.join(im_path, filename))
+        is_whole = (size % FITS_BLOCK == 0) or (not filename.lower().endswith((".fit", ".fits", ".fts")))
+        if (size > 0) and is_whole and (sizes.get(filename) == size):
+            complete.add(filename)
+        sizes[filename] = size
+    return complete
+
+
+# master calibration frame types, in the order they are created, and the masters calibrated by each type
+_IMAGE_TYPES = ("BIAS", "DARK", "FLAT")
+_CALIBRATED_MASTERS = {"BIAS": ("DARK", "FLAT"), "DARK": ("FLAT",)}
+
+
+def follow_night(year=datetime.date.today().year, month=datetime.date.today().month, day=datetime.date.today().day,
+                 telescope="C28", config_file="config.ini", poll_interval=2, idle_timeout=None, preview=False,
+                 session=None):
+    """
+    reduces the science frames of a night as soon as they are written, while the night is still being observed.
+
+    Master calibration frames are created as soon as MIN_NUM_FRAMES raw frames of a kind exist (per ccd geometry, and
+    per filter for flats), and created again as more raw frames of the kind arrive (along with the masters calibrated
+    by them). Science frames that had no calibration frames are retried once new masters are created. Errors in
+    creating a master or in reducing a frame are logged, and following goes on.
+
+    :param poll_interval: time between checks for new files [sec]
+    :param idle_timeout: stop after this many seconds without new files (None - follow until interrupted)
+    :param preview: True - only save binned quick-look previews of the new science frames (see preview.preview_image)
+    :param session: ReductionSession (None - a session of this night only, reading config_file)
+    """
+    if session is None:
+        with ReductionSession(config_file) as session:
+            return follow_night(year, month, day, telescope, poll_interval=poll_interval, idle_timeout=idle_timeout,
+                                preview=preview, session=session)
+
+    config = session.config
+    profile = get_profile(telescope)
+    # the cataloged headers have lower-case keywords
+    filter_key = profile.key("filter").lower()
+    instrument_key = profile.key("instrument").lower()
+
+    t = datetime.date(year, month, day)
+    t_str = datetime.date.strftime(t, format="%Y%m%d")
+
+    log = session.start_night(time.strftime("%Y%m%d_%H%M%S", time.gmtime()) + f"_{telescope}_{t_str}_follow")
+
+    im_path = config.get("GENERAL", "PATH") + config.get(telescope, "PATH") + t_str + config.get(telescope, "DIR_SUFFIX") + os.sep
+    reduced_path = im_path + config.get("GENERAL", "REDUCED_DIR") + os.sep
+
+    min_num_frames = config.getint("CAL", "MIN_NUM_FRAMES")
+    max_num_frames = config.getint("CAL", "MAX_NUM_FRAMES")
+    save_uncertainty = config.getboolean("GENERAL", "SAVE_UNCERTAINTY")
+    is_overwrite = config.getboolean("GENERAL", "OVERWRITE")
+    engine = config.get("GENERAL", "ENGINE", fallback="ccdproc")
+    if (engine == "fast") and save_uncertainty:
+        engine = "ccdproc"
+    memmap = config.getboolean("GENERAL", "MEMMAP", fallback=False)
+    output_format, quantize_level = get_output_format(config, telescope)
+    if output_format not in OUTPUT_FORMATS:
+        log.warning(f"Unknown output format {output_format}, saving float32 FITS files instead.")
+        output_format = "fits"
+    bundle_by = get_bundle_mode(config, log=log)
+    if preview:
+        reduced_path = im_path + config.get("GENERAL", "PREVIEW_DIR", fallback="preview") + os.sep
+        binning = config.getint("GENERAL", "PREVIEW_BINNING", fallback=DEFAULT_PREVIEW_BINNING)
+        preview_format = config.get("GENERAL", "PREVIEW_FORMAT", fallback="png").lower()
+        if preview_format not in PREVIEW_FORMATS:
+            log.warning(f"Unknown preview format {preview_format}, saving PNG previews instead.")
+            preview_format = "png"
+
+    cache = session.cache
+
+    log.info(f"Following {im_path}...")
+    sizes = {}
+    done = set()
+    pending = set()  # science frames waiting for master calibration frames
+    # number of raw frames each master was created from, by group of raw frames (see catalog.group_calframes)
+    masters_created = {}
+    manifest = None
+    last_new = time.time()
+    try:
+        while True:
+            if not os.path.isdir(im_path):
+                time.sleep(poll_interval)
+                continue
+
+            new_files = find_complete_files(im_path, sizes) - done
+            if new_files:
+                last_new = time.time()
+            elif (idle_timeout is not None) and (time.time() - last_new > idle_timeout):
+                log.info(f"No new files for {idle_timeout} s, stopping.")
+                break
+
+            if new_files or pending:
+                imlist = session.get_catalog(im_path)
+                complete = done | new_files
+
+                # create master calibration frames once there are enough raw frames (of the complete files only), and
+                # again once there are more
+                groups, _ = group_calframes(imlist, telescope, filenames=complete)
+                n_frames = {key: len(filenames) if max_num_frames <= 0 else min(len(filenames), max_num_frames)
+                            for key, filenames in groups.items()}
+                to_create = {key for key, n in n_frames.items() if (n >= min_num_frames) and
+                             (n > masters_created.get(key, 0))}
+                # with the masters calibrated by a master created again
+                for image_type, geometry, _ in list(to_create):
+                    to_create |= {key for key in masters_created
+                                  if (key[1] == geometry) and (key[0] in _CALIBRATED_MASTERS.get(image_type, ()))}
+                is_new_master = False
+                for key in sorted(to_create, key=lambda key: (_IMAGE_TYPES.index(key[0]), str(key[1]), str(key[2]))):
+                    image_type, _, filt = key
+                    log.info(f"Creating master {image_type.lower()} frame{f' ({filt})' if filt else ''} from "
+                             f"{n_frames[key]} raw frames...")
+                    try:
+                        calframes.create_masters(year, month, day, telescope, log=log, filenames=complete, only={key},
+                                                 session=session)
+                    except Exception as e:
+                        log.error(f"Could not create the master {image_type.lower()} frame ({e}).", exc_info=True)
+                        continue
+                    masters_created[key] = n_frames[key]
+                    is_new_master = True
+                if is_new_master:
+                    # the masters loaded so far may have been created again
+                    session.masters.clear()
+
+                light = set(imlist.files_filtered(**{profile.key("image_type"): profile.val("light")}))
+                to_reduce = sorted((new_files & light) | (pending if is_new_master else set()))
+                if to_reduce and (manifest is None):
+                    # create reduced folder
+                    if not os.path.exists(reduced_path):
+                        os.makedirs(reduced_path)
+                    manifest = Manifest(reduced_path, log=log)
+                    reduced_catalog = ReducedCatalog(reduced_path, telescope, log=log)
+
+                for filename in to_reduce:
+                    try:
+                        header = imlist.header(filename)
+                        filt = header.get(filter_key)
+                        ccd_str = utils.get_ccd_str(get_header_ccd_shape(header, telescope))
+                        bias_file, dark_file, flat_file = calframes.get_calframes(year, month, day, filt, ccd_str,
+                                                                                  telescope=telescope,
+                                                                                  instrument=header.get(instrument_key),
+                                                                                  log=log, session=session)
+                        if (not bias_file) or (not dark_file) or (not flat_file):
+                            log.warning(f"No calibration frames found for {filename}, waiting for new masters.")
+                            pending.add(filename)
+                            continue
+
+                        pending.discard(filename)
+                        if preview:
+                            masters = load_masters(bias_file, dark_file, flat_file, memmap=memmap, log=log,
+                                                   session=session)
+                            output = preview_image(im_path + filename, filt, reduced_path, masters, telescope,
+                                                   binning=binning, preview_format=preview_format, log=log)
+                            latency = time.time() - os.path.getmtime(im_path + filename)
+                            log.info(f"{filename} previewed in {os.path.basename(output)} ({latency:.1f} s after "
+                                     f"readout).")
+                            continue
+                        output = get_output_file(reduced_path, imlist.fits_header(filename), filt, telescope,
+                                                 bundle_by=bundle_by)
+                        master_files = (bias_file, dark_file, flat_file)
+                        if (not is_overwrite) and manifest.is_up_to_date(output, im_path + filename, master_files):
+                            log.debug(f"{filename} is already reduced, skipping.")
+                            continue
+
+                        masters = load_masters(bias_file, dark_file, flat_file, engine=engine, memmap=memmap, log=log,
+                                               session=session)
+                        file_hash = manifest.get_hash(output, im_path + filename) or get_file_hash(im_path + filename)
+                        with open_hdu(im_path + filename, memmap=memmap) as im:
+                            output = reduce_image(im, filt, reduced_path, masters, telescope,
+                                                  save_uncertainty=save_uncertainty, memmap=memmap,
+                                                  output_format=output_format, quantize_level=quantize_level,
+                                                  bundle_by=bundle_by, log=log)
+                        manifest.record(output, im_path + filename, master_files, file_hash)
+                        reduced_catalog.record(output, im_path + filename, imlist.fits_header(filename), master_files)
+                        latency = time.time() - os.path.getmtime(im_path + filename)
+                        log.info(f"{filename} reduced to {os.path.basename(output)} ({latency:.1f} s after readout).")
+                    except Exception as e:
+                        # a bad frame doesn't stop following the night
+                        log.error(f"Could not reduce {filename} ({e}).", exc_info=True)
+                        pending.discard(filename)
+
+                if to_reduce and (not preview):
+                    manifest.save()
+                    reduced_catalog.save()
+
+                done |= new_files
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        log.info("Stopped following.")
+    finally:
+        cache.log_stats(log)
+
+    return reduced_path
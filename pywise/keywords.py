@@ -1,115 +1,236 @@
+import logging
 from astropy import units as u
 
+
+class TelescopeProfile:
+    """
+    header keywords and keyword values of a telescope, resolved once.
+
+    A keyword (or value) may have several alternatives (e.g. "JD" or "JUL-DATE"), given as a list.
+    """
+    __slots__ = ("name", "keys", "vals", "_image_types")
+
+    # frame kinds recognized by image_type
+    FRAME_TYPES = ("bias", "dark", "flat", "light")
+
+    def __init__(self, name, keys, vals):
+        self.name = name
+        self.keys = dict(keys)
+        self.vals = dict(vals)
+        # IMAGETYP value (in lower case) -> frame kind
+        self._image_types = {}
+        for frame_type in self.FRAME_TYPES:
+            for val in self.alternatives(self.vals.get(frame_type, [])):
+                self._image_types[val.lower()] = frame_type
+
+    @staticmethod
+    def alternatives(entry):
+        """
+        :return: list of the alternatives of a keyword or value entry
+        """
+        return list(entry) if isinstance(entry, (list, tuple)) else [entry]
+
+    def key(self, key):
+        """
+        :return: header keyword (the first alternative, if there are several)
+        """
+        return self.alternatives(self.keys[key])[0]
+
+    def val(self, val):
+        """
+        :return: keyword value (a list, if there are several alternatives)
+        """
+        return self.vals[val]
+
+    def find_key(self, key, header):
+        """
+        :return: the alternative of a header keyword that appears in the header (the first alternative if none does)
+        """
+        names = self.alternatives(self.keys[key])
+        for name in names:
+            if name in header:
+                return name
+        return names[0]
+
+    def image_type(self, val):
+        """
+        :return: frame kind ("bias", "dark", "flat" or "light") of an IMAGETYP value, None if unknown
+        """
+        if not isinstance(val, str):
+            return None
+        return self._image_types.get(val.lower())
+
+    def extend(self, name, keys=None, vals=None):
+        """
+        :return: new TelescopeProfile with the keywords and values of this one, updated by keys and vals
+        """
+        return TelescopeProfile(name, {**self.keys, **(keys or {})}, {**self.vals, **(vals or {})})
+
+
+_common_keys = {
+    "ra": "RA",
+    "dec": "DEC",
+    "exptime": "EXPTIME",
+    "filter": "FILTER",
+    "image_type": "IMAGETYP",
+    "object": "OBJECT",
+    "airmass": "AIRMASS",
+    "naxis": "NAXIS",
+    "x_naxis": "NAXIS1",
+    "y_naxis": "NAXIS2",
+    "x_bin": "XBINNING",
+    "y_bin": "YBINNING",
+    "telescope": "TELESCOP",
+    "instrument": "INSTRUME",
+    "readout_noise": "RDNOISE",
+    "flip": "FLIPSTAT",
+    "x_subframe": "XORGSUBF",
+    "y_subframe": "YORGSUBF",
+}
+
+_common_vals = {
+    "bias": "BIAS",
+    "dark": "DARK",
+    "flat": "FLAT",
+    "light": "LIGHT",
+}
+
+_profiles = {
+    "1m": TelescopeProfile("1m", {**_common_keys,
+                                  "jd": ["JD", "JUL-DATE"],
+                                  "temperature": ["CCD-TEMP", "TEMP1"],
+                                  "gain": "EGAIN",
+                                  "epoch": "EPOCH",
+                                  "ccdsec": "CCDSEC"},  # laiwo
+                           {"bias": ["BiasFrame", "Bias Frame", "BIAS"],
+                            "dark": ["DarkFrame", "Dark Frame", "DARK"],
+                            "flat": ["FlatField", "Flat Field", "FLAT"],
+                            "light": ["LightFrame", "SCIENCE"]}),
+    "C28": TelescopeProfile("C28", {**_common_keys,
+                                    "readout": "READOUTM",  # 8 MHz (RBI Flood)
+                                    "jd": "JD",
+                                    "temperature": "CCD-TEMP",
+                                    "gain": "GAIN",
+                                    "rbi_delay": "RBIDELAY"},
+                            {**_common_vals,
+                             "rbi": "8 MHz (RBI Flood)",
+                             "rbi_delay": 27*u.s}),
+    "C18": TelescopeProfile("C18", {**_common_keys,
+                                    "readout": "READOUTM",
+                                    "jd": "JD",
+                                    "temperature": "CCD-TEMP",
+                                    "gain": "GAIN"},
+                            {**_common_vals,
+                             "rbi": "8 MHz (RBI Flood)"}),
+}
+_builtin_profiles = dict(_profiles)
+
+# values parsed as astropy Quantity when set from config.ini
+_QUANTITY_VALS = ("rbi_delay",)
+
+
+def get_profile(telescope):
+    """
+    :return: TelescopeProfile of a telescope
+    """
+    try:
+        return _profiles[telescope]
+    except KeyError:
+        raise Exception(f"Not implemented for {telescope} yet!") from None
+
+
+def register_profile(profile):
+    """
+    adds (or replaces) a telescope profile in the registry.
+    """
+    _profiles[profile.name] = profile
+
+
+def get_header_keys():
+    """
+    :return: set of the (upper-case) header keywords of all the registered telescope profiles (with all their
+             alternatives), i.e. the keywords kept in the header catalogs
+    """
+    return {name.upper() for profile in _profiles.values() for entry in profile.keys.values()
+            for name in TelescopeProfile.alternatives(entry)}
+
+
+def load_profiles(config):
+    """
+    registers the telescope profiles defined or extended in config.ini: a telescope section may set BASE_PROFILE
+    (the profile it is based on, by default the profile of the same name), KEY_<key> = <header keyword> and
+    VAL_<value> = <keyword value> options (several alternatives are separated by commas).
+    """
+    for section in config.sections():
+        options = dict(config.items(section))
+        keys = {option[4:]: _parse(val) for option, val in options.items() if option.startswith("key_")}
+        vals = {option[4:]: _parse(val, quantity=option[4:] in _QUANTITY_VALS)
+                for option, val in options.items() if option.startswith("val_")}
+        if ("base_profile" not in options) and (not keys) and (not vals):
+            continue
+        base = options.get("base_profile", section)
+        # config.ini extends the built-in profiles, so that loading it again doesn't stack the changes
+        base_profile = _builtin_profiles.get(base, _profiles.get(base))
+        if base_profile is None:
+            raise Exception(f"Unknown telescope profile {base} of {section}!")
+        register_profile(base_profile.extend(section, keys, vals))
+
+
+def _parse(val, quantity=False):
+    if quantity:
+        return u.Quantity(val)
+    alternatives = [alternative.strip() for alternative in val.split(",")]
+    return alternatives if len(alternatives) > 1 else alternatives[0]
+
+
+def get_jd(header, telescope):
+    """
+    :return: JD of the image (astropy.units.Quantity), corrected for the RBI flood delay (C28)
+    """
+    profile = get_profile(telescope)
+    jd = header[profile.find_key("jd", header)]*u.day
+    # fix JD for RBI flood delay (C28), unless already corrected:
+    if is_rbi_delayed(header, profile):
+        jd = jd + profile.val("rbi_delay")
+    return jd
+
+
+def is_rbi_delayed(header, profile):
+    """
+    :return: True if the JD in the header is not yet corrected for the RBI flood delay (of telescopes that have one)
+    """
+    return ("rbi_delay" in profile.vals) and (header[profile.key("readout")] == profile.val("rbi")) and \
+        (profile.key("rbi_delay") not in header)
+
+
+def fix_rbi_delay(header, telescope, log=None):
+    """
+    corrects (in place) the JD in the header for the RBI flood delay (C28).
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    profile = get_profile(telescope)
+    if is_rbi_delayed(header, profile):
+        header[profile.find_key("jd", header)] = get_jd(header, telescope).to_value()
+        header[profile.key("rbi_delay")] = "TRUE"
+        header.comments[profile.key("rbi_delay")] = f"""Corrected JD by {profile.val("rbi_delay")} of RBI flood delay."""
+        log.warning(f"""Corrected RBI flood delay of {profile.val("rbi_delay")}.""")
+
+
+def get_output_name(header, filt, telescope):
+    """
+    :param header: raw image header (astropy.io.fits.Header), only the header is needed (not the pixel data)
+    :return: reduced image file name (without extension), <object>_<JD>_<filter>_<telescope>
+    """
+    obj = header[get_profile(telescope).key("object")]
+    jd = str(get_jd(header, telescope).to_value()).replace(".", "_")
+    return f"{obj}_{jd}_{filt}_{telescope}"
+
+
 def get_key_name(key, telescope):
-    meter = {
-        "ra": "RA",
-        "dec": "DEC",
-        "exptime": "EXPTIME",
-        "filter": "FILTER",
-        "image_type": "IMAGETYP",
-        "light": ["LightFrame", "SCIENCE"],
-        "jd": ["JD", "JUL-DATE"],
-        "object": "OBJECT",
-        "airmass": "AIRMASS",
-        "naxis": "NAXIS",
-        "x_naxis": "NAXIS1",
-        "y_naxis": "NAXIS2",
-        "x_bin": "XBINNING",
-        "y_bin": "YBINNING",
-        "temperature": ["CCD-TEMP", "TEMP1"],
-        "telescope": "TELESCOP",
-        "instrument": "INSTRUME",
-        "gain": "EGAIN",
-        "readout_noise": "RDNOISE",
-        "flip": "FLIPSTAT",
-        "x_subframe": "XORGSUBF",
-        "y_subframe": "YORGSUBF",
-        "epoch": "EPOCH",
-        "ccdsec": "CCDSEC"  # laiwo
-    }
-
-    c28 = {
-        "ra": "RA",
-        "dec": "DEC",
-        "exptime": "EXPTIME",
-        "readout": "READOUTM",  # 8 MHz (RBI Flood)
-        "filter": "FILTER",
-        "image_type": "IMAGETYP",
-        "light": "LIGHT",
-        "jd": "JD",
-        "object": "OBJECT",
-        "airmass": "AIRMASS",
-        "naxis": "NAXIS",
-        "x_naxis": "NAXIS1",
-        "y_naxis": "NAXIS2",
-        "x_bin": "XBINNING",
-        "y_bin": "YBINNING",
-        "temperature": "CCD-TEMP",
-        "telescope": "TELESCOP",
-        "instrument": "INSTRUME",
-        "gain": "GAIN",
-        "readout_noise": "RDNOISE",
-        "flip": "FLIPSTAT",
-        "x_subframe": "XORGSUBF",
-        "y_subframe": "YORGSUBF",
-        "rbi_delay": "RBIDELAY",
-    }
-
-    c18 = {
-        "ra": "RA",
-        "dec": "DEC",
-        "exptime": "EXPTIME",
-        "readout": "READOUTM",
-        "filter": "FILTER",
-        "image_type": "IMAGETYP",
-        "light": "LIGHT",
-        "jd": "JD",
-        "object": "OBJECT",
-        "airmass": "AIRMASS",
-        "naxis": "NAXIS",
-        "x_naxis": "NAXIS1",
-        "y_naxis": "NAXIS2",
-        "x_bin": "XBINNING",
-        "y_bin": "YBINNING",
-        "temperature": "CCD-TEMP",
-        "telescope": "TELESCOP",
-        "instrument": "INSTRUME",
-        "gain": "GAIN",
-        "readout_noise": "RDNOISE",
-        "flip": "FLIPSTAT",
-        "x_subframe": "XORGSUBF",
-        "y_subframe": "YORGSUBF",
-    }
-
-    keys = {
-        "1m": meter,
-        "C28": c28,
-        "C18": c18,
-    }
-
-    return keys[telescope][key]
+    return _profiles[telescope].keys[key]
 
 
 def get_key_val(val, telescope):
-    meter = {
-        "light": ["LightFrame", "SCIENCE"]
-    }
-
-    c28 = {
-        "rbi": "8 MHz (RBI Flood)",
-        "rbi_delay": 27*u.s,
-        "light": "LIGHT"
-    }
-
-    c18 = {
-        "rbi": "8 MHz (RBI Flood)",
-        "light": "LIGHT"
-    }
-
-    vals = {
-        "1m": meter,
-        "C28": c28,
-        "C18": c18,
-    }
-
-    return vals[telescope][val]
+    return _profiles[telescope].vals[val]
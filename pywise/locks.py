@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+LOCK_SUFFIX = ".lock"
+DEFAULT_LOCK_TIMEOUT = 600  # [sec]
+
+
+def get_owner():
+    """
+    :return: "<host>.<pid>" of this process
+    """
+    return f"{socket.gethostname()}.{os.getpid()}"
+
+
+def get_tmp_name(filename):
+    """
+    :return: hidden temporary file name next to filename, unique to this host and process, with the same extension
+             (so that astropy still recognizes the file format)
+    """
+    path, name = os.path.split(filename)
+    base, ext = os.path.splitext(name)
+    return os.path.join(path, f".{base}.{get_owner()}.tmp{ext}")
+
+
+@contextmanager
+def atomic_output(filename):
+    """
+    yields a temporary file name to write instead of filename. Once written, the temporary file is renamed to filename,
+    so that other processes (on any host) see either the previous file or the complete new one. On error the temporary
+    file is removed.
+    """
+    tmp_file = get_tmp_name(filename)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, filename)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WorkLock:
+    """
+    lock file claiming a unit of work (e.g. the master calibration frames of a night) among processes on any number of
+    hosts sharing the file system.
+
+    The lock file is created atomically (O_CREAT | O_EXCL), and its modification time is refreshed by a heartbeat thread
+    while it is held. A lock that was not refreshed for `timeout` seconds (its holder was killed or lost the file
+    system), or whose holder process is gone (on this host), is stale, and is reclaimed.
+
+    Usage:
+        with WorkLock(filename):  # waits for the lock
+            ...
+        lock = WorkLock(filename)
+        if lock.try_acquire():  # doesn't wait
+            ...
+            lock.release()
+    """
+
+    def __init__(self, filename, timeout=DEFAULT_LOCK_TIMEOUT, log=None):
+        """
+        :param filename: file name of the claimed work (the lock file is <filename>.lock)
+        :param timeout: time without a heartbeat after which the lock is stale [sec]
+        """
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.filename = filename + LOCK_SUFFIX
+        self.timeout = timeout
+        self.log = log
+        self._token = None
+        self._stop = None
+        self._heartbeat = None
+
+    def holder(self):
+        """
+        :return: dict of the lock file content (host, pid, token and time), None if the lock is free (or unreadable)
+        """
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_stale(self, holder):
+        try:
+            age = time.time() - os.stat(self.filename).st_mtime
+        except FileNotFoundError:
+            return True
+        if age > self.timeout:
+            return True
+        return (holder is not None) and (holder.get("host") == socket.gethostname()) and \
+            (not _is_alive(holder.get("pid", 0)))
+
+    def _reclaim(self):
+        # returns True if the lock file was removed (by this process or another one)
+        holder = self.holder()
+        if holder is None:
+            # just released, or just created and not written yet
+            return not os.path.exists(self.filename) or self._is_stale(None)
+        if not self._is_stale(holder):
+            return False
+
+        # rename first, so that only one of the processes reclaiming the lock removes it
+        stale_file = get_tmp_name(self.filename)
+        try:
+            os.rename(self.filename, stale_file)
+        except FileNotFoundError:
+            return True
+        try:
+            with open(stale_file) as f:
+                reclaimed = json.load(f)
+        except (OSError, ValueError):
+            reclaimed = {}
+        if reclaimed.get("token") != holder.get("token"):
+            # the lock was reclaimed and taken by another process in the meantime, put it back
+            try:
+                os.link(stale_file, self.filename)
+            except OSError:
+                pass
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        self.log.warning(f"Reclaimed stale lock {self.filename} of {holder.get('host')}, process {holder.get('pid')}.")
+        return True
+
+    def try_acquire(self):
+        """
+        :return: True if the lock was acquired, False if it is held by another process
+        """
+        for _ in range(2):
+            try:
+                fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._reclaim():
+                    return False
+                continue
+            self._token = uuid.uuid4().hex
+            with os.fdopen(fd, "w") as f:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "token": self._token,
+                           "time": time.time()}, f)
+            self._stop = threading.Event()
+            self._heartbeat = threading.Thread(target=self._beat, name="pywise-lock", daemon=True)
+            self._heartbeat.start()
+            return True
+        return False
+
+    def acquire(self, poll_interval=1., min_interval=0.01):
+        """
+        waits until the lock is acquired, with an exponential backoff between attempts (so that locks held briefly, e.g.
+        while a frame is appended to a bundle, are taken without waiting a whole poll interval).
+
+        :param poll_interval: maximal time between attempts [sec]
+        :param min_interval: time before the first attempt again [sec]
+        """
+        interval = min_interval
+        is_waiting = False
+        while not self.try_acquire():
+            if (not is_waiting) and (interval >= poll_interval):
+                holder = self.holder() or {}
+                self.log.info(f"Waiting for {os.path.basename(self.filename)}, held by {holder.get('host')}, process "
+                              f"{holder.get('pid')}...")
+                is_waiting = True
+            time.sleep(interval)
+            interval = min(2*interval, poll_interval)
+
+    def _beat(self):
+        while not self._stop.wait(self.timeout/5):
+            try:
+                os.utime(self.filename)
+            except OSError as e:
+                self.log.warning(f"Could not refresh lock {self.filename} ({e}).")
+
+    def release(self):
+        if self._token is None:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        if (self.holder() or {}).get("token") == self._token:
+            os.remove(self.filename)
+        else:
+            self.log.warning(f"Lock {self.filename} was reclaimed by another process while held.")
+        self._token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def get_work_lock(config, filename, log=None):
+    """
+    :param filename: file name of the claimed work (the lock file is <filename>.lock)
+    :return: WorkLock, if LOCKS is set in config.ini (several hosts reducing the same archive), None otherwise
+    """
+    if not config.getboolean("GENERAL", "LOCKS", fallback=False):
+        return None
+    return WorkLock(filename, timeout=config.getint("GENERAL", "LOCK_TIMEOUT", fallback=DEFAULT_LOCK_TIMEOUT), log=log)
@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import logging
+from pywise.bundle import output_exists
+from pywise.locks import WorkLock, get_tmp_name
+
+MANIFEST_FILENAME = ".manifest.json"
+
+
+def get_file_hash(filename, chunk_size=2**20):
+    """
+    :return: SHA-256 hex digest of the file content (hashed where the raw frame is read, just before it is opened, so
+             that the frame itself is then read from the page cache)
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_masters_record(master_files):
+    return [[os.path.basename(filename), os.stat(filename).st_mtime_ns] for filename in master_files]
+
+
+def _is_same_input(entry, input_file, st):
+    return (entry["input"] == os.path.basename(input_file)) and (entry["size"] == st.st_size) and \
+        (entry["mtime"] == st.st_mtime_ns)
+
+
+class Manifest:
+    """
+    per-night record of the reduced frames (in the reduced folder): for each output file, the input file (size,
+    modification time and hash) and the master calibration frames used.
+    """
+
+    def __init__(self, reduced_path, log=None):
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.filename = os.path.join(reduced_path, MANIFEST_FILENAME)
+        self.log = log
+        self._entries = self._read()
+        self._modified = set()
+
+    def _read(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            self.log.warning(f"Could not read manifest {self.filename}, starting a new one.")
+            return {}
+
+    def is_up_to_date(self, output, input_file, master_files, check_hash=True):
+        """
+        :param output: reduced frame file name (or bundled frame, see bundle.get_output_file)
+        :param input_file: raw frame file name
+        :param master_files: master calibration frame file names
+        :param check_hash: False - consider a touched input as changed, without reading it to compare its hash
+        :return: True if the output exists, and neither its input nor its master calibration frames changed since it
+                 was written (outputs missing from the manifest are considered up to date)
+        """
+        if not output_exists(output):
+            return False
+
+        entry = self._entries.get(os.path.basename(output))
+        if entry is None:
+            return True
+
+        if entry["masters"] != _get_masters_record(master_files):
+            return False
+
+        st = os.stat(input_file)
+        if _is_same_input(entry, input_file, st):
+            return True
+
+        # the input was touched, check whether its content changed
+        if (not check_hash) or (entry["hash"] != get_file_hash(input_file)):
+            return False
+
+        entry.update({"input": os.path.basename(input_file), "size": st.st_size, "mtime": st.st_mtime_ns})
+        self._modified.add(os.path.basename(output))
+        return True
+
+    def get_hash(self, output, input_file):
+        """
+        :return: the recorded hash of the input file of an output, if the input's size and modification time didn't
+                 change since (None - the input has to be hashed, see get_file_hash)
+        """
+        entry = self._entries.get(os.path.basename(output))
+        if entry is None:
+            return None
+
+        return entry["hash"] if _is_same_input(entry, input_file, os.stat(input_file)) else None
+
+    def record(self, output, input_file, master_files, file_hash):
+        """
+        :param file_hash: SHA-256 hex digest of the input file (see get_file_hash)
+        """
+        st = os.stat(input_file)
+        self._entries[os.path.basename(output)] = {"input": os.path.basename(input_file), "size": st.st_size,
+                                                   "mtime": st.st_mtime_ns, "hash": file_hash,
+                                                   "masters": _get_masters_record(master_files)}
+        self._modified.add(os.path.basename(output))
+
+    def save(self):
+        """
+        saves the modified entries, merged with those saved by other processes (or hosts) since the manifest was read.
+        """
+        if not self._modified:
+            return
+
+        tmp_file = get_tmp_name(self.filename)
+        try:
+            with WorkLock(self.filename, log=self.log):
+                entries = self._read()
+                entries.update({name: self._entries[name] for name in self._modified})
+                with open(tmp_file, "w") as f:
+                    json.dump(entries, f, indent=1)
+                os.replace(tmp_file, self.filename)
+            self._entries = entries
+            self._modified.clear()
+        except OSError as e:
+            self.log.warning(f"Could not save manifest {self.filename} ({e}).")
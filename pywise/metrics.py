@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_mapped_bytes = 0
+_mapped_lock = threading.Lock()
+
+
+def count_mapped_read(nbytes):
+    """
+    counts bytes read through a memory map (e.g. FITS data opened by astropy), which the OS I/O counters don't see.
+    """
+    global _mapped_bytes
+    with _mapped_lock:
+        _mapped_bytes += nbytes
+
+
+def get_io_bytes():
+    """
+    :return: bytes read and written by this process so far (None if not available on this platform)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]) + _mapped_bytes, int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    if resource is not None:
+        # block counts only, in 512-byte units
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock*512 + _mapped_bytes, usage.ru_oublock*512
+    return None, None
+
+
+def get_peak_rss():
+    """
+    :return: peak resident set size of this process and of its finished child processes [bytes] (None if not available)
+    """
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss*1024
+
+
+def get_cpu_time():
+    """
+    :return: user + system CPU time of this process and of its finished child processes [sec]
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Metrics:
+    """
+    wall time, CPU time, bytes read and written, and peak RSS, accumulated per pipeline stage.
+
+    Stages can be nested (per thread), and are named by their path (e.g. "create_masters/bias"). I/O is counted for this
+    process only (not for worker processes), CPU time also includes worker processes that already finished. Both are
+    process-wide, so stages running concurrently in different threads share them.
+    """
+
+    def __init__(self, log=None):
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.log = log
+        self.stages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._t0 = None
+
+    def start(self, profile=False):
+        """
+        resets the metrics, and starts profiling with cProfile if requested.
+        """
+        self.stages.clear()
+        self._local = threading.local()
+        self._t0 = (time.perf_counter(), get_cpu_time())
+        self._profiler = cProfile.Profile() if profile else None
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    @contextmanager
+    def stage(self, name):
+        if not hasattr(self._local, "path"):
+            self._local.path = []
+        self._local.path.append(name)
+        path = "/".join(self._local.path)
+        read0, written0 = get_io_bytes()
+        t0, cpu0 = time.perf_counter(), get_cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - t0, get_cpu_time() - cpu0
+            read1, written1 = get_io_bytes()
+            with self._lock:
+                entry = self.stages.setdefault(path, {"calls": 0, "wall": 0., "cpu": 0., "read_bytes": 0,
+                                                      "written_bytes": 0, "peak_rss": 0})
+                entry["calls"] += 1
+                entry["wall"] += wall
+                entry["cpu"] += cpu
+                if read0 is not None:
+                    entry["read_bytes"] += read1 - read0
+                    entry["written_bytes"] += written1 - written0
+                entry["peak_rss"] = max(entry["peak_rss"], get_peak_rss() or 0)
+            self._local.path.pop()
+
+    def summary(self, **kwargs):
+        """
+        :param kwargs: additional fields of the summary (e.g. night, telescope)
+        :return: dict of the totals since start, and of the metrics of each stage
+        """
+        total = {}
+        if self._t0 is not None:
+            total = {"wall": time.perf_counter() - self._t0[0], "cpu": get_cpu_time() - self._t0[1],
+                     "peak_rss": get_peak_rss()}
+        return {**kwargs, "total": total, "stages": self.stages}
+
+    def save(self, filename, **kwargs):
+        """
+        saves the summary to <filename>.metrics.json (and the cProfile statistics to <filename>.prof, if profiling).
+        """
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(filename + ".prof")
+            self._profiler = None
+            self.log.info(f"Profile saved in {filename}.prof")
+
+        try:
+            with open(filename + ".metrics.json", "w") as f:
+                json.dump(self.summary(**kwargs), f, indent=1)
+        except OSError as e:
+            self.log.warning(f"Could not save metrics {filename}.metrics.json ({e}).")
+            return
+
+        for path, entry in self.stages.items():
+            self.log.debug(f"{path}: {entry['calls']} calls, {entry['wall']:.3f} s wall, {entry['cpu']:.3f} s CPU, "
+                           f"{entry['read_bytes']/1024**2:.1f} MB read, {entry['written_bytes']/1024**2:.1f} MB written")
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    :return: the metrics of the night being reduced (shared by calframes and wise)
+    """
+    return _metrics
+
+
+def stage(name):
+    """
+    context manager accumulating the metrics of a stage into the shared Metrics.
+    """
+    return _metrics.stage(name)
+
+
+def timed(name):
+    """
+    decorator accumulating the metrics of each call of a function into the shared Metrics, as stage `name`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _metrics.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,247 @@
+import os
+import glob
+import json
+import datetime
+import logging
+from pywise import utils
+from pywise.archive import get_index_dir, get_master_filename, get_master_index, nearest_dates
+from pywise.catalog import get_catalog, group_calframes, DEFAULT_CATALOG_THREADS
+from pywise.bundle import get_bundle_mode, get_output_file
+from pywise.keywords import get_profile
+from pywise.manifest import Manifest
+
+# master frame type (as in the archive file names) and the raw image type it is combined from
+MASTER_TYPES = (("Bias", "BIAS"), ("Dark", "DARK"), ("Flat", "FLAT"))
+
+
+def get_rates(log_path, telescope):
+    """
+    :return: reduction time per science frame [sec] and master creation time per raw calibration byte [sec], from the
+             metrics of the most recent reduce_night of the telescope (None where not available)
+    """
+    per_frame, per_byte = None, None
+    for filename in sorted(glob.glob(os.path.join(log_path, f"*_{telescope}_*.metrics.json")), reverse=True):
+        try:
+            with open(filename) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        stages = summary.get("stages", {})
+        if (per_frame is None) and summary.get("frames") and ("reduce" in stages):
+            per_frame = stages["reduce"]["wall"] / summary["frames"]
+        if (per_byte is None) and stages.get("create_masters", {}).get("read_bytes"):
+            per_byte = stages["create_masters"]["wall"] / stages["create_masters"]["read_bytes"]
+        if (per_frame is not None) and (per_byte is not None):
+            break
+    return per_frame, per_byte
+
+
+def plan_nights(d1, d2=None, telescope="C28", config_file="config.ini", nights=1, log=None):
+    """
+    plans the reduction of a range of nights from the headers of the raw frames only, without reading pixel data or
+    writing any frame: which master calibration frames would be created, which masters each ccd geometry and filter
+    would use, and how many science frames would be reduced or skipped.
+
+    d1 and d2 should be in the format "YYYYMMDD"
+
+    :param nights: number of nights reduced concurrently (nights > 1 creates the masters of the whole range first, so a
+                   night may also use new masters of later nights)
+    :return: list of night plans (dicts)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    config = utils.get_config(config_file)
+    profile = get_profile(telescope)
+    d1 = datetime.datetime.strptime(d1, "%Y%m%d").date()
+    d2 = datetime.datetime.strptime(d2, "%Y%m%d").date() if d2 is not None else d1
+
+    max_day_shift = config.getint("CAL", "MAX_DAY_SHIFT")
+    min_num_frames = config.getint("CAL", "MIN_NUM_FRAMES")
+    max_num_frames = config.getint("CAL", "MAX_NUM_FRAMES")
+    is_cal_overwrite = config.getboolean("CAL", "OVERWRITE")
+    is_overwrite = config.getboolean("GENERAL", "OVERWRITE")
+    cal_archive_path = config.get("CAL", "PATH") + telescope + os.sep
+    index = get_master_index(cal_archive_path, telescope, index_dir=get_index_dir(config), log=log) \
+        if os.path.isdir(cal_archive_path) else None
+    ccd_keys = utils.get_ccd_keys(telescope)
+    threads = config.getint("GENERAL", "CATALOG_THREADS", fallback=DEFAULT_CATALOG_THREADS)
+    bundle_by = get_bundle_mode(config, log=log)
+
+    # masters of the range: which would be created, by (frame type, instrument, ccd_str, filter) -> dates
+    plans = []
+    created = {}
+    for t in utils.daterange(d1, d2):
+        t_str = t.strftime("%Y%m%d")
+        im_path = config.get("GENERAL", "PATH") + config.get(telescope, "PATH") + t_str + \
+            config.get(telescope, "DIR_SUFFIX") + os.sep
+        plan = {"night": t_str, "path": im_path, "exists": os.path.isdir(im_path), "masters": [], "batches": [],
+                "read_bytes": 0, "master_read_bytes": 0, "write_bytes": 0}
+        plans.append(plan)
+        if not plan["exists"]:
+            continue
+
+        imlist = get_catalog(im_path, threads=threads, log=log)
+        if len(imlist.files) == 0:
+            continue
+        plan["instrument"] = instrument = imlist.values(profile.key("instrument"), True)[0]
+        plan["imlist"] = imlist
+        groups, plan["geometries"] = group_calframes(imlist, telescope)
+        for geometry in plan["geometries"]:
+            ccd_str = utils.get_ccd_str({key: [val] for key, val in zip(ccd_keys, geometry)})
+            for frame_type, image_type in MASTER_TYPES:
+                filters = sorted(key[2] for key in groups if (key[0] == image_type) and (key[1] == geometry))
+                for filt in filters:
+                    filenames = groups[(image_type, geometry, filt)]
+                    if max_num_frames > 0:
+                        filenames = filenames[:max_num_frames]
+                    master_file = get_master_filename(cal_archive_path, frame_type, telescope, instrument, t, ccd_str,
+                                                      filt or "")
+                    if os.path.isfile(master_file) and (not is_cal_overwrite):
+                        action = "exists"
+                    elif len(filenames) >= min_num_frames:
+                        action = "create"
+                        created.setdefault((frame_type, instrument, ccd_str, filt or ""), set()).add(t)
+                        plan["master_read_bytes"] += sum(os.path.getsize(filename) for filename in filenames)
+                    else:
+                        action = "too few frames"
+                    plan["masters"].append({"file": master_file, "frames": len(filenames), "action": action})
+
+    # science frames: the masters they would use, and whether they are already reduced
+    archived = {}  # dates of the archived masters, by (frame type, instrument, ccd_str, filter)
+    archived_geometries = {}  # ccd_str of the archived masters, by (frame type, instrument, filter)
+
+    def get_dates(key, t):
+        dates = set(created.get(key, ())) if nights > 1 else {d for d in created.get(key, ()) if d <= t}
+        if (key not in archived) and (index is not None):
+            archived[key] = set(index.get_master_dates(*key))
+        return dates | archived.get(key, set())
+
+    def get_sources(frame_type, instrument, ccd_str, filt):
+        # the ccd geometry itself, and the unbinned geometries containing it (see calframes.derive_master)
+        if ((frame_type, instrument, filt) not in archived_geometries) and (index is not None):
+            archived_geometries[(frame_type, instrument, filt)] = index.get_ccd_strs(frame_type, instrument, filt)
+        sources = set(archived_geometries.get((frame_type, instrument, filt), [])) | \
+            {key[2] for key in created if key[:2] == (frame_type, instrument) and (key[3] == filt)}
+        target = utils.parse_ccd_str(ccd_str)
+        return {ccd_str} | {source for source in sources
+                            if utils.get_window(utils.parse_ccd_str(source), target) is not None}
+
+    for plan in plans:
+        if "imlist" not in plan:
+            continue
+        t = datetime.datetime.strptime(plan["night"], "%Y%m%d").date()
+        imlist = plan.pop("imlist").filtered(**{profile.key("image_type"): profile.val("light")})
+        reduced_path = plan["path"] + config.get("GENERAL", "REDUCED_DIR") + os.sep
+        manifest = Manifest(reduced_path, log=log)
+
+        batches = {}
+        for filename in imlist.files:
+            header = imlist.header(filename)
+            geometry = tuple(header.get(key) for key in utils.get_ccd_keys(telescope, original_keys=True))
+            batches.setdefault((geometry, header.get(profile.key("filter").lower())), []).append(filename)
+
+        for (geometry, filt), filenames in batches.items():
+            ccd_str = utils.get_ccd_str({key: [val] for key, val in zip(ccd_keys, geometry)})
+            batch = {"ccd_str": ccd_str, "filter": filt, "frames": len(filenames), "masters": {}, "reduce": 0,
+                     "skip": 0}
+            is_new_master = False
+            for frame_type, _ in MASTER_TYPES:
+                frame_filt = filt if frame_type == "Flat" else ""
+                # the nearest master (of the ccd geometry itself on equal distance)
+                best = None
+                for source in get_sources(frame_type, plan["instrument"], ccd_str, frame_filt):
+                    key = (frame_type, plan["instrument"], source, frame_filt)
+                    nearest = nearest_dates(sorted(get_dates(key, t)), [t], max_day_shift=max_day_shift)[t]
+                    if nearest is None:
+                        continue
+                    rank = (abs((nearest - t).days), source != ccd_str, nearest)
+                    if (best is None) or (rank < best[0]):
+                        best = (rank, key, nearest)
+                if best is None:
+                    batch["masters"][frame_type] = None
+                    continue
+                _, key, nearest = best
+                master_file = get_master_filename(cal_archive_path, frame_type, telescope, plan["instrument"], nearest,
+                                                  ccd_str, frame_filt)
+                is_derived = key[2] != ccd_str
+                is_new = (nearest in created.get(key, ())) or (is_derived and not os.path.isfile(master_file))
+                is_new_master |= is_new
+                batch["masters"][frame_type] = {"file": master_file, "new": is_new, "derived": is_derived}
+            plan["batches"].append(batch)
+            if None in batch["masters"].values():
+                # skipped by reduce_night, for lack of calibration frames
+                continue
+
+            master_files = [master["file"] for master in batch["masters"].values()]
+            for filename in filenames:
+                output = get_output_file(reduced_path, imlist.fits_header(filename), filt, telescope,
+                                         bundle_by=bundle_by)
+                if (not is_overwrite) and (not is_new_master) and \
+                        manifest.is_up_to_date(output, plan["path"] + filename, master_files, check_hash=False):
+                    batch["skip"] += 1
+                    continue
+                batch["reduce"] += 1
+                header = imlist.header(filename)
+                plan["read_bytes"] += os.path.getsize(plan["path"] + filename)
+                plan["write_bytes"] += 4*header["naxis1"]*header["naxis2"]  # float32
+
+    return plans
+
+
+def get_gaps(plans):
+    """
+    :param plans: output of plan_nights
+    :return: list of (night, ccd_str, filter, number of science frames, missing master frame types) of the science frames
+             that would have no master calibration frames within MAX_DAY_SHIFT days
+    """
+    return [(plan["night"], batch["ccd_str"], batch["filter"], batch["frames"],
+             [frame_type for frame_type, master in batch["masters"].items() if master is None])
+            for plan in plans for batch in plan["batches"] if None in batch["masters"].values()]
+
+
+def format_plan(plans, log_path=None, telescope="C28"):
+    """
+    :param plans: output of plan_nights
+    :param log_path: folder of the metrics of previous reductions, used to estimate the run time (None - no estimate)
+    :return: the plan as text
+    """
+    lines = []
+    n_create, n_reduce, n_skip, n_missing = 0, 0, 0, 0
+    read_bytes, master_read_bytes, write_bytes = 0, 0, 0
+    for plan in plans:
+        if not plan["exists"]:
+            lines.append(f"{plan['night']}: folder {plan['path']} doesn't exist.")
+            continue
+        lines.append(f"{plan['night']}: {plan['path']}")
+        for master in plan["masters"]:
+            lines.append(f"  {master['action']:>14}: {os.path.basename(master['file'])} ({master['frames']} raw frames)")
+        for batch in plan["batches"]:
+            lines.append(f"  {batch['ccd_str']} {batch['filter']}: {batch['reduce']} frames to reduce, "
+                         f"{batch['skip']} already reduced")
+            for frame_type, master in batch["masters"].items():
+                if master is None:
+                    lines.append(f"    {frame_type:>4}: none within the maximal day shift, the frames would be skipped!")
+                else:
+                    lines.append(f"    {frame_type:>4}: {os.path.basename(master['file'])}{' (new)' if master['new'] else ''}"
+                                 f"{' (derived)' if master['derived'] else ''}")
+            if None in batch["masters"].values():
+                n_missing += batch["frames"]
+            n_reduce += batch["reduce"]
+            n_skip += batch["skip"]
+        n_create += sum(master["action"] == "create" for master in plan["masters"])
+        read_bytes += plan["read_bytes"]
+        master_read_bytes += plan["master_read_bytes"]
+        write_bytes += plan["write_bytes"]
+
+    lines.append(f"Total: {n_create} master frames to create, {n_reduce} science frames to reduce, {n_skip} already "
+                 f"reduced, {n_missing} without calibration frames.")
+    lines.append(f"Reading {(read_bytes + master_read_bytes)/1024**2:.1f} MB, writing {write_bytes/1024**2:.1f} MB "
+                 f"(float32, before compression).")
+    if log_path is not None:
+        per_frame, per_byte = get_rates(log_path, telescope)
+        if per_frame is not None:
+            estimate = n_reduce*per_frame + (master_read_bytes*per_byte if per_byte is not None else 0)
+            lines.append(f"Estimated time: {estimate:.1f} s (from the metrics of the last reduced night).")
+
+    return "\n".join(lines)
@@ -0,0 +1,102 @@
+import zlib
+import struct
+import logging
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData
+from pywise import fastcal
+from pywise.calframes import bin_frame
+from pywise.catalog import open_hdu
+from pywise.keywords import get_profile, get_output_name, fix_rbi_delay
+from pywise.locks import atomic_output
+from pywise.metrics import stage
+
+PREVIEW_FORMATS = ("png", "fits")
+DEFAULT_PREVIEW_BINNING = 8
+# lower and upper percentiles of the PNG intensity stretch
+PNG_STRETCH = (0.5, 99.5)
+
+# binned master calibration frames (wise.Masters they were binned from, FastMasters), by
+# (bias_file, dark_file, flat_file, binning)
+_preview_masters = {}
+
+
+def get_preview_masters(masters, binning):
+    """
+    :param masters: wise.Masters
+    :return: FastMasters of the master calibration frames, binned by the mean of binning x binning pixels
+    """
+    key = (masters.bias_file, masters.dark_file, masters.flat_file, binning)
+    # masters loaded again (e.g. created again while following a night) are binned again
+    if (key not in _preview_masters) or (_preview_masters[key][0] is not masters):
+        bias, dark, flat = [CCDData(data=bin_frame(np.asarray(master.data), binning, binning, method="mean"),
+                                    unit=master.unit, header=master.header)
+                            for master in (masters.bias, masters.dark, masters.flat)]
+        _preview_masters[key] = (masters, fastcal.prepare_masters(bias, dark, flat))
+    return _preview_masters[key][1]
+
+
+def write_png(filename, data, stretch=PNG_STRETCH):
+    """
+    writes a frame as an 8-bit grayscale PNG (with zlib, without an imaging library), linearly stretched between two
+    percentiles, with the first row of the frame at the bottom (as FITS viewers show it).
+    """
+    finite = data[np.isfinite(data)]
+    vmin, vmax = np.percentile(finite, stretch) if finite.size > 0 else (0., 1.)
+    scaled = (np.nan_to_num(data, nan=vmin) - vmin) * (255 / max(vmax - vmin, np.finfo(np.float32).tiny))
+    rows = np.zeros((data.shape[0], data.shape[1] + 1), dtype=np.uint8)  # each row starts with filter type 0
+    rows[:, 1:] = np.clip(scaled, 0, 255)[::-1]
+
+    def chunk(tag, content):
+        return struct.pack(">I", len(content)) + tag + content + struct.pack(">I", zlib.crc32(tag + content))
+
+    with atomic_output(filename) as tmp_file:
+        with open(tmp_file, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", data.shape[1], data.shape[0], 8, 0, 0, 0, 0)))
+            f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 1)))
+            f.write(chunk(b"IEND", b""))
+
+
+def preview_image(filename, filt, preview_path, masters, telescope, binning=DEFAULT_PREVIEW_BINNING,
+                  preview_format="png", log=None):
+    """
+    calibrates a binned preview of a raw science frame with binned master calibration frames, and saves it to the
+    preview folder (as a PNG thumbnail, or a float32 FITS file).
+
+    :param filename: raw frame file name (with the path)
+    :param masters: wise.Masters of the raw frame
+    :param binning: number of pixels binned (by their mean) along each axis
+    :return: preview file name
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    profile = get_profile(telescope)
+    with open_hdu(filename, memmap=True) as im:
+        header = im.header.copy()
+        output = preview_path + get_output_name(header, filt, telescope) + "." + preview_format
+        with stage("read"):
+            data = bin_frame(im.data, binning, binning, method="mean")
+    bscale, bzero = header.pop("BSCALE", 1), header.pop("BZERO", 0)
+
+    with stage("calibrate"):
+        if bscale != 1:
+            np.multiply(data, np.float32(bscale), out=data)
+        if bzero != 0:
+            np.add(data, np.float32(bzero), out=data)
+        fastcal.calibrate(data, header[profile.key("exptime")], get_preview_masters(masters, binning))
+
+    with stage("write"):
+        if preview_format == "png":
+            write_png(output, data)
+        else:
+            fix_rbi_delay(header, telescope, log=log)
+            for axis in ("x", "y"):
+                header[profile.key(f"{axis}_bin")] = header.get(profile.key(f"{axis}_bin"), 1)*binning
+                header[profile.key(f"{axis}_subframe")] = header.get(profile.key(f"{axis}_subframe"), 0)//binning
+            header["PREVIEW"] = (binning, "binned quick-look preview")
+            with atomic_output(output) as tmp_file:
+                fits.PrimaryHDU(data=data, header=header).writeto(tmp_file, overwrite=True)
+
+    return output
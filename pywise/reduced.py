@@ -0,0 +1,80 @@
+import os
+import csv
+import logging
+from pywise.keywords import get_profile, get_jd
+from pywise.locks import WorkLock, get_tmp_name
+
+REDUCED_CATALOG_FILENAME = "reduced_frames.csv"
+# header values of each reduced frame (TelescopeProfile keys), taken from the raw frame header
+HEADER_KEYS = ("object", "jd", "filter", "exptime", "airmass", "x_naxis", "y_naxis", "x_subframe", "y_subframe",
+               "x_bin", "y_bin")
+COLUMNS = ("filename",) + HEADER_KEYS + ("debias", "dedark", "deflat", "raw_file")
+
+
+class ReducedCatalog:
+    """
+    per-night table of the reduced frames (a CSV file in the reduced folder): for each reduced frame, its key header
+    values (with the JD corrected for the RBI flood delay) and the master calibration frames used, so that the reduced
+    frames can be selected without opening them.
+    """
+
+    def __init__(self, reduced_path, telescope, log=None):
+        if log is None:
+            log = logging.getLogger(__name__)
+
+        self.filename = os.path.join(reduced_path, REDUCED_CATALOG_FILENAME)
+        self.telescope = telescope
+        self.log = log
+        self._rows = {}
+
+    def _read(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        try:
+            with open(self.filename, newline="") as f:
+                return {row["filename"]: row for row in csv.DictReader(f)}
+        except (OSError, csv.Error, KeyError):
+            self.log.warning(f"Could not read reduced frame catalog {self.filename}, starting a new one.")
+            return {}
+
+    def record(self, output, input_file, header, master_files):
+        """
+        :param output: reduced frame file name
+        :param input_file: raw frame file name
+        :param header: raw frame header (astropy.io.fits.Header)
+        :param master_files: master bias, dark and flat file names
+        """
+        profile = get_profile(self.telescope)
+        row = {"filename": os.path.basename(output)}
+        for key in HEADER_KEYS:
+            if key == "jd":
+                row[key] = get_jd(header, self.telescope).to_value()
+            else:
+                row[key] = header.get(profile.find_key(key, header), "") if key in profile.keys else ""
+        for key, master_file in zip(("debias", "dedark", "deflat"), master_files):
+            row[key] = os.path.basename(master_file)
+        row["raw_file"] = os.path.basename(input_file)
+        self._rows[row["filename"]] = row
+
+    def save(self):
+        """
+        adds the recorded frames to the catalog (replacing older rows of the same frames), and replaces the catalog file
+        in one step, so that readers always see a complete table.
+        """
+        if not self._rows:
+            return
+
+        tmp_file = get_tmp_name(self.filename)
+        try:
+            with WorkLock(self.filename, log=self.log):
+                rows = self._read()
+                rows.update(self._rows)
+                with open(tmp_file, "w", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+                    writer.writeheader()
+                    for name in sorted(rows):
+                        writer.writerow(rows[name])
+                os.replace(tmp_file, self.filename)
+            self._rows.clear()
+        except OSError as e:
+            self.log.warning(f"Could not save reduced frame catalog {self.filename} ({e}).")
@@ -0,0 +1,85 @@
+import os
+import logging
+from pywise.archive import MasterResolver, get_index_dir, get_master_index
+from pywise.cache import get_master_cache
+from pywise.catalog import HeaderCatalog, DEFAULT_CATALOG_THREADS
+from pywise.utils import get_config, init_log, close_log
+
+
+class ReductionSession:
+    """
+    state shared by the reduction of consecutive nights: config.ini (parsed once), a single logger (with a log file per
+    night), the header catalogs of the night folders, the loaded master calibration frames, and the nearest masters of
+    the nights of the range (see resolve_range).
+
+    Usage:
+        with ReductionSession("config.ini") as session:
+            for day in days:
+                wise.reduce_night(day.year, day.month, day.day, "C28", session=session)
+    """
+
+    def __init__(self, config_file="config.ini", log=None):
+        """
+        :param log: logger of the session (None - a logger with a log file per night, see start_night)
+        """
+        self.config_file = config_file
+        self.config = get_config(config_file)
+        self.log = log if log is not None else logging.getLogger(__name__)
+        self.cache = get_master_cache(self.config, log=self.log)
+        self.catalogs = {}
+        # master calibration frames (wise.Masters) of the current night and of the previous one, by
+        # (bias_file, dark_file, flat_file, engine, memmap)
+        self.masters = {}
+        self.previous_masters = {}
+        # MasterResolver of the nights being reduced, by telescope
+        self.resolvers = {}
+
+    def start_night(self, log_name):
+        """
+        starts the log file of a night, replacing the log handlers of the previous night, and keeps only the master
+        calibration frames of the previous night (for reuse by this one).
+
+        :param log_name: log file name (without extension)
+        :return: the session logger
+        """
+        init_log(log_name, config=self.config, log=self.log)
+        self.previous_masters, self.masters = self.masters, {}
+        return self.log
+
+    def resolve_range(self, telescope, nights):
+        """
+        lets create_masters and get_calframes find the nearest master calibration frames of a range of nights in a
+        single sweep over the calibration archive (see archive.MasterResolver).
+
+        :param nights: list of datetime.date
+        :return: the MasterResolver of the telescope
+        """
+        cal_archive_path = self.config.get("CAL", "PATH") + telescope + os.sep
+        index = get_master_index(cal_archive_path, telescope, index_dir=get_index_dir(self.config), log=self.log)
+        self.resolvers[telescope] = MasterResolver(index, nights,
+                                                   max_day_shift=self.config.getint("CAL", "MAX_DAY_SHIFT"))
+        return self.resolvers[telescope]
+
+    def get_catalog(self, location):
+        """
+        :return: the (refreshed) HeaderCatalog of a night folder
+        """
+        key = os.path.abspath(location)
+        if key not in self.catalogs:
+            self.catalogs[key] = HeaderCatalog(location, log=self.log,
+                                               threads=self.config.getint("GENERAL", "CATALOG_THREADS",
+                                                                          fallback=DEFAULT_CATALOG_THREADS))
+        else:
+            self.catalogs[key].refresh()
+        return self.catalogs[key]
+
+    def close(self):
+        close_log(self.log)
+        self.masters.clear()
+        self.previous_masters.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,17 +2,26 @@ import numpy as np
 from configparser import ConfigParser
 import logging
 import os
+import re
 import datetime
+from pywise.keywords import get_profile, load_profiles
 
 
 def get_config(config_file="config.ini"):
     config = ConfigParser(inline_comment_prefixes=';')
     config.read(config_file)
+    load_profiles(config)
     return config
 
 
-def init_log(filename="log.log", config_file="config.ini"):
-    config = get_config(config_file)
+def init_log(filename="log.log", config_file="config.ini", config=None, log=None):
+    """
+    :param config: parsed config.ini (None - read config_file)
+    :param log: logger to set up (None - the pywise logger), its previous handlers are closed
+    :return: logger writing to the console and to <LOG.PATH>/<filename>.log
+    """
+    if config is None:
+        config = get_config(config_file)
     log_path = config.get('LOG', 'PATH')  # log file path
     console_log_level = config.get('LOG', 'CONSOLE_LEVEL')  # logging level
     file_log_level = config.get('LOG', 'FILE_LEVEL')  # logging level
@@ -21,8 +30,11 @@ def init_log(filename="log.log", config_file="config.ini"):
     if not os.path.exists(log_path):
         os.makedirs(log_path)
 
-    log = logging.getLogger(__name__)
+    if log is None:
+        log = logging.getLogger(__name__)
     log.setLevel(logging.DEBUG)
+    # drop the handlers of a previous call, otherwise every log line is written once per call
+    close_log(log)
 
     # console handler
     h = logging.StreamHandler()
@@ -54,7 +66,7 @@ def find_groups(imlist, keys, return_inverse=False):
     """
     sorts imlist to groups according to keys.
 
-    :param imlist: ccdproc.ImageFileCollection
+    :param imlist: ccdproc.ImageFileCollection or catalog.HeaderCatalog
     :param keys: list of keywords
     :param return_inverse: True - return unique indices
     :return: groups by keywords
@@ -69,18 +81,23 @@ def find_groups(imlist, keys, return_inverse=False):
         return groups
 
 
-def get_ccd_shape(imlist, telescope, original_keys=False):
+def get_ccd_keys(telescope, original_keys=False):
+    """
+    :param original_keys: True - return the header keywords, False - return the ccd_shape keys
+    :return: list of the keys describing the ccd geometry (size, subframe origin and binning)
+    """
     out_keys = ["x_naxis", "y_naxis", "x_subframe", "y_subframe", "x_bin", "y_bin"]
-    if telescope in ["1m", "C28", "C18"]:
-        keys = ["naxis1", "naxis2", "xorgsubf", "yorgsubf", "xbinning", "ybinning"]
-    else:
-        raise Exception(f"Not implemented for {telescope} yet!")
+    if original_keys:
+        # lower case, as in catalog.HeaderCatalog
+        profile = get_profile(telescope)
+        return [profile.key(key).lower() for key in out_keys]
+    return out_keys
 
-    groups = find_groups(imlist, keys)
 
-    if original_keys:
-        out_keys = keys
+def get_ccd_shape(imlist, telescope, original_keys=False):
+    groups = find_groups(imlist, get_ccd_keys(telescope, original_keys=True))
 
+    out_keys = get_ccd_keys(telescope, original_keys=original_keys)
     ccd_shape = {out_keys[i]: groups[i] for i in range(len(out_keys))}
 
     return ccd_shape
@@ -100,6 +117,38 @@ def get_ccd_str(ccd_shape, idx=0):
     return ccd_str
 
 
+def parse_ccd_str(ccd_str):
+    """
+    :return: single set of ccd_shape values (as returned by get_set_from_dict) of an output of get_ccd_str, None if it
+             doesn't match
+    """
+    match = re.match(r"^x(\d+)-(\d+)_(\d+)bin_y(\d+)-(\d+)_(\d+)bin$", ccd_str)
+    if match is None:
+        return None
+    keys = ["x_subframe", "x_naxis", "x_bin", "y_subframe", "y_naxis", "y_bin"]
+    return dict(zip(keys, map(int, match.groups())))
+
+
+def get_window(source, target):
+    """
+    :param source: single set of ccd_shape values of an unbinned frame
+    :param target: single set of ccd_shape values of a (subframed and/or binned) frame, whose subframe origin is in
+                   binned pixels
+    :return: (y slice, x slice) of the source data covering the target frame (in unbinned pixels), None if the source
+             is binned or doesn't contain the target frame
+    """
+    if (source["x_bin"] != 1) or (source["y_bin"] != 1):
+        return None
+    window = []
+    for axis in ["y", "x"]:
+        start = target[f"{axis}_subframe"]*target[f"{axis}_bin"] - source[f"{axis}_subframe"]
+        stop = start + target[f"{axis}_naxis"]*target[f"{axis}_bin"]
+        if (start < 0) or (stop > source[f"{axis}_naxis"]):
+            return None
+        window.append(slice(start, stop))
+    return tuple(window)
+
+
 def daterange(start_date, end_date):
     for n in range(int((end_date - start_date).days) + 1):
         yield start_date + datetime.timedelta(n)
@@ -1,18 +1,377 @@
 import os
 import time
-from pywise import calframes, utils
-from pywise.keywords import get_key_name, get_key_val
-import ccdproc
+import logging
+import logging.handlers
+import multiprocessing
+import threading
+from queue import Queue, Empty, Full
+from contextlib import ExitStack
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pywise import calframes, fastcal, utils
+from pywise.bundle import get_bundle_mode, get_output_file, split_output, write_output, get_output_size, get_index, \
+    compact_bundle
+from pywise.cache import get_master_cache
+from pywise.catalog import open_hdu
+from pywise.keywords import get_profile, get_jd, get_output_name, is_rbi_delayed, fix_rbi_delay
+from pywise.locks import get_work_lock
+from pywise.manifest import Manifest, get_file_hash
+from pywise.reduced import ReducedCatalog
+from pywise.metrics import get_metrics, stage
+from pywise.plan import plan_nights, get_gaps
+from pywise.preview import preview_image, PREVIEW_FORMATS, DEFAULT_PREVIEW_BINNING
+from pywise.output import get_output_format, OUTPUT_FORMATS, DEFAULT_QUANTIZE_LEVEL
+from pywise.session import ReductionSession
 import numpy as np
 from astropy import units as u
+from astropy.nddata import CCDData
 import datetime
-from pywise.utils import get_config, init_log, close_log, daterange_func
+from pywise.utils import get_config, init_log, close_log, daterange, daterange_func
+
+
+Masters = namedtuple("Masters", ["bias", "dark", "flat", "bias_file", "dark_file", "flat_file", "fast"])
+
+# master calibration frames loaded without a ReductionSession (and, in worker processes, inherited from the night being
+# reduced), by (bias_file, dark_file, flat_file, engine, memmap)
+_masters = {}
+# reusable float32 frame buffers of the memory-mapped input mode, by frame shape
+_buffers = {}
+_worker_log = None
+# ReductionSession of a process reducing some of the nights of a range (see schedule_nights)
+_worker_session = None
+
+
+def load_masters(bias_file, dark_file, flat_file, engine="ccdproc", memmap=False, log=None, session=None):
+    """
+    :param memmap: True - wrap the memory-mapped master data instead of copies (see MasterCache.read)
+    :param session: ReductionSession keeping the loaded masters (None - keep them in this module)
+    :return: Masters, read through the shared master cache (and prepared for the fast engine if requested)
+    """
+    key = (bias_file, dark_file, flat_file, engine, memmap)
+    loaded = _masters if session is None else session.masters
+    if (key not in loaded) and (session is not None) and (key in session.previous_masters):
+        # already loaded for the previous night
+        loaded[key] = session.previous_masters[key]
+    if key not in loaded:
+        cache = get_master_cache(log=log)
+        bias = cache.read(bias_file, memmap=memmap)
+        dark = cache.read(dark_file, memmap=memmap)
+        flat = cache.read(flat_file, memmap=memmap)
+        if engine == "fast":
+            fast_masters = fastcal.prepare_masters(bias, dark, flat)
+        else:
+            fast_masters = None
+        loaded[key] = Masters(bias, dark, flat, bias_file, dark_file, flat_file, fast_masters)
+
+    return loaded[key]
+
+
+def calibrate_image(im, masters, telescope, save_uncertainty=False, out=None):
+    """
+    subtracts bias, subtracts dark and corrects flat field of a single science image.
+
+    :param im: raw science image (astropy.io.fits HDU)
+    :param masters: Masters - use the fast calibration engine instead of ccdproc if masters.fast is set
+    :param out: reusable float32 buffer of the frame shape - if given, im is unscaled raw data (opened with
+                open_hdu(memmap=True)), converted into out one tile at a time (and calibrated in place by the fast engine)
+    :return: calibrated ccdproc.CCDData (float32)
+    """
+    bias_file, dark_file, flat_file = masters.bias_file, masters.dark_file, masters.flat_file
+    exptime_key = get_profile(telescope).key("exptime")
+    exptime = im.header[exptime_key]
+
+    if out is not None:
+        header = im.header.copy()
+        bscale, bzero = header.pop("BSCALE", 1), header.pop("BZERO", 0)
+        data = fastcal.convert_raw(im.data, out, bscale=bscale, bzero=bzero, exptime=exptime, masters=masters.fast)
+        im = CCDData(data=data, unit=u.adu, header=header)
+    else:
+        im = CCDData(data=im.data.astype("float32"), unit=u.adu, header=im.header)
+        if masters.fast is not None:
+            fastcal.calibrate(im.data, exptime, masters.fast)
+
+    if masters.fast is not None:
+        im.header["DEBIAS"] = bias_file.split(os.sep)[-1]
+        im.header["DEDARK"] = dark_file.split(os.sep)[-1]
+        im.header["DEFLAT"] = flat_file.split(os.sep)[-1]
+        return im
+
+    import ccdproc  # only the ccdproc engine needs it (importing it takes a while)
+    im = ccdproc.subtract_bias(im, masters.bias,
+                               add_keyword=ccdproc.Keyword("DEBIAS", value=bias_file.split(os.sep)[-1]))
+    im = ccdproc.subtract_dark(im, masters.dark, exposure_time=exptime_key, exposure_unit=u.s,
+                               scale=True, add_keyword=ccdproc.Keyword("DEDARK", value=dark_file.split(os.sep)[-1]))
+    im = ccdproc.flat_correct(im, masters.flat, add_keyword=ccdproc.Keyword("DEFLAT", value=flat_file.split(os.sep)[-1]))
+    if not save_uncertainty:
+        im.uncertainty = None
+        im.mask = None
+    im.data = im.data.astype('float32', copy=False)
+
+    return im
+
+
+def reduce_image(im, filt, reduced_path, masters, telescope, save_uncertainty=False, memmap=False,
+                 output_format="fits", quantize_level=DEFAULT_QUANTIZE_LEVEL, bundle_by=None, log=None):
+    """
+    calibrates a single science image and saves it to the reduced folder.
+
+    :param memmap: True - im was opened with open_hdu(memmap=True), convert it through a reusable frame buffer
+    :param output_format: output format of the reduced image (see pywise.output.write_reduced)
+    :param bundle_by: None - save the reduced image to its own file, "filter" or "object" - append it to the bundle of
+                      its filter or object (see pywise.bundle.get_output_file)
+    :return: reduced image file name (or bundled frame)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    filename = get_output_file(reduced_path, im.header, filt, telescope, bundle_by=bundle_by)
+
+    fix_rbi_delay(im.header, telescope, log=log)
+    with stage("read"):
+        im.data  # the pixel data is read on first access (or mapped, with memmap)
+    out = None
+    if memmap:
+        if im.data.shape not in _buffers:
+            _buffers[im.data.shape] = np.empty(im.data.shape, dtype=np.float32)
+        out = _buffers[im.data.shape]
+    with stage("calibrate"):
+        im = calibrate_image(im, masters, telescope, save_uncertainty=save_uncertainty, out=out)
+    with stage("write"):
+        _write_image(im, filename, output_format, quantize_level, log)
+
+    return filename
+
+
+def _write_image(im, filename, output_format, quantize_level, log):
+    t0 = time.perf_counter()
+    write_output(im, filename, output_format=output_format, quantize_level=quantize_level, log=log)
+    dt = time.perf_counter() - t0
+    size = get_output_size(filename)
+    log.debug(f"Saved {os.path.basename(filename)} ({size/1024**2:.1f} MB, compression ratio {im.data.nbytes/size:.2f}, "
+              f"{im.data.nbytes/1024**2/dt:.0f} MB/s).")
+
+
+def _put(q, item, stop):
+    # blocks until there is room in the queue, unless the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    # blocks until an item arrives, unless the pipeline is stopped (returns None)
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except Empty:
+            pass
+    return None
+
+
+def reduce_overlapped(tasks, im_path, reduced_path, telescope, save_uncertainty=False, memmap=False,
+                      output_format="fits", quantize_level=DEFAULT_QUANTIZE_LEVEL, bundle_by=None, prefetch=2,
+                      on_saved=None, file_hashes=None, log=None):
+    """
+    reduces science frames with overlapped I/O: a reader thread reads up to `prefetch` frames ahead, the calling thread
+    calibrates them, and a writer thread saves up to `prefetch` calibrated frames behind.
+
+    At most 2*prefetch + 3 frames are in memory at once. As in a sequential reduction, an error stops the reduction, but
+    the frames calibrated before it are still saved. The error is raised once the threads have stopped.
+
+    :param tasks: list of (raw file name, filter, Masters), in reduction order
+    :param on_saved: function called (in the writer thread) with the reduced file name, the raw file name, the Masters
+                     and the raw file hash (see manifest.get_file_hash, computed by the reader) of each saved frame
+    :param file_hashes: dict of the known raw file hashes, by raw file name (see Manifest.get_hash; the other raw files
+                        are hashed by the reader)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if file_hashes is None:
+        file_hashes = {}
+
+    read_queue = Queue(maxsize=prefetch)
+    write_queue = Queue(maxsize=prefetch)
+    stop_reading = threading.Event()
+    stop_writing = threading.Event()
+    errors = []
+    done = object()
+    # calibrated frames still referenced by the writer use at most prefetch + 2 buffers (see calibrate_image)
+    buffers = {}
+    n_buffers = prefetch + 2
+
+    def read():
+        try:
+            for filename, filt, masters in tasks:
+                with ExitStack() as stack:
+                    try:
+                        with stage("reduce/read"):
+                            file_hash = file_hashes.get(filename) or get_file_hash(im_path + filename)
+                            im = stack.enter_context(open_hdu(im_path + filename, memmap=memmap))
+                            if memmap:
+                                # page the data in, so that the calibration doesn't wait for the disk
+                                np.asarray(im.data).view(np.uint8).reshape(-1)[::4096].sum()
+                            else:
+                                im.data  # the pixel data is read on first access
+                    except Exception:
+                        log.error(f"Could not read {filename}.")
+                        raise
+                    # the file is closed by the calibration stage
+                    item = (filename, filt, masters, file_hash, im, stack.pop_all())
+                if not _put(read_queue, item, stop_reading):
+                    item[-1].close()
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _put(read_queue, done, stop_reading)
+
+    def write():
+        try:
+            while True:
+                item = _get(write_queue, stop_writing)
+                if (item is None) or (item is done):
+                    return
+                im, output, filename, masters, file_hash = item
+                with stage("reduce/write"):
+                    _write_image(im, output, output_format, quantize_level, log)
+                if on_saved is not None:
+                    on_saved(output, filename, masters, file_hash)
+        except Exception as e:
+            errors.append(e)
+            stop_writing.set()
+            stop_reading.set()
+
+    threads = [threading.Thread(target=read, name="pywise-reader", daemon=True),
+               threading.Thread(target=write, name="pywise-writer", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        i = 0
+        while True:
+            item = _get(read_queue, stop_reading)
+            if (item is None) or (item is done):
+                break
+            filename, filt, masters, file_hash, im, stack = item
+            with stack:
+                log.debug(f"{filename}")
+                output = get_output_file(reduced_path, im.header, filt, telescope, bundle_by=bundle_by)
+                fix_rbi_delay(im.header, telescope, log=log)
+                out = None
+                if memmap:
+                    shape = im.data.shape
+                    if shape not in buffers:
+                        buffers[shape] = [np.empty(shape, dtype=np.float32) for _ in range(n_buffers)]
+                    out = buffers[shape][i % n_buffers]
+                with stage("calibrate"):
+                    im = calibrate_image(im, masters, telescope, save_uncertainty=save_uncertainty, out=out)
+            if not _put(write_queue, (im, output, filename, masters, file_hash), stop_writing):
+                break
+            i += 1
+    except BaseException:
+        stop_reading.set()
+        raise
+    finally:
+        # let the writer save the frames that were already calibrated
+        _put(write_queue, done, stop_writing)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def _init_worker(queue, config_file=None, telescope=None, nights=None):
+    """
+    :param nights: nights of the range reduced by schedule_nights (None - the worker reduces the frames of a night)
+    """
+    global _worker_log
+
+    if config_file is not None:
+        # register the telescope profiles of config.ini (not inherited by spawned processes)
+        get_config(config_file)
+
+    # forward log records to the listener of the main process
+    _worker_log = logging.getLogger(f"{__name__}.worker")
+    _worker_log.setLevel(logging.DEBUG)
+    _worker_log.propagate = False
+    for h in list(_worker_log.handlers):
+        _worker_log.removeHandler(h)
+    _worker_log.addHandler(logging.handlers.QueueHandler(queue))
+    get_master_cache(log=_worker_log)
+    if nights is not None:
+        _init_session(config_file, telescope, nights, log=_worker_log)
+
+
+def _init_session(config_file, telescope, nights, log=None):
+    global _worker_session
+
+    # the nearest masters of the whole range are resolved once per process, as in reduce_nights
+    _worker_session = ReductionSession(config_file, log=log)
+    _worker_session.resolve_range(telescope, nights)
+
+
+def _reduce_file(filename, filt, reduced_path, master_files, telescope, engine, save_uncertainty, memmap,
+                 output_format, quantize_level, bundle_by, file_hash=None):
+    """
+    :param file_hash: the raw file hash, if known (None - hash the raw file)
+    :return: reduced image file name (or bundled frame), and the raw file hash (see manifest.get_file_hash)
+    """
+    _worker_log.debug(f"{os.path.basename(filename)}")
+    masters = load_masters(*master_files, engine=engine, memmap=memmap, log=_worker_log)
+    if file_hash is None:
+        file_hash = get_file_hash(filename)
+    with open_hdu(filename, memmap=memmap) as im:
+        output = reduce_image(im, filt, reduced_path, masters, telescope, save_uncertainty=save_uncertainty,
+                              memmap=memmap, output_format=output_format, quantize_level=quantize_level,
+                              bundle_by=bundle_by, log=_worker_log)
+    return output, file_hash
 
 
 def reduce_night(year=datetime.date.today().year, month=datetime.date.today().month, day=datetime.date.today().day,
-                 telescope="C28", config_file="config.ini"):
-    config = get_config(config_file)
-    log = init_log(time.strftime("%Y%m%d_%H%M%S", time.gmtime()), config_file)
+                 telescope="C28", config_file="config.ini", workers=1, create_calframes=True, preview=False,
+                 session=None):
+    """
+    :param create_calframes: True - create the master calibration frames of the night first (ignored with preview)
+    :param preview: True - only save binned quick-look previews of the science frames to the preview folder (see
+                    preview.preview_image), instead of reducing them, with existing (or derivable) master calibration
+                    frames only
+    :param session: ReductionSession shared by consecutive nights (None - a session of this night only, reading
+                    config_file)
+    """
+    if session is None:
+        with ReductionSession(config_file) as session:
+            return reduce_night(year, month, day, telescope, workers=workers, create_calframes=create_calframes,
+                                preview=preview, session=session)
+
+    config = session.config
+    t_str = datetime.date(year, month, day).strftime("%Y%m%d")
+
+    log_name = time.strftime("%Y%m%d_%H%M%S", time.gmtime()) + f"_{telescope}_{t_str}"
+    log = session.start_night(log_name)
+    metrics = get_metrics()
+    metrics.log = log
+    metrics.start(profile=config.getboolean("LOG", "PROFILE", fallback=False))
+
+    # the metrics (and the profile) of the night are saved however it ends
+    summary = {"frames": 0}
+    try:
+        return _run_night(year, month, day, telescope, workers, create_calframes, preview, session, log, summary)
+    finally:
+        metrics.save(config.get("LOG", "PATH") + log_name, night=t_str, telescope=telescope, **summary)
+
+
+def _run_night(year, month, day, telescope, workers, create_calframes, preview, session, log, summary):
+    """
+    :param summary: dict of the additional fields of the metrics summary of the night (updated in place)
+    """
+    config = session.config
+    config_file = session.config_file
+    profile = get_profile(telescope)
+    metrics = get_metrics()
 
     t = datetime.date(year, month, day)
     t_str = datetime.date.strftime(t, format="%Y%m%d")
@@ -23,95 +382,326 @@ def reduce_night(year=datetime.date.today().year, month=datetime.date.today().mo
         log.warning(f"Folder {im_path} doesn't exist!")
         return
 
-    log.info(f"""Creating {telescope} master calibration frames for {t_str}...""")
-    calframes.create_masters(year, month, day, telescope, log=log, config_file=config_file)
+    if create_calframes and (not preview):
+        log.info(f"""Creating {telescope} master calibration frames for {t_str}...""")
+        calframes.create_masters(year, month, day, telescope, log=log, session=session)
 
-    imlist = ccdproc.ImageFileCollection(im_path, keywords='*')
-    files = imlist.files_filtered(imagetyp="LIGHT")
-    if len(files.tolist()) == 0:
+    with stage("catalog"):
+        imlist = session.get_catalog(im_path).filtered(**{profile.key("image_type"): profile.val("light")})
+    if len(imlist.files) == 0:
         log.warning(f"No science frames in {t_str}.")
         return
 
-    imlist = ccdproc.ImageFileCollection(im_path, keywords='*', filenames=files.tolist())
-
     save_uncertainty = config.getboolean("GENERAL", "SAVE_UNCERTAINTY")
     is_overwrite = config.getboolean("GENERAL", "OVERWRITE")
+    engine = config.get("GENERAL", "ENGINE", fallback="ccdproc")
+    if (engine == "fast") and save_uncertainty:
+        log.warning("The fast calibration engine doesn't propagate uncertainties, using ccdproc instead.")
+        engine = "ccdproc"
+    memmap = config.getboolean("GENERAL", "MEMMAP", fallback=False)
+    output_format, quantize_level = get_output_format(config, telescope)
+    if output_format not in OUTPUT_FORMATS:
+        log.warning(f"Unknown output format {output_format}, saving float32 FITS files instead.")
+        output_format = "fits"
+    prefetch = config.getint("GENERAL", "PREFETCH", fallback=2)
+    bundle_by = get_bundle_mode(config, log=log)
 
-    instrument = imlist.values("instrume", True)[0]
+    instrument = imlist.values(profile.key("instrument"), True)[0]
     ccd_shape = utils.get_ccd_shape(imlist, telescope)
 
     reduced_path = im_path + config.get("GENERAL", "REDUCED_DIR") + os.sep
-    # create reduced folder
-    if not os.path.exists(reduced_path):
-        os.makedirs(reduced_path)
+    cache = session.cache
 
+    # find and load the master calibration frames of each ccd geometry and filter
+    batches = []
+    n_no_masters = 0
     log.debug(f"""ccd_shape length {len(ccd_shape["x_naxis"])}""")
     for i in range(len(ccd_shape["x_naxis"])):
         ccd_set = utils.get_set_from_dict(ccd_shape, i)
         ccd_str = utils.get_ccd_str(ccd_shape, idx=i)
-        filters = np.unique(imlist.summary["filter"])
+        filters = np.unique(imlist.values(profile.key("filter")))
         log.debug(f"{filters}")
         for filt in filters:
+            kwargs = dict()
+            kwargs[profile.key("image_type")] = profile.val("light")
+            kwargs[profile.key("filter")] = filt
+            kwargs[profile.key("x_naxis")] = ccd_set["x_naxis"]
+            kwargs[profile.key("y_naxis")] = ccd_set["y_naxis"]
+            kwargs[profile.key("x_subframe")] = ccd_set["x_subframe"]
+            kwargs[profile.key("y_subframe")] = ccd_set["y_subframe"]
+            kwargs[profile.key("x_bin")] = ccd_set["x_bin"]
+            kwargs[profile.key("y_bin")] = ccd_set["y_bin"]
+
             bias_file, dark_file, flat_file = calframes.get_calframes(year, month, day, filt, ccd_str, telescope=telescope,
-                                                                      instrument=instrument, log=log, config_file=config_file)
+                                                                      instrument=instrument, log=log, session=session)
             if (not bias_file) or (not dark_file) or (not flat_file):
                 log.warning(f"No calibration frames found, skipping.")
+                n_no_masters += len(imlist.files_filtered(**kwargs))
                 continue
 
-            bias = ccdproc.CCDData.read(bias_file)
-            dark = ccdproc.CCDData.read(dark_file)
-            flat = ccdproc.CCDData.read(flat_file)
+            with stage("load_masters"):
+                masters = load_masters(bias_file, dark_file, flat_file, engine=engine, memmap=memmap, log=log,
+                                       session=session)
 
-            kwargs = dict()
-            kwargs[get_key_name("image_type", telescope)] = get_key_val("light", telescope)
-            kwargs[get_key_name("filter", telescope)] = filt
-            kwargs[get_key_name("x_naxis", telescope)] = ccd_set["x_naxis"]
-            kwargs[get_key_name("y_naxis", telescope)] = ccd_set["y_naxis"]
-            kwargs[get_key_name("x_subframe", telescope)] = ccd_set["x_subframe"]
-            kwargs[get_key_name("y_subframe", telescope)] = ccd_set["y_subframe"]
-            kwargs[get_key_name("x_bin", telescope)] = ccd_set["x_bin"]
-            kwargs[get_key_name("y_bin", telescope)] = ccd_set["y_bin"]
-
-            for im, filename in imlist.hdus(return_fname=True, **kwargs):
-                log.debug(f"{filename}")
+            batches.append((filt, ccd_str, masters, kwargs))
+
+    if preview:
+        preview_path = im_path + config.get("GENERAL", "PREVIEW_DIR", fallback="preview") + os.sep
+        binning = config.getint("GENERAL", "PREVIEW_BINNING", fallback=DEFAULT_PREVIEW_BINNING)
+        preview_format = config.get("GENERAL", "PREVIEW_FORMAT", fallback="png").lower()
+        if preview_format not in PREVIEW_FORMATS:
+            log.warning(f"Unknown preview format {preview_format}, saving PNG previews instead.")
+            preview_format = "png"
+        if not os.path.exists(preview_path):
+            os.makedirs(preview_path)
+
+        # previews are cheap to redo, so they are neither claimed nor recorded in the manifest: a preview is only
+        # skipped if it is newer than its raw frame
+        previews = []
+        with stage("preview"):
+            for filt, ccd_str, masters, kwargs in batches:
+                for filename in imlist.files_filtered(**kwargs):
+                    output = preview_path + get_output_name(imlist.fits_header(filename), filt, telescope) + "." + \
+                        preview_format
+                    if (not is_overwrite) and os.path.isfile(output) and \
+                            (os.path.getmtime(output) >= os.path.getmtime(im_path + filename)):
+                        log.debug(f"{filename} already has a preview, skipping.")
+                        continue
+                    previews.append(preview_image(im_path + filename, filt, preview_path, masters, telescope,
+                                                  binning=binning, preview_format=preview_format, log=log))
+        preview_time = metrics.stages["preview"]["wall"]
+        log.info(f"Saved {len(previews)} {binning}x{binning} binned previews in {preview_format} format to "
+                 f"{preview_path} ({len(previews)/max(preview_time, 1e-6):.1f} frames/s).")
+        cache.log_stats(log)
+        summary.update(frames=len(previews), preview=binning)
+        return preview_path
+
+    # create reduced folder
+    if not os.path.exists(reduced_path):
+        os.makedirs(reduced_path)
+
+    # claim the batches (when several hosts reduce the same nights), and skip those claimed by other hosts
+    claims = ExitStack()
+    claimed = []
+    n_other_hosts = 0
+    for filt, ccd_str, masters, kwargs in batches:
+        lock = get_work_lock(config, f"{reduced_path}.{ccd_str}_{filt}", log=log)
+        if lock is None:
+            claimed.append((filt, masters, kwargs))
+        elif lock.try_acquire():
+            claims.callback(lock.release)
+            claimed.append((filt, masters, kwargs))
+        else:
+            holder = lock.holder() or {}
+            log.info(f"{filt} {ccd_str} frames are being reduced by {holder.get('host')}, process {holder.get('pid')}, "
+                     f"skipping.")
+            n_other_hosts += len(imlist.files_filtered(**kwargs))
+
+    # decide which frames to reduce from their headers only (the manifest is read once the batches are claimed, so
+    # that it includes the frames reduced by the previous holders)
+    manifest = Manifest(reduced_path, log=log)
+    reduced_catalog = ReducedCatalog(reduced_path, telescope, log=log)
+    tasks = []
+    n_reduced = 0
+    outputs = []
+    # hashes of the raw frames that didn't change since they were last reduced, which needn't be read again
+    file_hashes = {}
+
+    def record(output, filename, master_files, file_hash):
+        outputs.append(output)
+        manifest.record(output, im_path + filename, master_files, file_hash)
+        reduced_catalog.record(output, im_path + filename, imlist.fits_header(filename), master_files)
+
+    try:
+        with stage("plan"):
+            for filt, masters, kwargs in claimed:
+                master_files = (masters.bias_file, masters.dark_file, masters.flat_file)
+                for filename in imlist.files_filtered(**kwargs):
+                    output = get_output_file(reduced_path, imlist.fits_header(filename), filt, telescope,
+                                             bundle_by=bundle_by)
+                    if (not is_overwrite) and manifest.is_up_to_date(output, im_path + filename, master_files):
+                        log.debug(f"{filename} is already reduced, skipping.")
+                        n_reduced += 1
+                        continue
+                    file_hash = manifest.get_hash(output, im_path + filename)
+                    if file_hash is not None:
+                        file_hashes[filename] = file_hash
+                    tasks.append((filename, filt, masters))
+        log.info(f"Reducing {len(tasks)} science frames ({n_reduced} already reduced, {n_other_hosts} claimed by other "
+                 f"hosts, {n_no_masters} without calibration frames)...")
+
+        with stage("reduce"):
+            if workers > 1:
+                # the masters are already loaded, so forked workers share them instead of receiving them with every frame
+                _masters.clear()
+                _masters.update(session.masters)
+                queue = multiprocessing.Queue()
+                listener = logging.handlers.QueueListener(queue, *log.handlers, respect_handler_level=True)
+                listener.start()
+                try:
+                    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                             initargs=(queue, config_file)) as executor:
+                        futures = []
+                        for filename, filt, masters in tasks:
+                            master_files = (masters.bias_file, masters.dark_file, masters.flat_file)
+                            future = executor.submit(_reduce_file, im_path + filename, filt, reduced_path, master_files,
+                                                     telescope, engine, save_uncertainty, memmap, output_format,
+                                                     quantize_level, bundle_by, file_hashes.get(filename))
+                            futures.append((future, filename, master_files))
+                        log.info(f"Using {workers} workers.")
+                        for future, filename, master_files in futures:
+                            output, file_hash = future.result()
+                            record(output, filename, master_files, file_hash)
+                finally:
+                    listener.stop()
+                    _masters.clear()
+            elif prefetch > 0:
+                def on_saved(output, filename, masters, file_hash):
+                    record(output, filename, (masters.bias_file, masters.dark_file, masters.flat_file), file_hash)
+
+                reduce_overlapped(tasks, im_path, reduced_path, telescope, save_uncertainty=save_uncertainty,
+                                  memmap=memmap, output_format=output_format, quantize_level=quantize_level,
+                                  bundle_by=bundle_by, prefetch=prefetch, on_saved=on_saved, file_hashes=file_hashes,
+                                  log=log)
+            else:
+                for filename, filt, masters in tasks:
+                    log.debug(f"{filename}")
+                    file_hash = file_hashes.get(filename) or get_file_hash(im_path + filename)
+                    with open_hdu(im_path + filename, memmap=memmap) as im:
+                        output = reduce_image(im, filt, reduced_path, masters, telescope,
+                                              save_uncertainty=save_uncertainty, memmap=memmap,
+                                              output_format=output_format, quantize_level=quantize_level,
+                                              bundle_by=bundle_by, log=log)
+                    record(output, filename, (masters.bias_file, masters.dark_file, masters.flat_file), file_hash)
+    finally:
+        manifest.save()
+        reduced_catalog.save()
+        claims.close()
 
-                obj = im.header[get_key_name("object", telescope)]
-                jd = im.header[get_key_name("jd", telescope)]*u.day
-                # fix JD for RBI flood delay (C28):
-                if telescope == "C28":
-                    if im.header[get_key_name("readout", telescope)] == get_key_val("rbi", telescope):
-                        jd = jd + get_key_val("rbi_delay", telescope)
-                        im.header[get_key_name("jd", telescope)] = jd.to_value()
-                        im.header[get_key_name("rbi_delay", telescope)] = "TRUE"
-                        im.header.comments[get_key_name("rbi_delay", telescope)] = f"""Corrected JD by {get_key_val("rbi_delay", telescope)} of RBI flood delay."""
-                        log.warning(f"""Corrected RBI flood delay of {get_key_val("rbi_delay", telescope)}.""")
-
-                jd = str(jd.to_value()).replace(".", "_")
-                filename = f"{obj}_{jd}_{filt}_{telescope}"
-
-                file_exists = os.path.isfile(reduced_path + filename + ".fits")
-                if (not file_exists) | (file_exists & is_overwrite):
-                    im.data = im.data.astype("float32")
-                    im = ccdproc.subtract_bias(ccdproc.CCDData(data=im.data, unit=u.adu, header=im.header), bias,
-                                               add_keyword=ccdproc.Keyword("DEBIAS", value=bias_file.split(os.sep)[-1]))
-                    im = ccdproc.subtract_dark(im, dark, exposure_time=get_key_name("exptime", telescope), exposure_unit=u.s,
-                                               scale=True, add_keyword=ccdproc.Keyword("DEDARK", value=dark_file.split(os.sep)[-1]))
-                    im = ccdproc.flat_correct(im, flat, add_keyword=ccdproc.Keyword("DEFLAT", value=flat_file.split(os.sep)[-1]))
-                    if not save_uncertainty:
-                        im.uncertainty = None
-                        im.mask = None
-                    im.data = im.data.astype('float32')
-                    im.write(reduced_path + filename + ".fits", overwrite=True)
-
-    close_log(log)
+    if outputs:
+        # float32 data size of the reduced frames, compared to the size of the files written
+        nbytes = sum(4*imlist.header(filename)["naxis1"]*imlist.header(filename)["naxis2"] for filename, _, _ in tasks)
+        size = sum(get_output_size(output) for output in outputs)
+        write_time = metrics.stages.get("reduce/write", {}).get("wall")  # not measured with workers
+        throughput = f", {nbytes/1024**2/write_time:.0f} MB/s" if write_time else ""
+        log.info(f"Saved {len(outputs)} reduced frames in {output_format} format: {size/1024**2:.1f} MB "
+                 f"(compression ratio {nbytes/size:.2f}{throughput}).")
+
+        # frames reduced again (e.g. with OVERWRITE) leave their previous copies in their bundles
+        bundle_files = {split_output(output)[0] for output in outputs if split_output(output)[1] is not None}
+        for bundle_file in sorted(bundle_files):
+            if get_index(bundle_file).n_superseded > 0:
+                with stage("compact"):
+                    compact_bundle(bundle_file, log=log)
+
+    cache.log_stats(log)
+    summary.update(frames=len(tasks), workers=workers)
 
     return reduced_path
 
 
-def reduce_nights(d1, d2=None, telescope="C28", config_file="config.ini"):
+def log_gaps(d1, d2, telescope, config_file, nights=1, log=None):
+    """
+    logs up front the science frames of a range of nights that will have no master calibration frames within
+    MAX_DAY_SHIFT days (taking into account the masters that will be created from the raw frames of the range), from
+    the headers only (see plan.plan_nights).
+
+    d1 and d2 should be in the format "YYYYMMDD"
+
+    :return: list of gaps (see plan.get_gaps)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    max_day_shift = get_config(config_file).getint("CAL", "MAX_DAY_SHIFT")
+    gaps = get_gaps(plan_nights(d1, d2, telescope, config_file=config_file, nights=nights, log=log))
+    for night, ccd_str, filt, frames, frame_types in gaps:
+        log.warning(f"{night} {ccd_str} {filt}: no master {', '.join(frame_types).lower()} within {max_day_shift} "
+                    f"days, {frames} science frames will be skipped!")
+    if gaps:
+        log.warning(f"{sum(gap[3] for gap in gaps)} science frames of {len({gap[0] for gap in gaps})} night(s) have no "
+                    f"calibration frames.")
+    else:
+        log.info(f"All the {telescope} science frames of {d1}-{d2 or d1} have master calibration frames.")
+    return gaps
+
+
+def _create_masters(year, month, day, telescope, frame_types):
+    calframes.create_masters(year, month, day, telescope, log=_worker_log, frame_types=frame_types,
+                             session=_worker_session)
+
+
+def _reduce_night(year, month, day, telescope, workers):
+    return reduce_night(year, month, day, telescope, workers=workers, create_calframes=False, session=_worker_session)
+
+
+def schedule_nights(d1, d2=None, telescope="C28", config_file="config.ini", nights=2, workers=1):
+    """
+    reduces a range of nights concurrently.
+
+    Since a night may use the master calibration frames of its neighbours, all the master biases of the range are
+    created first, then all the master darks, then all the master flats (each stage in parallel over the nights).
+    Only then the science frames are reduced, with up to `nights` nights in flight.
+
+    d1 and d2 should be in the format "YYYYMMDD"
+    """
+    d1 = datetime.datetime.strptime(d1, "%Y%m%d")
+    if d2 is not None:
+        d2 = datetime.datetime.strptime(d2, "%Y%m%d")
+    else:
+        d2 = d1
+    days = list(daterange(d1, d2))
+    nights_range = [day.date() for day in days]
+
+    log = init_log(time.strftime("%Y%m%d_%H%M%S", time.gmtime()) + f"_{telescope}_masters", config_file)
+    log_gaps(d1.strftime("%Y%m%d"), d2.strftime("%Y%m%d"), telescope, config_file, nights=nights, log=log)
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(queue, *log.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=nights, initializer=_init_worker,
+                                 initargs=(queue, config_file, telescope, nights_range)) as executor:
+            for frame_type in ["bias", "dark", "flat"]:
+                log.info(f"Creating {telescope} master {frame_type} frames for {len(days)} nights...")
+                futures = [executor.submit(_create_masters, day.year, day.month, day.day, telescope, (frame_type,))
+                           for day in days]
+                for future in futures:
+                    future.result()
+    finally:
+        listener.stop()
+        close_log(log)
+
+    with ProcessPoolExecutor(max_workers=nights, initializer=_init_session,
+                             initargs=(config_file, telescope, nights_range)) as executor:
+        futures = [executor.submit(_reduce_night, day.year, day.month, day.day, telescope, workers)
+                   for day in days]
+        for future in futures:
+            future.result()
+
+    return
+
+
+def reduce_nights(d1, d2=None, telescope="C28", config_file="config.ini", workers=1, nights=1, preview=False):
     """
     d1 and d2 should be in the format "YYYYMMDD"
+
+    nights > 1 reduces up to `nights` nights concurrently (see schedule_nights)
+    preview=True saves binned quick-look previews of the nights instead (see reduce_night)
     """
-    daterange_func(d1, d2, reduce_night, telescope=telescope, config_file=config_file)
+    if (nights > 1) and (not preview):
+        schedule_nights(d1, d2, telescope=telescope, config_file=config_file, nights=nights, workers=workers)
+        return
+
+    # a single session (config, logger, catalogs, masters and nearest masters) for the whole range
+    with ReductionSession(config_file) as session:
+        log = session.start_night(time.strftime("%Y%m%d_%H%M%S", time.gmtime()) + f"_{telescope}_{d1}-{d2 or d1}")
+        if not preview:
+            log_gaps(d1, d2, telescope, config_file, log=log)
+        days = daterange(datetime.datetime.strptime(d1, "%Y%m%d").date(),
+                         datetime.datetime.strptime(d2 or d1, "%Y%m%d").date())
+        session.resolve_range(telescope, days)
+        # previews use the existing (or derivable) master calibration frames only
+        daterange_func(d1, d2, reduce_night, telescope=telescope, workers=workers, create_calframes=not preview,
+                       preview=preview, session=session)
 
     return
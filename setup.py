@@ -18,5 +18,5 @@ setup(name='pywise',
           'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
           'Programming Language :: Python',
           'Topic :: Scientific/Engineering :: Astronomy'],
-      scripts=['bin/wise_reduce']
+      scripts=['bin/wise_reduce', 'bin/wise_export']
       )
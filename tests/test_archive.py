@@ -0,0 +1,46 @@
+import os
+import datetime
+from pywise.archive import MasterIndex
+from pywise.locks import atomic_output
+
+CCD_STR = "x1-2048_1bin_y1-2048_1bin"
+
+
+def _write_master(cal_archive_path, name):
+    filename = os.path.join(cal_archive_path, name)
+    with atomic_output(filename) as tmp_file:
+        with open(tmp_file, "wb") as f:
+            f.write(b"\0"*2880)
+    return filename
+
+
+def test_index_updates_without_rescan(tmp_path, monkeypatch):
+    cal_archive_path = str(tmp_path / "C28") + os.sep
+    os.makedirs(cal_archive_path)
+    index = MasterIndex(cal_archive_path, "C28", index_dir=str(tmp_path / "index"))
+    assert not index.index_file.startswith(cal_archive_path)
+
+    _write_master(cal_archive_path, f"Bias_C28_ML16803_20200101_{CCD_STR}.fits")
+    assert index.get_dates("Bias", "ML16803", CCD_STR) == ["20200101"]
+
+    # masters written (and indexed) by this process don't trigger a rescan of the archive folder
+    listdir = os.listdir
+    scans = []
+    monkeypatch.setattr(os, "listdir", lambda path: scans.append(path) or listdir(path))
+    index.add(_write_master(cal_archive_path, f"Bias_C28_ML16803_20200103_{CCD_STR}.fits"))
+    assert index.find_nearest("Bias", "ML16803", datetime.date(2020, 1, 4), CCD_STR) == \
+        os.path.join(cal_archive_path, f"Bias_C28_ML16803_20200103_{CCD_STR}.fits")
+    assert scans == []
+
+    # masters written by anyone else do
+    _write_master(cal_archive_path, f"Bias_C28_ML16803_20200104_{CCD_STR}.fits")
+    assert index.get_dates("Bias", "ML16803", CCD_STR) == ["20200101", "20200103", "20200104"]
+    assert scans == [cal_archive_path]
+
+    # the index is shared by the processes of the same host, without a rescan
+    other = MasterIndex(cal_archive_path, "C28", index_dir=str(tmp_path / "index"))
+    assert other.index_file == index.index_file
+    assert other.get_dates("Bias", "ML16803", CCD_STR) == ["20200101", "20200103", "20200104"]
+    assert scans == [cal_archive_path]
+    index.close()
+    other.close()
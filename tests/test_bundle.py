@@ -0,0 +1,64 @@
+import os
+import numpy as np
+from astropy import units as u
+from astropy.nddata import CCDData
+from pywise import bundle
+from pywise.output import write_reduced
+
+
+def _frame(value):
+    ccd = CCDData(np.full((32, 48), value, dtype=np.float32), unit=u.adu)
+    ccd.header["FRAME"] = value
+    return ccd
+
+
+def _frame_bytes(ccd, tmp_path, output_format):
+    filename = str(tmp_path / f"frame_{ccd.header['FRAME']}.fits")
+    write_reduced(ccd, filename, output_format=output_format)
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def test_append_compact_export(tmp_path):
+    bundle_file = str(tmp_path / "bundle_V_C28.fits")
+    frames = {"a": _frame(1), "b": _frame(2), "c": _frame(3)}
+
+    bundle.write_output(frames["a"], f"{bundle_file}[a]")
+    # another host, with its own index, appends to the same bundle
+    first = bundle._indexes.pop(os.path.abspath(bundle_file))
+    mtime_ns = os.stat(first.filename).st_mtime_ns
+    bundle.write_output(frames["b"], f"{bundle_file}[b]")
+    bundle.write_output(frames["c"], f"{bundle_file}[c]")
+    # as seen through a coarse modification time
+    os.utime(first.filename, ns=(mtime_ns, mtime_ns))
+
+    # this host appends "a" again with its first index, and compacts the bundle
+    bundle._indexes[os.path.abspath(bundle_file)] = first
+    frames["a"] = _frame(4)
+    bundle.write_output(frames["a"], f"{bundle_file}[a]")
+    assert bundle.get_index(bundle_file).n_superseded == 1
+    bundle.compact_bundle(bundle_file)
+
+    for index in (bundle.get_index(bundle_file), bundle.BundleIndex(bundle_file)):
+        index.refresh()
+        assert sorted(index.frames) == ["a", "b", "c"]
+        assert index.n_superseded == 0
+    for name, ccd in frames.items():
+        assert bundle.read_bytes(f"{bundle_file}[{name}]") == _frame_bytes(ccd, tmp_path, "fits")
+
+    out_path = tmp_path / "exported"
+    out_path.mkdir()
+    filenames = bundle.export_bundle(bundle_file, out_path=str(out_path))
+    assert len(filenames) == 3
+    for name, ccd in frames.items():
+        with open(out_path / f"{name}.fits", "rb") as f:
+            assert f.read() == _frame_bytes(ccd, tmp_path, "fits")
+
+
+def test_compressed_frame(tmp_path):
+    bundle_file = str(tmp_path / "bundle_M31_C28.fits")
+    ccd = _frame(5)
+    bundle.write_output(ccd, f"{bundle_file}[x]", output_format="int16")
+    assert bundle.read_bytes(f"{bundle_file}[x]") == _frame_bytes(ccd, tmp_path, "int16")
+    bundle.write_output(ccd, f"{bundle_file}[y]", output_format="rice")
+    assert np.array_equal(bundle.read_bundled(f"{bundle_file}[y]")[1].data, ccd.data)
@@ -0,0 +1,26 @@
+import os
+from pywise.keywords import get_profile
+from pywise.utils import get_config
+
+CONFIG_EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini.example")
+
+
+def test_config_example():
+    config = get_config(CONFIG_EXAMPLE)
+    assert not config.getboolean("LOG", "PROFILE")
+    assert get_profile("C28").key("jd") == "JD"
+
+
+def test_log_profile_is_not_a_telescope_profile(tmp_path):
+    config_file = tmp_path / "config.ini"
+    with open(CONFIG_EXAMPLE) as f:
+        config_file.write_text(f.read().replace("PROFILE = False", "PROFILE = True", 1))
+    assert get_config(str(config_file)).getboolean("LOG", "PROFILE")
+
+
+def test_base_profile(tmp_path):
+    config_file = tmp_path / "config.ini"
+    config_file.write_text("[C28B]\nBASE_PROFILE = C28\nKEY_JD = JUL-DATE\n")
+    get_config(str(config_file))
+    assert get_profile("C28B").key("jd") == "JUL-DATE"
+    assert get_profile("C28B").key("readout") == get_profile("C28").key("readout")
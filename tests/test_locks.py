@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import subprocess
+from pywise.locks import WorkLock
+
+
+def _write_holder(lock, host, pid, token="other", age=0):
+    with open(lock.filename, "w") as f:
+        json.dump({"host": host, "pid": pid, "token": token, "time": time.time() - age}, f)
+    if age:
+        os.utime(lock.filename, (time.time() - age, time.time() - age))
+
+
+def test_contention(tmp_path):
+    filename = str(tmp_path / "work")
+    lock, other = WorkLock(filename), WorkLock(filename)
+    assert lock.try_acquire()
+    assert not other.try_acquire()
+    assert other.holder()["pid"] == os.getpid()
+
+    # acquire waits for the release
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (other.acquire(poll_interval=0.05), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.2)
+    lock.release()
+    assert acquired.wait(5)
+    thread.join()
+    assert not lock.try_acquire()
+    other.release()
+    assert not os.path.exists(other.filename)
+
+
+def test_stale_reclaim(tmp_path, caplog):
+    lock = WorkLock(str(tmp_path / "work"), timeout=60)
+
+    # held by a process of this host that is gone
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    _write_holder(lock, socket.gethostname(), dead.pid)
+    with caplog.at_level(logging.WARNING):
+        assert lock.try_acquire()
+    assert "Reclaimed stale lock" in caplog.text
+    lock.release()
+
+    # held by another host that stopped refreshing the lock
+    _write_holder(lock, "other-host", 1, age=120)
+    assert lock.try_acquire()
+    assert lock.holder()["host"] == socket.gethostname()
+    lock.release()
+
+    # but not while it is refreshed
+    _write_holder(lock, "other-host", 1)
+    assert not lock.try_acquire()
+    assert lock.holder()["host"] == "other-host"
+
+
+def test_release_by_non_owner(tmp_path, caplog):
+    filename = str(tmp_path / "work")
+    lock, other = WorkLock(filename), WorkLock(filename)
+
+    # a lock that was never acquired is not released
+    assert lock.try_acquire()
+    other.release()
+    assert lock.holder()["token"] == lock._token
+
+    # a lock reclaimed by another process while held is left to it
+    _write_holder(lock, "other-host", 1, token="other")
+    with caplog.at_level(logging.WARNING):
+        lock.release()
+    assert "was reclaimed by another process" in caplog.text
+    assert WorkLock(filename).holder()["token"] == "other"
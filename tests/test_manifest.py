@@ -0,0 +1,32 @@
+import os
+from pywise.manifest import Manifest, get_file_hash
+
+
+def test_hash_is_reused_until_the_input_changes(tmp_path):
+    input_file = str(tmp_path / "raw.fits")
+    master_file = str(tmp_path / "Bias.fits")
+    output = str(tmp_path / "reduced.fits")
+    for filename in [input_file, master_file, output]:
+        with open(filename, "wb") as f:
+            f.write(b"\0"*2880)
+
+    manifest = Manifest(str(tmp_path))
+    assert manifest.get_hash(output, input_file) is None
+    manifest.record(output, input_file, [master_file], get_file_hash(input_file))
+    manifest.save()
+
+    manifest = Manifest(str(tmp_path))
+    assert manifest.get_hash(output, input_file) == get_file_hash(input_file)
+    assert manifest.is_up_to_date(output, input_file, [master_file])
+
+    # a touched input is hashed again (but is still up to date if its content didn't change)
+    st = os.stat(input_file)
+    os.utime(input_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert manifest.get_hash(output, input_file) is None
+    assert manifest.is_up_to_date(output, input_file, [master_file])
+    assert manifest.get_hash(output, input_file) == get_file_hash(input_file)
+
+    with open(input_file, "ab") as f:
+        f.write(b"\0"*2880)
+    assert manifest.get_hash(output, input_file) is None
+    assert not manifest.is_up_to_date(output, input_file, [master_file])